@@ -1,7 +1,7 @@
 """Configuration management."""
 
 import os
-from typing import List
+from typing import List, Optional
 from dotenv import load_dotenv
 from pathlib import Path
 
@@ -63,3 +63,49 @@ def get_test_cred_string() -> str:
     """Get test credential string for development."""
     return os.environ.get("TEST_CRED_STRING", "")
 
+
+def get_mail_store_dir() -> Optional[str]:
+    """Directory of the on-disk mail mirror; unset disables it."""
+    return os.environ.get("MAIL_STORE_DIR") or None
+
+
+def get_mail_store_max_bytes() -> Optional[int]:
+    """Blob budget of the mail mirror in bytes (MAIL_STORE_MAX_MB)."""
+    value = os.environ.get("MAIL_STORE_MAX_MB")
+    return int(value) * 1024 * 1024 if value else None
+
+
+def get_parse_cache_max_bytes() -> Optional[int]:
+    """Memory budget of the parsed-message cache in bytes (PARSE_CACHE_MAX_MB)."""
+    value = os.environ.get("PARSE_CACHE_MAX_MB")
+    return int(value) * 1024 * 1024 if value else None
+
+
+def get_state_store_url() -> str:
+    """Backend of the shared token/OAuth state store: memory://, sqlite:///path or redis://host:port/db."""
+    return os.environ.get("STATE_STORE_URL", "memory://")
+
+
+def get_state_store_key() -> Optional[str]:
+    """Secret the state store encrypts values with; unset stores them in clear."""
+    return os.environ.get("STATE_STORE_KEY") or None
+
+
+def get_state_snapshot_path() -> Optional[str]:
+    """File the in-memory state store is saved to at shutdown and loaded from at startup."""
+    return os.environ.get("STATE_SNAPSHOT_PATH") or None
+
+
+def get_graph_text_bodies() -> bool:
+    """Ask Graph for plain-text bodies (GRAPH_TEXT_BODIES=1); the /messages "html" field is then empty."""
+    return os.environ.get("GRAPH_TEXT_BODIES", "").strip().lower() in ("1", "true", "yes")
+
+
+def get_graph_notification_url() -> Optional[str]:
+    """Public URL of POST /graph/notifications for Graph change notifications; unset keeps polling only."""
+    return os.environ.get("GRAPH_NOTIFICATION_URL") or None
+
+
+def get_prefetch_enabled() -> bool:
+    """Prefetch the next page and the newest bodies after serving /messages (PREFETCH=1)."""
+    return os.environ.get("PREFETCH", "").strip().lower() in ("1", "true", "yes")
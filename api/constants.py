@@ -8,15 +8,109 @@ MIN_PAGE_SIZE = 1
 # OTP
 DEFAULT_OTP_TOP_EMAILS = 5
 DEFAULT_TIME_WINDOW_MINUTES = 30
+DEFAULT_OTP_WAIT_SECONDS = 60
+MAX_OTP_WAIT_SECONDS = 300
+OTP_WAIT_POLL_SECONDS = 5  # Poll interval for providers without IDLE (Graph)
+DEFAULT_OTP_MAX_BODY_BYTES = 64 * 1024  # Text bytes read per message section when scanning for a code
+MIN_MAX_BODY_BYTES = 1024
+
+# Folders: request alias -> (IMAP mailbox, Graph well-known folder name)
+MAIL_FOLDERS = {
+    "inbox": ("INBOX", "inbox"),
+    "junk": ("Junk", "junkemail"),
+}
+DEFAULT_FOLDERS = ("inbox",)
+MAX_FOLDERS = 5
 
 # OAuth
 STATE_TTL_SECONDS = 600  # 10 minutes
 TOKEN_CACHE_CLEANUP_INTERVAL = 300  # 5 minutes
 TOKEN_EXPIRY_BUFFER_SECONDS = 60  # Cleanup tokens 60s before expiry
+TOKEN_REFRESH_CHECK_SECONDS = 30  # Background refresher wake-up interval
+TOKEN_REFRESH_AHEAD_SECONDS = 300  # Renew access tokens this long before they expire
+TOKEN_REFRESH_ACTIVE_SECONDS = 1800  # ...but only for accounts used within this window
+TOKEN_CACHE_MAX_ENTRIES = 100_000  # Per-process token cache cap (LRU beyond it)
+TOKEN_ROTATED_MAX_ACCOUNTS = 10000  # Rotated refresh tokens kept (LRU)
+PROVIDER_MEMO_TTL_SECONDS = 7 * 24 * 3600  # How long a detected Graph/IMAP provider is trusted
+PROVIDER_RACE_GRAPH_GRACE_SECONDS = 1.0  # After IMAP wins a race, how long Graph may still take to win it
+
+# Shared token/state store
+STATE_STORE_REDIS_PREFIX = "hotmail:"
+STATE_STORE_REDIS_TIMEOUT_SECONDS = 5.0  # Connect and reply timeout of one Redis command
+STATE_STORE_SWEEP_EVERY = 256  # Writes between purges of expired entries
+STATE_STORE_MAX_ENTRIES = 200_000  # memory:// backend cap (LRU beyond it)
+REFRESH_TOKEN_STORE_TTL_SECONDS = 90 * 24 * 3600  # Microsoft refresh tokens live up to 90 days
+
+# Shared HTTP client (identity platform, Graph)
+HTTP_TIMEOUT_SECONDS = 30
+HTTP_CONNECT_TIMEOUT_SECONDS = 10
+HTTP_POOL_TIMEOUT_SECONDS = 10  # Wait for a free connection before failing
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+HTTP_KEEPALIVE_EXPIRY_SECONDS = 120
+
+# Graph JSON batching
+GRAPH_BATCH_MAX_REQUESTS = 20  # Graph's limit of sub-requests per /$batch
+GRAPH_BATCH_MAX_ATTEMPTS = 3  # Tries for throttled sub-requests
+GRAPH_RETRY_AFTER_DEFAULT_SECONDS = 1.0  # When a throttled response has no Retry-After
+GRAPH_RETRY_AFTER_MAX_SECONDS = 10.0
+
+# Graph delta sync (messages/delta per folder)
+GRAPH_DELTA_WINDOW_DAYS = 3  # A folder's first delta query reads messages received this recently
+GRAPH_DELTA_MAX_MESSAGES = 1000  # Newest messages kept per synced folder
+GRAPH_DELTA_PAGE_SIZE = 50  # odata.maxpagesize of delta pages
+GRAPH_DELTA_MAX_PAGES = 2  # Delta pages followed per sync; the next call goes on from the nextLink
+GRAPH_DELTA_MIN_INTERVAL_SECONDS = 1.0  # Calls within this of the last sync reuse it
+GRAPH_SYNC_MAX_MAILBOXES = 1000  # Folder states kept in memory (LRU)
+
+# Graph change notifications (subscriptions on each account's inbox)
+GRAPH_SUBSCRIPTION_LIFETIME_MINUTES = 4200  # Well under the lifetime Graph allows message subscriptions
+GRAPH_SUBSCRIPTION_RENEW_AHEAD_SECONDS = 12 * 3600
+GRAPH_SUBSCRIPTION_CHECK_SECONDS = 300  # Background renewer wake-up interval
+GRAPH_SUBSCRIPTION_RETRY_SECONDS = 300  # After a failed subscribe, keep polling this long before trying again
+GRAPH_PUSH_MAX_STALE_SECONDS = 300  # Subscribed folders are still re-synced this often, in case a notification was lost
+GRAPH_PUSH_QUEUE_MAX = 10000  # Notifications waiting for the worker; beyond this they are dropped
+
+# Graph request scheduler (token buckets, adaptive concurrency, retries)
+GRAPH_APP_RATE_PER_SECOND = 200.0  # Requests the whole app starts per second
+GRAPH_APP_BURST = 400
+GRAPH_MAILBOX_RATE_PER_SECOND = 16.0  # Graph allows 10,000 requests per 10 minutes per mailbox
+GRAPH_MAILBOX_BURST = 40
+GRAPH_MAILBOX_CONCURRENCY = 4  # Graph's limit of concurrent requests per mailbox
+GRAPH_CONCURRENCY_MAX = 64  # Ceiling of the adaptive app-wide concurrency limit
+GRAPH_CONCURRENCY_MIN = 2
+GRAPH_CONCURRENCY_DECREASE_INTERVAL_SECONDS = 1.0  # Throttles within this cut the limit only once
+GRAPH_REQUEST_MAX_ATTEMPTS = 4  # Tries per request on 429/503/504 and connection errors
+GRAPH_BACKOFF_BASE_SECONDS = 0.5  # Without Retry-After: full-jitter backoff from base * 2**attempt
+GRAPH_RETRY_JITTER_SECONDS = 0.5  # Spread of requests resuming after a Retry-After pause
+GRAPH_SCHEDULER_MAX_MAILBOXES = 10000  # Idle per-mailbox states kept (LRU)
 
 # IMAP
 OUTLOOK_IMAP_HOST = "outlook.office365.com"
 OUTLOOK_IMAP_PORT = 993
+IMAP_POOL_MAX_IDLE_SECONDS = 300  # Drop pooled connections unused for 5 minutes
+IMAP_POOL_MAX_PER_ACCOUNT = 3
+IMAP_POOL_NOOP_AFTER_SECONDS = 5  # Skip the NOOP health check for connections used very recently
+IMAP_COMMAND_TIMEOUT_SECONDS = 30
+IMAP_SYNC_MAX_MAILBOXES = 1000  # Sync states kept in memory (LRU)
+IMAP_FULL_SYNC_MAX_MESSAGES = 5000  # Larger mailboxes are paged by UID windows instead of mirrored
+IMAP_SEARCH_WINDOW_MIN = 100  # First UID window size when paging with UID range searches
+IMAP_IDLE_HEARTBEAT_SECONDS = 15  # Re-issue IDLE (and let SSE clients see a keepalive) this often
+
+# Predictive prefetch of the next page and the newest bodies (PREFETCH=1)
+PREFETCH_TOP_BODIES = 3  # Bodies prefetched from the top of a header-only page
+PREFETCH_PAGE_TTL_SECONDS = 30  # A prefetched page unread this long is dropped
+PREFETCH_BODY_TTL_SECONDS = 120
+PREFETCH_MAX_ACCOUNTS = 32  # Accounts prefetched at the same time
+PREFETCH_MAX_ENTRIES = 2000
+
+# On-disk mail mirror (MAIL_STORE_DIR)
+MAIL_STORE_MAX_BYTES = 512 * 1024 * 1024  # Blob bytes kept before least-recently-read entries are evicted
+MAIL_STORE_EVICT_TO = 0.9  # Eviction frees down to this fraction of the budget
+
+# Parsed-message cache (text, html, OTP per message)
+PARSE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+PARSE_CACHE_ENTRY_OVERHEAD = 256  # Bytes charged per entry on top of its strings
 
 # Error messages
 ERROR_GENERIC = "An error occurred"
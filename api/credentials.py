@@ -58,6 +58,11 @@ def parse_cred_string(cred_string: str) -> Credentials:
     return Credentials(email=email, password=password, refresh_token=refresh_token, client_id=client_id)
 
 
+def format_cred_string(creds: Credentials) -> str:
+    """Inverse of parse_cred_string, in the standard email|password|refresh|client layout."""
+    return "|".join([creds.email, creds.password or "", creds.refresh_token or "", creds.client_id or ""])
+
+
 def select_provider(creds: Credentials) -> str:
     """
     Determine which provider to use based on credentials.
@@ -0,0 +1,202 @@
+"""
+Mail folders: request aliases, concurrent scans across folders and merged paging.
+
+A request names folders by alias ("inbox", "junk"); anything else is passed
+through as the IMAP mailbox / Graph folder id. Each folder is scanned on its
+own (one selected IMAP session or one Graph query per folder) and the results
+are combined here.
+"""
+from __future__ import annotations
+
+import asyncio
+import base64
+import json
+from contextlib import aclosing
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, TypeVar
+
+from .constants import DEFAULT_FOLDERS, MAIL_FOLDERS, MAX_FOLDERS
+
+T = TypeVar("T")
+
+_EPOCH = datetime.min.replace(tzinfo=timezone.utc)
+
+
+def normalize_folders(folders: Optional[Sequence[str]]) -> List[str]:
+    """Known aliases lowercased, duplicates dropped, order kept; defaults to INBOX only."""
+    out: List[str] = []
+    for name in folders or DEFAULT_FOLDERS:
+        name = name.strip()
+        if name.lower() in MAIL_FOLDERS:
+            name = name.lower()
+        if name and name not in out:
+            out.append(name)
+    if not out:
+        return list(DEFAULT_FOLDERS)
+    if len(out) > MAX_FOLDERS:
+        raise ValueError(f"At most {MAX_FOLDERS} folders per request")
+    return out
+
+
+def imap_mailbox(folder: Optional[str]) -> str:
+    if not folder:
+        return MAIL_FOLDERS[DEFAULT_FOLDERS[0]][0]
+    return MAIL_FOLDERS[folder.lower()][0] if folder.lower() in MAIL_FOLDERS else folder
+
+
+def graph_folder(folder: Optional[str]) -> str:
+    if not folder:
+        return MAIL_FOLDERS[DEFAULT_FOLDERS[0]][1]
+    return MAIL_FOLDERS[folder.lower()][1] if folder.lower() in MAIL_FOLDERS else folder
+
+
+# ===== Page tokens =====
+# A multi-folder page token carries one cursor per folder that still has
+# messages; folders missing from it are exhausted. An empty cursor means
+# "from the newest message".
+
+def encode_page_token(cursors: Dict[str, str]) -> Optional[str]:
+    if not cursors:
+        return None
+    raw = json.dumps(cursors, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_page_token(token: Optional[str], folders: List[str]) -> Dict[str, str]:
+    """Cursors for `folders`; a missing or unreadable token starts every folder from the top."""
+    if not token:
+        return {folder: "" for folder in folders}
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        cursors = json.loads(raw)
+    except ValueError:
+        return {folder: "" for folder in folders}
+    if not isinstance(cursors, dict):
+        return {folder: "" for folder in folders}
+    return {folder: str(cursors[folder]) for folder in folders if folder in cursors}
+
+
+def merge_pages(
+    pages: Dict[str, Tuple[List[T], bool]], limit: int, key: Callable[[T], datetime]
+) -> Tuple[List[Tuple[str, T]], Dict[str, int], List[str]]:
+    """
+    Merge per-folder pages (newest first) into one page of at most `limit` rows.
+
+    `pages` maps folder -> (rows, more). Returns the merged (folder, row) list,
+    how many rows of each folder were used, and the folders that still have
+    rows after this page.
+    """
+    tagged = [(folder, row) for folder, (rows, _) in pages.items() for row in rows]
+    tagged.sort(key=lambda pair: key(pair[1]), reverse=True)
+    taken = tagged[:limit]
+    used = {folder: 0 for folder in pages}
+    for folder, _ in taken:
+        used[folder] += 1
+    remaining = [folder for folder, (rows, more) in pages.items() if more or used[folder] < len(rows)]
+    return taken, used, remaining
+
+
+def date_key(parse: Callable[[str], datetime]) -> Callable[[Optional[str]], datetime]:
+    """Sort key from a date parser; unparsable or naive dates sort as oldest / UTC."""
+
+    def key(value: Optional[str]) -> datetime:
+        if not value:
+            return _EPOCH
+        try:
+            dt = parse(value)
+        except (TypeError, ValueError):
+            return _EPOCH
+        return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+    return key
+
+
+# ===== Concurrent scans =====
+
+async def gather_folders(folders: Iterable[str], scan: Callable[[str], Awaitable[T]]) -> Dict[str, T]:
+    """Run `scan` for every folder concurrently; the first failure cancels the rest."""
+    names = list(folders)
+    tasks = [asyncio.ensure_future(scan(folder)) for folder in names]
+    try:
+        results = await asyncio.gather(*tasks)
+    finally:
+        await _cancel(tasks)
+    return dict(zip(names, results))
+
+
+async def first_found(folders: Iterable[str], scan: Callable[[str], Awaitable[Optional[T]]]) -> Optional[T]:
+    """
+    First non-None result among concurrent folder scans; the others are cancelled.
+
+    A folder that fails does not stop the others. When nothing is found, the
+    first failure is re-raised so a broken scan is not reported as "no result".
+    """
+    tasks = [asyncio.ensure_future(scan(folder)) for folder in folders]
+    error: Optional[BaseException] = None
+    try:
+        for done in asyncio.as_completed(tasks):
+            try:
+                result = await done
+            except Exception as e:
+                error = error or e
+                continue
+            if result is not None:
+                return result
+    finally:
+        await _cancel(tasks)
+    if error is not None:
+        raise error
+    return None
+
+
+_DONE = object()
+
+
+class _Failed:
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+async def merge_streams(streams: List[AsyncIterator[T]]) -> AsyncIterator[T]:
+    """
+    Interleave items from several async iterators as they arrive.
+
+    Ends when every stream has ended. Failed streams are dropped; if all of
+    them fail, the first failure is raised. Closing the merged iterator
+    (contextlib.aclosing) cancels and closes every stream.
+    """
+    queue: asyncio.Queue[Any] = asyncio.Queue()
+
+    async def pump(stream: AsyncIterator[T]) -> None:
+        try:
+            async with aclosing(stream) as items:
+                async for item in items:
+                    await queue.put(item)
+        except Exception as e:
+            queue.put_nowait(_Failed(e))
+        finally:
+            queue.put_nowait(_DONE)
+
+    tasks = [asyncio.ensure_future(pump(stream)) for stream in streams]
+    pending = len(tasks)
+    errors: List[BaseException] = []
+    try:
+        while pending:
+            item = await queue.get()
+            if item is _DONE:
+                pending -= 1
+            elif isinstance(item, _Failed):
+                errors.append(item.error)
+            else:
+                yield item
+    finally:
+        await _cancel(tasks)
+    if errors and len(errors) == len(tasks):
+        raise errors[0]
+
+
+async def _cancel(tasks: List["asyncio.Future[Any]"]) -> None:
+    for task in tasks:
+        task.cancel()
+    # Wait so pooled connections held by the scans are released before returning
+    await asyncio.gather(*tasks, return_exceptions=True)
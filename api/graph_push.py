@@ -0,0 +1,259 @@
+"""
+Graph change notifications: a subscription on each account's inbox, and the
+receiving end of the webhook (POST /graph/notifications).
+
+The webhook acknowledges notifications as soon as they are queued. A worker
+then checks each one's clientState against the subscription it names,
+marks that account's inbox changed (graph_sync), drops the pages prefetched
+for the account (prefetch) and wakes the requests waiting for its mail. While an account is subscribed, its inbox is only
+re-synced after such a notification, which takes the polling off Graph.
+
+Subscriptions are recorded in the shared state store, so a notification
+posted to any worker is recognised; waiters wake on the worker that holds them.
+"""
+from __future__ import annotations
+
+import asyncio
+import hmac
+import secrets
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from .constants import (
+    GRAPH_PUSH_QUEUE_MAX, GRAPH_SUBSCRIPTION_LIFETIME_MINUTES, GRAPH_SUBSCRIPTION_RENEW_AHEAD_SECONDS,
+    GRAPH_SUBSCRIPTION_RETRY_SECONDS
+)
+from .graph_sync import mark_graph_folder_changed, set_graph_push
+from .outlook_graph import graph_create_subscription, graph_delete_subscription, graph_renew_subscription
+from .prefetch import forget_prefetched
+from .state_store import StateStoreError, get_state_store
+from .ttl_cache import TTLCache
+
+FOLDER = "inbox"
+
+
+@dataclass
+class GraphSubscription:
+    id: str
+    email: str
+    client_state: str
+    expires_at: float  # epoch seconds
+    # What the renewer needs to get a token for the account
+    client_id: str = ""
+    refresh_token: str = ""
+
+
+@dataclass
+class GraphPushStats:
+    subscribed: int = 0
+    renewed: int = 0
+    failed: int = 0
+    received: int = 0
+    delivered: int = 0
+    rejected: int = 0  # Unknown subscription or wrong clientState
+    dropped: int = 0  # Queue full
+
+
+_SUBSCRIPTIONS: Dict[str, GraphSubscription] = {}  # account -> subscription this worker made
+_FAILED: TTLCache = TTLCache(10000)  # account -> error, while subscribing is not retried
+_INFLIGHT: Dict[str, "asyncio.Task[Optional[GraphSubscription]]"] = {}
+_WAITERS: Dict[str, List["asyncio.Future[None]"]] = {}
+_QUEUE: Optional["asyncio.Queue[Dict[str, Any]]"] = None
+_WORKER: Optional["asyncio.Task[None]"] = None
+_STATS = GraphPushStats()
+
+
+def _account(email_addr: str) -> str:
+    return (email_addr or "").strip().lower()
+
+
+def _expiry() -> datetime:
+    return datetime.now(timezone.utc) + timedelta(minutes=GRAPH_SUBSCRIPTION_LIFETIME_MINUTES)
+
+
+async def _record(sub: GraphSubscription) -> None:
+    _SUBSCRIPTIONS[_account(sub.email)] = sub
+    ttl = sub.expires_at - time.time()
+    await get_state_store().set("graph_subscription", sub.id, {"email": sub.email, "client_state": sub.client_state}, ttl)
+    await set_graph_push(sub.email, FOLDER, sub.expires_at)
+
+
+async def _forget(sub: GraphSubscription) -> None:
+    if _SUBSCRIPTIONS.get(_account(sub.email)) is sub:
+        _SUBSCRIPTIONS.pop(_account(sub.email), None)
+    await get_state_store().delete("graph_subscription", sub.id)
+    await set_graph_push(sub.email, FOLDER, None)
+
+
+async def _subscribe(
+    access_token: str, email_addr: str, notification_url: str, client_id: str, refresh_token: str
+) -> Optional[GraphSubscription]:
+    account = _account(email_addr)
+    current = _SUBSCRIPTIONS.get(account)
+    try:
+        if current is not None:
+            try:
+                expires = _expiry()
+                await graph_renew_subscription(access_token, current.id, expires)
+                current.expires_at = expires.timestamp()
+                await _record(current)
+                _STATS.renewed += 1
+                return current
+            except Exception:
+                await _forget(current)  # Gone on Graph's side: make a new one
+        client_state = secrets.token_urlsafe(32)
+        created = await graph_create_subscription(access_token, notification_url, client_state, _expiry())
+        expires_at = datetime.fromisoformat(created["expirationDateTime"].replace("Z", "+00:00")).timestamp()
+        sub = GraphSubscription(created["id"], email_addr, client_state, expires_at, client_id, refresh_token)
+        await _record(sub)
+        _STATS.subscribed += 1
+        return sub
+    except Exception as e:
+        _STATS.failed += 1
+        _FAILED.put(account, str(e)[:200], time.time() + GRAPH_SUBSCRIPTION_RETRY_SECONDS)
+        print(f"Graph subscription for {account} failed: {e}")
+        return None
+
+
+async def ensure_graph_subscription(
+    access_token: str, email_addr: str, notification_url: str, client_id: str = "", refresh_token: str = ""
+) -> Optional[GraphSubscription]:
+    """
+    The account's inbox subscription, created (or renewed when close to
+    expiry) on demand. None when Graph refused it; polling then goes on and
+    subscribing is retried after GRAPH_SUBSCRIPTION_RETRY_SECONDS.
+    """
+    account = _account(email_addr)
+    sub = _SUBSCRIPTIONS.get(account)
+    if sub is not None and sub.expires_at - time.time() > GRAPH_SUBSCRIPTION_RENEW_AHEAD_SECONDS:
+        return sub
+    if account in _FAILED:
+        return None
+    task = _INFLIGHT.get(account)
+    if task is None:
+        # Concurrent requests for the account share one subscribe
+        task = asyncio.create_task(_subscribe(access_token, email_addr, notification_url, client_id, refresh_token))
+        _INFLIGHT[account] = task
+        task.add_done_callback(lambda t: _INFLIGHT.pop(account, None) if _INFLIGHT.get(account) is t else None)
+    return await asyncio.shield(task)
+
+
+async def remove_graph_subscription(access_token: str, email_addr: str) -> bool:
+    sub = _SUBSCRIPTIONS.get(_account(email_addr))
+    if sub is None:
+        return False
+    try:
+        await graph_delete_subscription(access_token, sub.id)
+    finally:
+        await _forget(sub)
+    return True
+
+
+async def renew_due_subscriptions(
+    token_for: Callable[[GraphSubscription], Awaitable[str]], now: Optional[float] = None
+) -> int:
+    """Renew this worker's subscriptions that expire within GRAPH_SUBSCRIPTION_RENEW_AHEAD_SECONDS."""
+    now = time.time() if now is None else now
+    renewed = 0
+    for sub in list(_SUBSCRIPTIONS.values()):
+        if sub.expires_at - now > GRAPH_SUBSCRIPTION_RENEW_AHEAD_SECONDS:
+            continue
+        try:
+            token = await token_for(sub)
+            expires = _expiry()
+            await graph_renew_subscription(token, sub.id, expires)
+        except Exception as e:
+            print(f"Graph subscription renewal for {_account(sub.email)} failed: {e}")
+            await _forget(sub)
+            continue
+        sub.expires_at = expires.timestamp()
+        await _record(sub)
+        _STATS.renewed += 1
+        renewed += 1
+    return renewed
+
+
+# ===== Webhook side =====
+
+def accept_graph_notifications(payload: Dict[str, Any]) -> int:
+    """Queue the notifications of one webhook POST for the worker; returns how many were queued."""
+    global _QUEUE, _WORKER
+    loop = asyncio.get_running_loop()
+    if _WORKER is None or _WORKER.done() or _WORKER.get_loop() is not loop:
+        _QUEUE = asyncio.Queue(GRAPH_PUSH_QUEUE_MAX)
+        _WORKER = loop.create_task(_worker(_QUEUE))
+    queued = 0
+    for item in payload.get("value") or []:
+        if not isinstance(item, dict):
+            continue
+        _STATS.received += 1
+        try:
+            _QUEUE.put_nowait(item)
+            queued += 1
+        except asyncio.QueueFull:
+            # The folder is re-synced after GRAPH_PUSH_MAX_STALE_SECONDS anyway
+            _STATS.dropped += 1
+    return queued
+
+
+async def _worker(queue: "asyncio.Queue[Dict[str, Any]]") -> None:
+    while True:
+        item = await queue.get()
+        try:
+            await _deliver(item)
+        except Exception as e:
+            print(f"Graph notification not processed: {e}")
+        finally:
+            queue.task_done()
+
+
+async def _deliver(item: Dict[str, Any]) -> None:
+    try:
+        known = await get_state_store().get("graph_subscription", str(item.get("subscriptionId") or ""))
+    except StateStoreError:
+        known = None
+    if known is None or not hmac.compare_digest(str(item.get("clientState") or ""), known["client_state"]):
+        _STATS.rejected += 1
+        return
+    await mark_graph_folder_changed(known["email"], FOLDER)
+    # A page prefetched before this change may miss the new mail
+    forget_prefetched(_account(known["email"]))
+    _STATS.delivered += 1
+    for waiter in _WAITERS.pop(_account(known["email"]), []):
+        if not waiter.done():
+            waiter.set_result(None)
+
+
+async def wait_for_graph_mail(email_addr: str, timeout: float) -> bool:
+    """Sleep up to `timeout` seconds; True when a notification for the account's inbox ended it early."""
+    waiter = asyncio.get_running_loop().create_future()
+    waiters = _WAITERS.setdefault(_account(email_addr), [])
+    waiters.append(waiter)
+    try:
+        await asyncio.wait_for(waiter, timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        if waiter in waiters:
+            waiters.remove(waiter)
+        if not waiters and _WAITERS.get(_account(email_addr)) is waiters:
+            _WAITERS.pop(_account(email_addr), None)
+
+
+async def close_graph_push() -> None:
+    global _WORKER, _QUEUE
+    worker, _WORKER, _QUEUE = _WORKER, None, None
+    if worker is not None and not worker.done():
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+
+
+def graph_push_stats() -> Dict[str, Any]:
+    data: Dict[str, Any] = asdict(_STATS)
+    data["subscriptions"] = len(_SUBSCRIPTIONS)
+    data["queued"] = _QUEUE.qsize() if _QUEUE is not None else 0
+    data["waiters"] = sum(len(w) for w in _WAITERS.values())
+    return data
@@ -0,0 +1,278 @@
+"""
+Scheduler in front of every Graph call.
+
+A request first takes a token from the app-wide bucket and from its
+mailbox's bucket, then a slot under two concurrency limits: Graph's
+GRAPH_MAILBOX_CONCURRENCY per mailbox, and an app-wide limit that adapts
+(additive increase per success, halved when Graph throttles). 429/503/504
+answers and connection errors are retried: after Retry-After, which also
+pauses the whole mailbox, or else with full-jitter exponential backoff. Under
+throttling, throughput bends instead of requests failing. A POST or PATCH
+that may have reached Graph (read timeout, gateway timeout) is not sent
+again: it could create a second subscription or apply a change twice.
+
+Mailboxes are told apart by access token: the Graph helpers only see the
+token, and a token belongs to one mailbox.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import random
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Mapping, Optional
+
+import httpx
+
+from .constants import (
+    GRAPH_APP_BURST, GRAPH_APP_RATE_PER_SECOND, GRAPH_BACKOFF_BASE_SECONDS, GRAPH_CONCURRENCY_DECREASE_INTERVAL_SECONDS,
+    GRAPH_CONCURRENCY_MAX, GRAPH_CONCURRENCY_MIN, GRAPH_MAILBOX_BURST, GRAPH_MAILBOX_CONCURRENCY,
+    GRAPH_MAILBOX_RATE_PER_SECOND, GRAPH_REQUEST_MAX_ATTEMPTS, GRAPH_RETRY_AFTER_MAX_SECONDS,
+    GRAPH_RETRY_JITTER_SECONDS, GRAPH_SCHEDULER_MAX_MAILBOXES
+)
+from .http_client import get_http_client
+
+RETRYABLE_STATUS = (429, 503, 504)
+# Methods that can be sent again after the first attempt may have reached Graph
+IDEMPOTENT_METHODS = ("GET", "HEAD", "DELETE")
+# Failures before the request went out, which any method can retry
+_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class TokenBucket:
+    """`rate` tokens a second, holding at most `burst`."""
+
+    def __init__(self, rate: float, burst: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._clock = clock
+        self._updated = clock()
+
+    def take(self) -> float:
+        """Reserve a token; returns the seconds until it is due (0 when one is at hand)."""
+        now = self._clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        # Reservations run the bucket negative, so waiters are spaced 1/rate apart
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class _Gate:
+    """Concurrency limit serving waiters in arrival order; `limit` may change at any time."""
+
+    def __init__(self, limit: float) -> None:
+        self.limit = limit
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> None:
+        if not self._waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.cancelled():
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+            else:
+                # Handed a slot and cancelled in the same step: pass it on
+                self.release()
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self.wake()
+
+    def wake(self) -> None:
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            self.in_flight += 1
+            waiter.set_result(None)
+
+
+@dataclass
+class _Mailbox:
+    bucket: TokenBucket
+    gate: _Gate
+    paused_until: float = 0.0  # time.monotonic() before which nothing is sent for this mailbox
+
+
+def retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """
+    Seconds from the Retry-After header of a response or of a $batch
+    sub-response, capped; None when absent or not a number of seconds.
+    """
+    value = next((v for k, v in headers.items() if k.lower() == "retry-after"), None)
+    try:
+        return max(0.0, min(float(value), GRAPH_RETRY_AFTER_MAX_SECONDS)) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _backoff(attempt: int) -> float:
+    """Full jitter: uniform between 0 and the exponential step, capped."""
+    return random.uniform(0, min(GRAPH_RETRY_AFTER_MAX_SECONDS, GRAPH_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+class GraphScheduler:
+    def __init__(self) -> None:
+        self.bucket = TokenBucket(GRAPH_APP_RATE_PER_SECOND, GRAPH_APP_BURST)
+        self.gate = _Gate(GRAPH_CONCURRENCY_MAX)
+        self._mailboxes: "OrderedDict[str, _Mailbox]" = OrderedDict()
+        self._last_decrease = 0.0
+        # Milliseconds spent waiting for admission, most recent last
+        self._queue_ms: Deque[float] = deque(maxlen=1024)
+        self.counters: Dict[str, int] = {
+            "requests": 0, "retries": 0, "throttled": 0, "transport_errors": 0, "gave_up": 0,
+        }
+
+    def _mailbox(self, access_token: str) -> _Mailbox:
+        key = hashlib.sha256(access_token.encode()).hexdigest()[:32]
+        mailbox = self._mailboxes.get(key)
+        if mailbox is None:
+            mailbox = self._mailboxes[key] = _Mailbox(
+                TokenBucket(GRAPH_MAILBOX_RATE_PER_SECOND, GRAPH_MAILBOX_BURST), _Gate(GRAPH_MAILBOX_CONCURRENCY)
+            )
+            if len(self._mailboxes) > GRAPH_SCHEDULER_MAX_MAILBOXES:
+                idle = [k for k, m in self._mailboxes.items() if not m.gate.in_flight and not m.gate.waiting]
+                for old in idle[:len(self._mailboxes) - GRAPH_SCHEDULER_MAX_MAILBOXES]:
+                    del self._mailboxes[old]
+        self._mailboxes.move_to_end(key)
+        return mailbox
+
+    async def _admit(self, mailbox: _Mailbox) -> None:
+        """Wait out the mailbox's pause and both buckets, then take a mailbox slot and an app slot."""
+        while True:
+            pause = mailbox.paused_until - time.monotonic()
+            if pause <= 0:
+                break
+            # Jitter, so a paused mailbox's requests do not all resume at the same instant
+            await asyncio.sleep(pause + random.uniform(0, GRAPH_RETRY_JITTER_SECONDS))
+        delay = max(self.bucket.take(), mailbox.bucket.take())
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # The mailbox slot first: a busy mailbox must not sit on app slots while it waits
+        await mailbox.gate.acquire()
+        try:
+            await self.gate.acquire()
+        except BaseException:
+            mailbox.gate.release()
+            raise
+
+    def _release(self, mailbox: _Mailbox) -> None:
+        self.gate.release()
+        mailbox.gate.release()
+
+    def note_throttled(self, access_token: str, retry_after: Optional[float]) -> None:
+        """Graph throttled a request for this token (also a $batch sub-request): pause it, narrow the app limit."""
+        self._throttled(self._mailbox(access_token), retry_after)
+
+    def _throttled(self, mailbox: _Mailbox, retry_after: Optional[float]) -> None:
+        self.counters["throttled"] += 1
+        now = time.monotonic()
+        if retry_after:
+            mailbox.paused_until = max(mailbox.paused_until, now + retry_after)
+        # Multiplicative decrease, once per interval: one throttled burst is one signal
+        if now - self._last_decrease >= GRAPH_CONCURRENCY_DECREASE_INTERVAL_SECONDS:
+            self._last_decrease = now
+            self.gate.limit = max(GRAPH_CONCURRENCY_MIN, self.gate.limit / 2)
+
+    def _succeeded(self) -> None:
+        # Additive increase: about one more slot per `limit` successes
+        if self.gate.limit < GRAPH_CONCURRENCY_MAX:
+            self.gate.limit = min(GRAPH_CONCURRENCY_MAX, self.gate.limit + 1 / self.gate.limit)
+            self.gate.wake()
+
+    async def request(self, method: str, url: str, access_token: str, **kwargs: Any) -> httpx.Response:
+        """
+        Send a Graph request through the shared client once admitted, retrying
+        throttled answers and connection errors (only those raised before
+        sending, unless the method is idempotent). After the last attempt the
+        throttled response is returned as is, or the connection error raised.
+        """
+        mailbox = self._mailbox(access_token)
+        self.counters["requests"] += 1
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            queued = time.monotonic()
+            await self._admit(mailbox)
+            self._queue_ms.append((time.monotonic() - queued) * 1000)
+            try:
+                resp = await get_http_client().request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                self.counters["transport_errors"] += 1
+                if attempt + 1 >= GRAPH_REQUEST_MAX_ATTEMPTS or not (idempotent or isinstance(e, _NOT_SENT_ERRORS)):
+                    self.counters["gave_up"] += 1
+                    raise
+                delay = _backoff(attempt)
+            else:
+                if resp.status_code not in RETRYABLE_STATUS:
+                    self._succeeded()
+                    return resp
+                if resp.status_code == 504 and not idempotent:
+                    # Graph may have carried it out behind the gateway
+                    return resp
+                wait = retry_after(resp.headers)
+                self._throttled(mailbox, wait)
+                if attempt + 1 >= GRAPH_REQUEST_MAX_ATTEMPTS:
+                    self.counters["gave_up"] += 1
+                    return resp
+                # With Retry-After the mailbox pause does the waiting in _admit
+                delay = 0.0 if wait is not None else _backoff(attempt)
+            finally:
+                self._release(mailbox)
+            self.counters["retries"] += 1
+            attempt += 1
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        samples = sorted(self._queue_ms)
+
+        def percentile(p: float) -> float:
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))], 2) if samples else 0.0
+
+        return {
+            **self.counters,
+            "concurrency_limit": round(self.gate.limit, 2),
+            "in_flight": self.gate.in_flight,
+            "waiting": self.gate.waiting,
+            "mailboxes": len(self._mailboxes),
+            "paused_mailboxes": sum(1 for m in self._mailboxes.values() if m.paused_until > time.monotonic()),
+            "queue_ms_p50": percentile(0.5),
+            "queue_ms_p95": percentile(0.95),
+            "queue_ms_max": round(samples[-1], 2) if samples else 0.0,
+        }
+
+
+_SCHEDULER: Optional[GraphScheduler] = None
+
+
+def get_graph_scheduler() -> GraphScheduler:
+    global _SCHEDULER
+    if _SCHEDULER is None:
+        _SCHEDULER = GraphScheduler()
+    return _SCHEDULER
+
+
+async def graph_request(method: str, url: str, access_token: str, **kwargs: Any) -> httpx.Response:
+    """GraphScheduler.request on the application's scheduler."""
+    return await get_graph_scheduler().request(method, url, access_token, **kwargs)
+
+
+def graph_scheduler_stats() -> Dict[str, Any]:
+    return get_graph_scheduler().stats()
@@ -0,0 +1,276 @@
+"""
+Incremental per-folder Graph sync through delta queries (messages/delta).
+
+A folder is read once with a delta query limited to the last
+GRAPH_DELTA_WINDOW_DAYS; afterwards only its deltaLink is followed, so a poll
+transfers the messages that arrived, changed or left since the previous one.
+The listing is served from the state kept here (newest first), the Graph
+counterpart of imap_sync. An expired delta token starts the folder over.
+
+A sync follows at most GRAPH_DELTA_MAX_PAGES pages and keeps the nextLink;
+the next call goes on from there. The first read comes newest first, so a
+partly read folder still holds its newest messages, down to its `floor`.
+Below the floor the state is not complete (a message moved in from long ago
+is kept, but not the ones around it): listings continue from Graph there.
+
+The state is header-only (bodyPreview). Callers that need bodies fetch them
+through $batch and keep them in the state (fill_bodies).
+
+A folder covered by a change-notification subscription (graph_push) is not
+re-synced on every call: only once a notification has marked it changed, or
+after GRAPH_PUSH_MAX_STALE_SECONDS in case one was lost. Both marks live in
+the shared state store, so they hold for every worker.
+"""
+from __future__ import annotations
+
+import asyncio
+import bisect
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from .constants import (
+    GRAPH_DELTA_MAX_MESSAGES, GRAPH_DELTA_MAX_PAGES, GRAPH_DELTA_MIN_INTERVAL_SECONDS, GRAPH_DELTA_PAGE_SIZE,
+    GRAPH_DELTA_WINDOW_DAYS, GRAPH_PUSH_MAX_STALE_SECONDS, GRAPH_SYNC_MAX_MAILBOXES
+)
+from .outlook_graph import GraphSyncReset, _graph_datetime, _parse_graph_message_to_email_message, graph_delta_messages
+from .state_store import StateStoreError, get_state_store
+
+# Sort key of a message: (receivedDateTime as ISO-8601 UTC, id); ISO strings sort by time
+OrderKey = Tuple[str, str]
+
+
+def _address(from_header: str) -> str:
+    """Address part of a converted "Name <addr>" header."""
+    start, end = from_header.rfind("<"), from_header.rfind(">")
+    return (from_header[start + 1:end] if 0 <= start < end else from_header).strip().lower()
+
+
+@dataclass
+class GraphFolderState:
+    delta_link: str  # deltaLink of the next round, or the nextLink to go on from when not `complete`
+    window_start: str = ""  # receivedDateTime the first read starts from
+    messages: Dict[str, Dict[str, Any]] = field(default_factory=dict)  # id -> converted message
+    order: List[OrderKey] = field(default_factory=list)  # ascending
+    # Every message of the folder from here up is in the state
+    floor: OrderKey = ("", "")
+    complete: bool = True  # False while the current round has pages left
+    first_read: bool = True  # The first read (newest first) is not finished
+    synced_at: float = 0.0
+    sync_started: float = 0.0  # Changes notified after this may not be in the state yet
+
+    def apply(self, items: List[Dict[str, Any]]) -> Tuple[int, int]:
+        """Apply raw delta items; returns (added or changed, removed)."""
+        changed = removed = 0
+        for item in items:
+            message_id = item.get("id")
+            if not message_id:
+                continue
+            if "@removed" in item:
+                removed += self._remove(message_id)
+                continue
+            old = self.messages.get(message_id)
+            received = item.get("receivedDateTime") or (old or {}).get("received", "")
+            self._remove(message_id)
+            message = _parse_graph_message_to_email_message(item)
+            message["received"] = received
+            if old is not None and "body" not in item:
+                # A header-only change (read flag, category...): the body fetched earlier still holds
+                message["body_text"], message["body_html"] = old["body_text"], old["body_html"]
+            self.messages[message_id] = message
+            bisect.insort(self.order, (message["received"], message_id))
+            changed += 1
+        # Keep the newest messages only
+        overflow = len(self.order) - GRAPH_DELTA_MAX_MESSAGES
+        if overflow > 0:
+            for _, message_id in self.order[:overflow]:
+                self.messages.pop(message_id, None)
+            del self.order[:overflow]
+            self.floor = max(self.floor, self.order[0])
+        return changed, removed
+
+    def advance(self, delta_link: str, complete: bool) -> None:
+        """Record where the sync stopped, and how far down the state is whole."""
+        self.delta_link = delta_link
+        self.complete = complete
+        if self.first_read:
+            if complete:
+                self.first_read = False
+                # The whole window, unless the oldest messages were dropped to stay within GRAPH_DELTA_MAX_MESSAGES
+                full = len(self.order) >= GRAPH_DELTA_MAX_MESSAGES
+                self.floor = self.order[0] if full else (self.window_start, "")
+            else:
+                # Pages so far came newest first: the oldest message read is the floor
+                self.floor = self.order[0] if self.order else (self.window_start, "")
+
+    def fill_bodies(self, details: Dict[str, Dict[str, Any]]) -> None:
+        """Keep bodies fetched for messages of the state (converted details, by id)."""
+        for message_id, detail in details.items():
+            message = self.messages.get(message_id)
+            if message is not None:
+                message["body_text"] = detail.get("body_text") or ""
+                message["body_html"] = detail.get("body_html") or ""
+
+    def _remove(self, message_id: str) -> int:
+        old = self.messages.pop(message_id, None)
+        if old is None:
+            return 0
+        key = (old["received"], message_id)
+        i = bisect.bisect_left(self.order, key)
+        if i < len(self.order) and self.order[i] == key:
+            del self.order[i]
+        return 1
+
+    def page(
+        self, limit: int, before: Optional[OrderKey] = None, from_filter: Optional[str] = None,
+        since: Optional[datetime] = None
+    ) -> Tuple[List[Dict[str, Any]], bool]:
+        """
+        Newest-first messages older than `before` (and received at or after
+        `since`), down to the floor, and whether more remain in the view.
+        """
+        end = bisect.bisect_left(self.order, before) if before else len(self.order)
+        lowest = max(self.floor, (_graph_datetime(since), "")) if since is not None else self.floor
+        start = bisect.bisect_left(self.order, lowest)
+        wanted = (from_filter or "").strip().lower()
+        out: List[Dict[str, Any]] = []
+        i = end - 1
+        while i >= start and len(out) < limit:
+            message = self.messages[self.order[i][1]]
+            if not wanted or _address(message.get("from", "")) == wanted:
+                out.append(message)
+            i -= 1
+        if not wanted:
+            return out, i >= start
+        return out, any(_address(self.messages[k[1]].get("from", "")) == wanted for k in self.order[start:i + 1])
+
+
+@dataclass
+class GraphSyncStats:
+    full_syncs: int = 0
+    delta_syncs: int = 0
+    resets: int = 0
+    reused: int = 0  # Calls answered from a state synced moments ago
+    push_reused: int = 0  # ...or from a pushed folder with no change notified since its sync
+    changed: int = 0
+    removed: int = 0
+    partial: int = 0  # Syncs that stopped at GRAPH_DELTA_MAX_PAGES, to go on at the next call
+
+
+_STATES: "OrderedDict[Tuple[str, str], GraphFolderState]" = OrderedDict()
+_LOCKS: Dict[Tuple[str, str], asyncio.Lock] = {}
+_STATS = GraphSyncStats()
+
+
+def _key(email_addr: str, folder: str) -> Tuple[str, str]:
+    return (email_addr or "").strip().lower(), folder or "inbox"
+
+
+def get_graph_sync_state(email_addr: str, folder: str = "inbox") -> Optional[GraphFolderState]:
+    return _STATES.get(_key(email_addr, folder))
+
+
+def forget_graph_sync_state(email_addr: str, folder: Optional[str] = None) -> None:
+    account = _key(email_addr, "")[0]
+    for key in list(_STATES):
+        if key[0] == account and (folder is None or key[1] == folder):
+            _STATES.pop(key, None)
+            _LOCKS.pop(key, None)
+
+
+def graph_sync_stats() -> Dict[str, Any]:
+    data: Dict[str, Any] = asdict(_STATS)
+    data["folders"] = len(_STATES)
+    return data
+
+
+def _push_key(key: Tuple[str, str]) -> str:
+    return f"{key[0]}|{key[1]}"
+
+
+async def set_graph_push(email_addr: str, folder: str, until: Optional[float]) -> None:
+    """Mark the folder as covered by a subscription until `until` (epoch seconds); None ends it."""
+    key = _push_key(_key(email_addr, folder))
+    store = get_state_store()
+    if until is None:
+        await store.delete("graph_push", key)
+    elif until > time.time():
+        await store.set("graph_push", key, {"until": until}, until - time.time())
+
+
+async def mark_graph_folder_changed(email_addr: str, folder: str = "inbox") -> None:
+    """A notification reported a change: the next call re-syncs the folder."""
+    await get_state_store().set(
+        "graph_changed", _push_key(_key(email_addr, folder)), {"at": time.time()}, 2 * GRAPH_PUSH_MAX_STALE_SECONDS
+    )
+
+
+async def _push_covers(key: Tuple[str, str], state: GraphFolderState) -> bool:
+    """True while the folder is subscribed and nothing was notified since `state` was synced."""
+    store = get_state_store()
+    try:
+        pushed = await store.get("graph_push", _push_key(key))
+        if not pushed or pushed.get("until", 0) <= time.time():
+            return False
+        changed = await store.get("graph_changed", _push_key(key))
+    except StateStoreError:
+        return False
+    return not changed or changed.get("at", 0) < state.sync_started
+
+
+def _store(key: Tuple[str, str], state: GraphFolderState) -> GraphFolderState:
+    _STATES[key] = state
+    _STATES.move_to_end(key)
+    while len(_STATES) > GRAPH_SYNC_MAX_MAILBOXES:
+        old, _ = _STATES.popitem(last=False)
+        _LOCKS.pop(old, None)
+    return state
+
+
+async def sync_graph_folder(access_token: str, email_addr: str, folder: str = "inbox") -> GraphFolderState:
+    """Bring the folder's state up to date through its deltaLink (or a fresh delta query) and return it."""
+    key = _key(email_addr, folder)
+    lock = _LOCKS.setdefault(key, asyncio.Lock())
+    async with lock:
+        state = _STATES.get(key)
+        now = time.time()
+        if state is not None and now - state.synced_at < GRAPH_DELTA_MIN_INTERVAL_SECONDS:
+            # Callers that queued behind the sync that just finished share its result
+            _STATS.reused += 1
+            _STATES.move_to_end(key)
+            return state
+        if (
+            state is not None and state.complete and now - state.synced_at < GRAPH_PUSH_MAX_STALE_SECONDS
+            and await _push_covers(key, state)
+        ):
+            _STATS.push_reused += 1
+            _STATES.move_to_end(key)
+            return state
+        items: List[Dict[str, Any]] = []
+        if state is not None:
+            try:
+                items, delta_link, complete = await graph_delta_messages(
+                    access_token, folder, delta_link=state.delta_link, page_size=GRAPH_DELTA_PAGE_SIZE,
+                    max_pages=GRAPH_DELTA_MAX_PAGES
+                )
+                _STATS.delta_syncs += 1
+            except GraphSyncReset:
+                _STATS.resets += 1
+                state = None
+        if state is None:
+            since = _graph_datetime(datetime.now(timezone.utc) - timedelta(days=GRAPH_DELTA_WINDOW_DAYS))
+            items, delta_link, complete = await graph_delta_messages(
+                access_token, folder, since=since, page_size=GRAPH_DELTA_PAGE_SIZE, max_pages=GRAPH_DELTA_MAX_PAGES
+            )
+            _STATS.full_syncs += 1
+            state = GraphFolderState(delta_link=delta_link, window_start=since)
+        changed, removed = state.apply(items)
+        _STATS.changed += changed
+        _STATS.removed += removed
+        _STATS.partial += not complete
+        state.advance(delta_link, complete)
+        state.sync_started = now
+        state.synced_at = time.time()
+        return _store(key, state)
@@ -0,0 +1,61 @@
+"""
+Application-wide httpx client for the identity platform and Graph.
+
+One AsyncClient keeps TLS connections to login.microsoftonline.com and
+graph.microsoft.com alive between calls (one pool per host inside it) and,
+with the `h2` package installed, multiplexes concurrent requests over HTTP/2.
+The FastAPI lifespan opens it at startup and closes it at shutdown; code
+running outside the app gets one opened on first use.
+"""
+from __future__ import annotations
+
+from typing import Any, Dict, Optional
+
+import httpx
+
+from .constants import (
+    HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_KEEPALIVE_EXPIRY_SECONDS, HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS, HTTP_POOL_TIMEOUT_SECONDS, HTTP_TIMEOUT_SECONDS
+)
+
+try:
+    import h2  # noqa: F401  (httpx needs it for HTTP/2)
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+_CLIENT: Optional[httpx.AsyncClient] = None
+_CREATED = 0
+
+
+def new_http_client(transport: Optional[httpx.AsyncBaseTransport] = None) -> httpx.AsyncClient:
+    """A client with the app's pool limits and timeouts; `transport` is for tests (httpx.MockTransport)."""
+    return httpx.AsyncClient(
+        http2=_HTTP2,
+        transport=transport,
+        timeout=httpx.Timeout(HTTP_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS, pool=HTTP_POOL_TIMEOUT_SECONDS),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_SECONDS,
+        ),
+    )
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _CLIENT, _CREATED
+    if _CLIENT is None or _CLIENT.is_closed:
+        _CLIENT = new_http_client()
+        _CREATED += 1
+    return _CLIENT
+
+
+async def close_http_client() -> None:
+    global _CLIENT
+    client, _CLIENT = _CLIENT, None
+    if client is not None:
+        await client.aclose()
+
+
+def http_client_stats() -> Dict[str, Any]:
+    return {"http2": _HTTP2, "open": _CLIENT is not None and not _CLIENT.is_closed, "clients_created": _CREATED}
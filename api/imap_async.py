@@ -0,0 +1,967 @@
+"""
+Asyncio-native IMAP client for Outlook (XOAUTH2, SELECT, UID SEARCH, UID FETCH).
+
+Serves the IMAP side of the FastAPI endpoints without blocking the event
+loop while a mailbox is being read.
+Headers and bodies are memoryview slices of the FETCH reply buffer; parse
+them with imap_parse.message_from_buffer.
+"""
+from __future__ import annotations
+
+import asyncio
+import base64
+import json
+import re
+import ssl as ssl_module
+import uuid
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from . import outlook_imap
+from .constants import (
+    IMAP_COMMAND_TIMEOUT_SECONDS,
+    IMAP_FULL_SYNC_MAX_MESSAGES,
+    IMAP_IDLE_HEARTBEAT_SECONDS,
+    IMAP_SEARCH_WINDOW_MIN,
+)
+from .imap_parse import (
+    Buffer, BodyPart, Envelope, find_text_parts, iter_fetch, message_from_buffer, parse_envelope, parse_internaldate,
+    search_date
+)
+from .imap_pool import AsyncImapConnectionPool
+from .imap_sync import get_sync_state, sync_mailbox
+from .mail_store import KIND_BODY, KIND_ENVELOPE, StoredMailbox, body_kind, get_mail_store
+
+# Connection target; tests point these at a local fake server
+HOST = outlook_imap.HOST
+PORT = outlook_imap.PORT
+USE_SSL = True
+
+# Compiled regex patterns for performance
+_LITERAL_PATTERN = re.compile(rb"\{(\d+)\}\r\n$")
+_FETCH_PATTERN = re.compile(rb"\* \d+ FETCH ", re.IGNORECASE)
+_RESP_CODE_PATTERN = re.compile(rb"\[([A-Z\-]+)(?: ([^\]]*))?\]", re.IGNORECASE)
+_EXISTS_PATTERN = re.compile(rb"^\* (\d+) EXISTS", re.IGNORECASE)
+_EXPUNGE_PATTERN = re.compile(rb"^\* \d+ EXPUNGE", re.IGNORECASE)
+_ESEARCH_PAIR_PATTERN = re.compile(rb"\b(COUNT|MAX|MIN) (\d+)", re.IGNORECASE)
+_STATUS_ITEMS_PATTERN = re.compile(rb"\(([^()]*)\)\s*$")
+_VANISHED_PATTERN = re.compile(rb"^\* VANISHED (\(EARLIER\) )?([\d:,]+)", re.IGNORECASE)
+
+
+class ImapError(Exception):
+    """Tagged NO/BAD response or a protocol violation."""
+
+
+@dataclass
+class ImapResponse:
+    status: str
+    text: str
+    # Each untagged response as alternating [text, literal, text, ...] chunks
+    untagged: List[List[bytes]] = field(default_factory=list)
+
+
+def _quote(value: str) -> str:
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _uid_set(uids: List[int]) -> str:
+    return ",".join(str(u) for u in uids)
+
+
+def parse_uid_set(value: bytes) -> List[int]:
+    """Expand an IMAP sequence set such as b"41,43:45" (no "*") to a list of UIDs."""
+    uids: List[int] = []
+    for piece in value.split(b","):
+        lo, _, hi = piece.partition(b":")
+        if not lo.isdigit() or (hi and not hi.isdigit()):
+            continue
+        a, b = int(lo), int(hi or lo)
+        uids.extend(range(min(a, b), max(a, b) + 1))
+    return uids
+
+
+def search_uids(resp: ImapResponse) -> List[int]:
+    """UIDs from the * SEARCH responses of a UID SEARCH."""
+    uids: List[int] = []
+    for unit in resp.untagged:
+        head = unit[0]
+        if head.upper().startswith(b"* SEARCH"):
+            uids.extend(int(x) for x in head[8:].split() if x.isdigit())
+    return uids
+
+
+def fetched_items(buf: bytearray) -> Dict[int, Dict[str, Any]]:
+    """uid -> items of the FETCH responses in a reply buffer, merged per UID."""
+    result: Dict[int, Dict[str, Any]] = {}
+    for record in iter_fetch(buf):
+        if record.uid is not None:
+            result.setdefault(record.uid, {}).update(record.items)
+    return result
+
+
+class AsyncImapClient:
+    """Minimal IMAP4rev1 client on asyncio streams. One command at a time per client."""
+
+    def __init__(self, host: str, port: int, use_ssl: bool = True, timeout: float = IMAP_COMMAND_TIMEOUT_SECONDS) -> None:
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.capabilities: Set[str] = set()
+        self.exists: int = 0
+        self.uidvalidity: Optional[int] = None
+        self.uidnext: Optional[int] = None
+        self.highestmodseq: Optional[int] = None
+        self.qresync_enabled = False
+        # UIDs reported expunged through QRESYNC VANISHED, consumed by imap_sync
+        self.vanished: List[int] = []
+        self.selected: Optional[str] = None
+        self.account: Optional[str] = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._tag_counter = 0
+        self._busy = False
+
+    async def connect(self) -> None:
+        ctx = ssl_module.create_default_context() if self.use_ssl else None
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=ctx), self.timeout
+        )
+        greeting = await self._read_unit()
+        if not greeting[0].startswith(b"* OK"):
+            raise ImapError(f"Unexpected greeting: {greeting[0][:100]!r}")
+        self._handle_untagged(greeting)
+        if not self.capabilities:
+            await self.command("CAPABILITY")
+
+    # ----- wire level -----
+
+    async def _readline(self, timeout: Optional[float] = None) -> bytes:
+        assert self._reader is not None
+        line = await asyncio.wait_for(self._reader.readline(), timeout or self.timeout)
+        if not line:
+            raise ImapError("Connection closed by server")
+        return line
+
+    async def _read_unit(self, timeout: Optional[float] = None) -> List[bytes]:
+        """Read one server response, following {n} literals."""
+        assert self._reader is not None
+        parts: List[bytes] = []
+        line = await self._readline(timeout)
+        while True:
+            m = _LITERAL_PATTERN.search(line)
+            if not m:
+                parts.append(line.rstrip(b"\r\n"))
+                return parts
+            parts.append(line[: m.start()])
+            parts.append(await asyncio.wait_for(self._reader.readexactly(int(m.group(1))), self.timeout))
+            line = await self._readline()
+
+    async def _read_into(self, buf: bytearray) -> None:
+        """Append one server response to buf exactly as sent, literals inline."""
+        assert self._reader is not None
+        line = await self._readline()
+        while True:
+            buf += line
+            m = _LITERAL_PATTERN.search(line)
+            if not m:
+                return
+            buf += await asyncio.wait_for(self._reader.readexactly(int(m.group(1))), self.timeout)
+            line = await self._readline()
+
+    def _next_tag(self) -> str:
+        self._tag_counter += 1
+        return f"A{self._tag_counter:04d}"
+
+    def _handle_untagged(self, unit: List[bytes]) -> None:
+        head = unit[0]
+        m = _EXISTS_PATTERN.match(head)
+        if m:
+            self.exists = int(m.group(1))
+            return
+        if _EXPUNGE_PATTERN.match(head):
+            self.exists = max(0, self.exists - 1)
+            return
+        m = _VANISHED_PATTERN.match(head)
+        if m:
+            gone = parse_uid_set(m.group(2))
+            self.vanished.extend(gone)
+            if not m.group(1):
+                # Plain VANISHED replaces EXPUNGE once QRESYNC is enabled; EARLIER ones were counted already
+                self.exists = max(0, self.exists - len(gone))
+            return
+        upper = head.upper()
+        if upper.startswith(b"* CAPABILITY "):
+            self.capabilities = {c.decode().upper() for c in head.split()[2:]}
+            return
+        self._handle_codes(head)
+
+    def _handle_codes(self, head: bytes) -> None:
+        for code in _RESP_CODE_PATTERN.finditer(head):
+            name = code.group(1).upper()
+            value = code.group(2) or b""
+            if name == b"CAPABILITY":
+                self.capabilities = {c.decode().upper() for c in value.split()}
+            elif name == b"UIDVALIDITY" and value.isdigit():
+                self.uidvalidity = int(value)
+            elif name == b"UIDNEXT" and value.isdigit():
+                self.uidnext = int(value)
+            elif name == b"HIGHESTMODSEQ" and value.isdigit():
+                self.highestmodseq = int(value)
+            elif name == b"NOMODSEQ":
+                self.highestmodseq = None
+
+    async def command(
+        self, name: str, *args: str, continuation: Optional[bytes] = None, into: Optional[bytearray] = None
+    ) -> ImapResponse:
+        """
+        Send a tagged command and collect responses until its completion.
+        With `into`, FETCH responses are left verbatim in that buffer for
+        iter_fetch instead of being split into untagged units.
+        """
+        return (await self._exchange([(name, *args)], continuation, into))[0]
+
+    async def pipeline(self, *commands: Tuple[str, ...], into: Optional[bytearray] = None) -> List[ImapResponse]:
+        """
+        Send several tagged commands back to back, then collect all their
+        completions: one round trip instead of one per command. Untagged
+        responses are credited to the oldest command still running, which is
+        how servers answer pipelined commands. Commands must not need a
+        continuation (no AUTHENTICATE/IDLE).
+        """
+        return await self._exchange(list(commands), None, into)
+
+    async def _exchange(
+        self, commands: List[Tuple[str, ...]], continuation: Optional[bytes], into: Optional[bytearray]
+    ) -> List[ImapResponse]:
+        assert self._writer is not None
+        if self._busy:
+            raise ImapError("Client already has a command in flight")
+        self._busy = True
+        tags = [self._next_tag() for _ in commands]
+        self._writer.write(b"".join(
+            " ".join([tag, *command]).encode("utf-8") + b"\r\n" for tag, command in zip(tags, commands)
+        ))
+        await self._writer.drain()
+        prefixes = {tag.encode() + b" ": i for i, tag in enumerate(tags)}
+        untagged: List[List[List[bytes]]] = [[] for _ in commands]
+        responses: List[Optional[ImapResponse]] = [None] * len(commands)
+        current = 0  # oldest command without a completion
+        sent_continuation = False
+        while current < len(commands):
+            if into is None:
+                unit = await self._read_unit()
+            else:
+                start = len(into)
+                await self._read_into(into)
+                if _FETCH_PATTERN.match(into, start):
+                    continue
+                unit = [bytes(into[start:into.index(b"\r\n", start)])]
+                del into[start:]
+            head = unit[0]
+            if head.startswith(b"+"):
+                # First challenge gets the payload; a second one is an error report we must ack empty
+                payload = continuation if (continuation is not None and not sent_continuation) else b""
+                sent_continuation = True
+                self._writer.write(payload + b"\r\n")
+                await self._writer.drain()
+            elif head.startswith(b"* "):
+                self._handle_untagged(unit)
+                untagged[current].append(unit)
+            else:
+                prefix = head[: head.find(b" ") + 1]
+                index = prefixes.get(prefix)
+                if index is None:
+                    continue  # Stray tagged lines are ignored
+                self._handle_codes(head)
+                status, _, text = head[len(prefix):].partition(b" ")
+                responses[index] = ImapResponse(status.decode().upper(), text.decode(errors="ignore"), untagged[index])
+                while current < len(commands) and responses[current] is not None:
+                    current += 1
+        # Left set on errors: a half-read connection must not be reused or sent LOGOUT
+        self._busy = False
+        return [resp for resp in responses if resp is not None]
+
+    async def _ok(
+        self, name: str, *args: str, continuation: Optional[bytes] = None, into: Optional[bytearray] = None
+    ) -> ImapResponse:
+        resp = await self.command(name, *args, continuation=continuation, into=into)
+        if resp.status != "OK":
+            raise ImapError(f"{name} failed: {resp.status} {resp.text}")
+        return resp
+
+    # ----- commands -----
+
+    async def authenticate_xoauth2(self, email_addr: str, access_token: str) -> None:
+        payload = base64.b64encode(outlook_imap._xoauth2_auth_string(email_addr, access_token))
+        resp = await self.command("AUTHENTICATE", "XOAUTH2", continuation=payload)
+        if resp.status != "OK":
+            raise ImapError("XOAUTH2 auth failed")
+        self.account = email_addr
+        if "[CAPABILITY" not in resp.text.upper():
+            # Capabilities may change after authentication
+            await self.command("CAPABILITY")
+
+    async def enable_qresync(self) -> bool:
+        """ENABLE QRESYNC (implies CONDSTORE) when advertised. Must run before SELECT."""
+        if "QRESYNC" not in self.capabilities:
+            return False
+        resp = await self.command("ENABLE", "QRESYNC")
+        self.qresync_enabled = resp.status == "OK"
+        return self.qresync_enabled
+
+    async def select(self, mailbox: str = "INBOX") -> None:
+        self.exists, self.uidvalidity, self.uidnext, self.highestmodseq = 0, None, None, None
+        self.vanished = []
+        args = [_quote(mailbox)]
+        if "CONDSTORE" in self.capabilities and not self.qresync_enabled:
+            # Ask for HIGHESTMODSEQ; with QRESYNC enabled the server already tracks mod-sequences
+            args.append("(CONDSTORE)")
+        resp = await self.command("SELECT", *args)
+        if resp.status != "OK":
+            raise ImapError(f"Cannot select {mailbox}")
+        self.selected = mailbox
+
+    async def uid_vanished_since(self, modseq: int) -> List[int]:
+        """UIDs expunged since `modseq` (QRESYNC UID FETCH ... VANISHED). Also drains self.vanished."""
+        await self._ok("UID FETCH", "1:*", "(UID)", f"(CHANGEDSINCE {modseq} VANISHED)")
+        gone, self.vanished = self.vanished, []
+        return gone
+
+    async def noop(self) -> bool:
+        resp = await self.command("NOOP")
+        return resp.status == "OK"
+
+    async def idle(self, timeout: float) -> bool:
+        """
+        IDLE until the server announces new mail (EXISTS grows) or timeout.
+        Returns True when new mail arrived. Falls back to a NOOP after sleeping
+        when the server does not advertise IDLE.
+        """
+        assert self._writer is not None
+        before = self.exists
+        if "IDLE" not in self.capabilities:
+            await asyncio.sleep(timeout)
+            await self.noop()
+            return self.exists > before
+        if self._busy:
+            raise ImapError("Client already has a command in flight")
+        self._busy = True
+        tag = self._next_tag()
+        tag_prefix = tag.encode() + b" "
+        self._writer.write(f"{tag} IDLE\r\n".encode())
+        await self._writer.drain()
+        while True:
+            unit = await self._read_unit()
+            if unit[0].startswith(b"+"):
+                break
+            if unit[0].startswith(tag_prefix):
+                self._busy = False
+                raise ImapError(f"IDLE rejected: {unit[0][:100]!r}")
+            self._handle_untagged(unit)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        arrived = self.exists > before
+        while not arrived:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                unit = await self._read_unit(timeout=remaining)
+            except asyncio.TimeoutError:
+                break
+            if unit[0].startswith(b"* "):
+                self._handle_untagged(unit)
+                arrived = self.exists > before
+
+        self._writer.write(b"DONE\r\n")
+        await self._writer.drain()
+        while True:
+            unit = await self._read_unit()
+            if unit[0].startswith(tag_prefix):
+                self._busy = False
+                return arrived
+            if unit[0].startswith(b"* "):
+                self._handle_untagged(unit)
+                arrived = arrived or self.exists > before
+
+    async def uid_search(self, *criteria: str) -> List[int]:
+        return search_uids(await self._ok("UID SEARCH", *criteria))
+
+    async def uid_esearch(self, returns: str, *criteria: str) -> Dict[str, int]:
+        """
+        ESEARCH (RFC 4731): UID SEARCH RETURN (<returns>) ... answering only the
+        requested aggregates, e.g. {"COUNT": 12, "MAX": 130}. Absent keys mean no match.
+        """
+        resp = await self._ok("UID SEARCH", f"RETURN ({returns})", *criteria)
+        result: Dict[str, int] = {}
+        for unit in resp.untagged:
+            if unit[0].upper().startswith(b"* ESEARCH"):
+                for name, value in _ESEARCH_PAIR_PATTERN.findall(unit[0]):
+                    result[name.decode().upper()] = int(value)
+        return result
+
+    async def status(self, mailbox: str, items: str = "MESSAGES UIDNEXT") -> Dict[str, int]:
+        resp = await self._ok("STATUS", _quote(mailbox), f"({items})")
+        result: Dict[str, int] = {}
+        for unit in resp.untagged:
+            if not unit[0].upper().startswith(b"* STATUS"):
+                continue
+            m = _STATUS_ITEMS_PATTERN.search(unit[0])
+            tokens = m.group(1).split() if m else []
+            for name, value in zip(tokens[0::2], tokens[1::2]):
+                if value.isdigit():
+                    result[name.decode().upper()] = int(value)
+        return result
+
+    async def uid_fetch(self, uids: List[int], items: str) -> Dict[int, Dict[str, Any]]:
+        """
+        UID FETCH returning uid -> {item name: value}. Names are normalized
+        without .PEEK (BODY[1]<0>); literals are memoryview slices of the reply
+        buffer, lists are parsed (BODYSTRUCTURE), numbers are int.
+        """
+        if not uids:
+            return {}
+        return await self.uid_fetch_many([(_uid_set(uids), items)])
+
+    async def uid_fetch_many(self, requests: List[Tuple[str, str]]) -> Dict[int, Dict[str, Any]]:
+        """
+        Pipeline several UID FETCH (uid set, items) commands in one round trip
+        and merge the items per UID, as uid_fetch returns them.
+        """
+        if not requests:
+            return {}
+        buf = bytearray()
+        for resp in await self.pipeline(*(("UID FETCH", uid_set, items) for uid_set, items in requests), into=buf):
+            if resp.status != "OK":
+                raise ImapError(f"UID FETCH failed: {resp.status} {resp.text}")
+        return fetched_items(buf)
+
+    async def logout(self) -> None:
+        try:
+            if not self._busy and self._writer is not None:
+                await asyncio.wait_for(self.command("LOGOUT"), 5)
+        except Exception:
+            pass
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+# ===== Pool =====
+
+async def _open_selected(email_addr: str, access_token: str, mailbox: str) -> AsyncImapClient:
+    client = AsyncImapClient(HOST, PORT, use_ssl=USE_SSL)
+    try:
+        await client.connect()
+        await client.authenticate_xoauth2(email_addr, access_token)
+        await client.enable_qresync()
+        await client.select(mailbox)
+    except BaseException:
+        client.close()
+        raise
+    return client
+
+
+async def _noop(client: AsyncImapClient) -> bool:
+    return await client.noop()
+
+
+async def _logout(client: AsyncImapClient) -> None:
+    await client.logout()
+
+
+_POOL = AsyncImapConnectionPool(_open_selected, _noop, _logout)
+
+
+def imap_async_pool_stats() -> Dict[str, object]:
+    """Hit/miss and eviction counters of the asyncio IMAP connection pool."""
+    return _POOL.stats()
+
+
+async def close_imap_async_pool() -> None:
+    await _POOL.close_all()
+
+
+# ===== Mailbox operations =====
+
+def _search_criteria(from_filter: Optional[str], since: Optional[datetime] = None) -> List[str]:
+    criteria: List[str] = []
+    if since is not None:
+        # SINCE compares dates only, in the server's timezone: start a day early, callers cut by INTERNALDATE
+        criteria += ["SINCE", search_date(since - timedelta(days=1))]
+    if from_filter:
+        criteria += ["FROM", _quote(from_filter)]
+    return criteria or ["ALL"]
+
+
+def _page(uids: List[int], limit: int, last_uid: Optional[int]) -> Tuple[List[int], List[int]]:
+    uids = sorted(uids, reverse=True)
+    if last_uid:
+        uids = [u for u in uids if u < last_uid]
+    return uids, uids[: max(1, min(limit, 50))]
+
+
+_ENVELOPE_ITEMS = "UID ENVELOPE INTERNALDATE RFC822.SIZE FLAGS BODY.PEEK[HEADER.FIELDS (FROM)]"
+_FROM_FIELD = "BODY[HEADER.FIELDS (FROM)]"
+
+
+def _page_items(include_bodies: bool, max_body_bytes: Optional[int]) -> str:
+    """FETCH items for a listing page: ENVELOPE, plus whole bodies or what a capped fetch plans with."""
+    if not include_bodies:
+        return _ENVELOPE_ITEMS
+    if not max_body_bytes:
+        return _ENVELOPE_ITEMS + " BODY.PEEK[]"
+    return _ENVELOPE_ITEMS + " BODYSTRUCTURE"
+
+
+def _envelope(items: Dict[str, Any]) -> Envelope:
+    env = parse_envelope(items.get("ENVELOPE"))
+    internaldate = items.get("INTERNALDATE")
+    env.internaldate = bytes(internaldate).decode("ascii", errors="replace") if isinstance(internaldate, (bytes, memoryview)) else ""
+    env.size = items.get("RFC822.SIZE") if isinstance(items.get("RFC822.SIZE"), int) else 0
+    env.flags = tuple(str(f) for f in items.get("FLAGS") or ())
+    field = items.get(_FROM_FIELD)
+    if isinstance(field, (bytes, bytearray, memoryview)):
+        value = str(message_from_buffer(field).get("From", "") or "")
+        # 8-bit bytes come back as surrogates; the envelope is stored as JSON
+        env.from_header = value.encode("utf-8", "surrogateescape").decode("utf-8", "replace")
+    return env
+
+
+def _envelope_json(env: Envelope) -> bytes:
+    return json.dumps(asdict(env), ensure_ascii=False).encode()
+
+
+def _envelope_from_json(data: Buffer) -> Envelope:
+    fields = json.loads(bytes(data))
+    fields["from_"] = [tuple(a) for a in fields.get("from_") or ()]
+    fields["to"] = [tuple(a) for a in fields.get("to") or ()]
+    fields["flags"] = tuple(fields.get("flags") or ())
+    return Envelope(**fields)
+
+
+def _mirror(client: AsyncImapClient) -> Optional[StoredMailbox]:
+    """The on-disk mirror of the selected mailbox, when MAIL_STORE_DIR is set."""
+    store = get_mail_store()
+    if store is None or not client.account or not client.uidvalidity:
+        return None
+    return store.mailbox(client.account, client.selected or "INBOX", client.uidvalidity)
+
+
+async def _stored_bodies(mirror: StoredMailbox, uids: List[int], max_body_bytes: Optional[int]) -> Dict[int, Buffer]:
+    """Bodies already on disk; a whole message also serves a capped request."""
+    found: Dict[int, Buffer] = dict(await mirror.get_async(KIND_BODY, uids))
+    kind = body_kind(max_body_bytes)
+    if kind != KIND_BODY:
+        found.update(await mirror.get_async(kind, [uid for uid in uids if uid not in found]))
+    return found
+
+
+_CONTENT_HEADER_PATTERN = re.compile(rb"^(content-[a-z-]*|mime-version)\s*:", re.IGNORECASE)
+
+
+def _strip_content_headers(header: Buffer) -> bytes:
+    """Drop Content-* and MIME-Version fields (with their folded lines) from a raw header block."""
+    kept: List[bytes] = []
+    dropping = False
+    for line in bytes(header).split(b"\r\n"):
+        if not line:
+            break
+        if line[:1] in (b" ", b"\t"):
+            if not dropping:
+                kept.append(line)
+            continue
+        dropping = bool(_CONTENT_HEADER_PATTERN.match(line))
+        if not dropping:
+            kept.append(line)
+    return b"".join(line + b"\r\n" for line in kept)
+
+
+def _part_bytes(part: BodyPart, data: Buffer) -> bytes:
+    head = f"Content-Type: {part.content_type}"
+    if part.charset:
+        head += f'; charset="{part.charset}"'
+    head += f"\r\nContent-Transfer-Encoding: {part.encoding}\r\n\r\n"
+    return head.encode("utf-8") + data
+
+
+def _synthesize_message(header: Buffer, sections: List[Tuple[BodyPart, Buffer]]) -> bytes:
+    """
+    Rebuild a small MIME message from the original header and the fetched text
+    sections, so the MIME parser sees the same Subject/Date and text/html.
+    """
+    out = _strip_content_headers(header) + b"MIME-Version: 1.0\r\n"
+    if not sections:
+        return out + b"\r\n"
+    if len(sections) == 1:
+        return out + _part_bytes(*sections[0])
+    boundary = f"=_partial_{uuid.uuid4().hex}".encode()
+    out += b'Content-Type: multipart/alternative; boundary="' + boundary + b'"\r\n\r\n'
+    for part, data in sections:
+        out += b"--" + boundary + b"\r\n" + _part_bytes(part, data) + b"\r\n"
+    return out + b"--" + boundary + b"--\r\n"
+
+
+async def _fetch_bodies(client: AsyncImapClient, uids: List[int], max_body_bytes: Optional[int] = None) -> Dict[int, Buffer]:
+    """
+    uid -> raw message. With max_body_bytes, messages larger than the cap are not
+    downloaded whole: BODYSTRUCTURE picks the first text/plain and text/html
+    sections, only their first max_body_bytes are fetched (BODY.PEEK[n]<0.max>)
+    and a stand-in message is built from them and the original header.
+    Bodies already in the on-disk mirror are not fetched again.
+    """
+    mirror = _mirror(client)
+    if mirror is None:
+        return await _download_bodies(client, uids, max_body_bytes)
+    result = await _stored_bodies(mirror, uids, max_body_bytes)
+    missing = [uid for uid in uids if uid not in result]
+    if missing:
+        fetched = await _download_bodies(client, missing, max_body_bytes)
+        await mirror.put_async(body_kind(max_body_bytes), fetched)
+        result.update(fetched)
+    return result
+
+
+async def _download_bodies(client: AsyncImapClient, uids: List[int], max_body_bytes: Optional[int]) -> Dict[int, Buffer]:
+    if not max_body_bytes:
+        fetched = await client.uid_fetch(uids, "(UID BODY.PEEK[])")
+        return {uid: items["BODY[]"] for uid, items in fetched.items() if "BODY[]" in items}
+    planned = await client.uid_fetch(uids, "(UID RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER])")
+    return await _fetch_capped(client, uids, planned, max_body_bytes)
+
+
+async def _fetch_capped(
+    client: AsyncImapClient, uids: List[int], planned: Dict[int, Dict[str, Any]], max_body_bytes: int
+) -> Dict[int, Buffer]:
+    """
+    Second step of a capped fetch, from RFC822.SIZE, BODYSTRUCTURE and (when
+    fetched) the header of each message: whole small messages and capped text
+    sections are fetched in one pipelined round trip.
+    """
+    result: Dict[int, Buffer] = {}
+    whole: List[int] = []
+    wanted: Dict[int, List[BodyPart]] = {}
+    headers: Dict[int, Buffer] = {}
+    # Messages needing the same section list share one UID FETCH
+    groups: Dict[str, List[int]] = {}
+    for uid in uids:
+        items = planned.get(uid, {})
+        # ENVELOPE listings plan without a header; their stand-ins only carry the text
+        header = items.get("BODY[HEADER]", b"")
+        size = items.get("RFC822.SIZE")
+        if not isinstance(items.get("BODYSTRUCTURE"), list) or (isinstance(size, int) and size <= max_body_bytes):
+            # Small enough to take whole, or the server gave us nothing to plan with
+            whole.append(uid)
+            continue
+        parts = [part for part in find_text_parts(items["BODYSTRUCTURE"]) if part is not None]
+        if not parts:
+            result[uid] = _synthesize_message(header, [])
+            continue
+        headers[uid] = header
+        wanted[uid] = parts
+        spec = " ".join(f"BODY.PEEK[{part.section}]<0.{max_body_bytes}>" for part in parts)
+        groups.setdefault(spec, []).append(uid)
+
+    requests = [(_uid_set(group), f"(UID {spec})") for spec, group in groups.items()]
+    if whole:
+        requests.append((_uid_set(whole), "(UID BODY.PEEK[])"))
+    fetched = await client.uid_fetch_many(requests)
+    for uid in whole:
+        if "BODY[]" in fetched.get(uid, {}):
+            result[uid] = fetched[uid]["BODY[]"]
+    for uid, parts in wanted.items():
+        items = fetched.get(uid, {})
+        sections: List[Tuple[BodyPart, Buffer]] = []
+        for part in parts:
+            data = items.get(f"BODY[{part.section}]<0>", items.get(f"BODY[{part.section}]"))
+            if isinstance(data, (bytes, memoryview)):
+                sections.append((part, data))
+        result[uid] = _synthesize_message(headers[uid], sections)
+    return result
+
+
+async def _window_search(
+    client: AsyncImapClient, criteria: List[str], below: int, want: int
+) -> Tuple[List[int], bool]:
+    """
+    Newest-first matching UIDs strictly below `below`, at most `want`, plus
+    whether more remain. Searches descending UID windows that grow 4x each
+    step, so the cost of a page depends on the page, not on the mailbox size.
+    """
+    found: List[int] = []
+    hi = below - 1
+    span = max(want * 2, IMAP_SEARCH_WINDOW_MIN)
+    while hi >= 1 and len(found) <= want:
+        lo = max(1, hi - span + 1)
+        batch = await client.uid_search("UID", f"{lo}:{hi}", *criteria)
+        found.extend(sorted((u for u in batch if lo <= u <= hi), reverse=True))
+        hi = lo - 1
+        span *= 4
+    return found[:want], len(found) > want
+
+
+async def _list_uids(
+    client: AsyncImapClient, email_addr: str, from_filter: Optional[str], limit: int, last_uid: Optional[int]
+) -> Tuple[List[int], bool, int]:
+    """
+    Newest-first page of UIDs, whether more remain, and the total matching
+    count (0 when not computed: totals are only needed on the first page).
+    """
+    want = max(1, min(limit, 50))
+    criteria = [] if not from_filter else ["FROM", _quote(from_filter)]
+    if not from_filter:
+        if get_sync_state(email_addr, client.selected or "INBOX") or client.exists <= IMAP_FULL_SYNC_MAX_MESSAGES:
+            # Unfiltered listings come from the incremental sync state instead of SEARCH ALL
+            state = await sync_mailbox(client, email_addr)
+            take, more = state.page(limit, last_uid)
+            return take, more, len(state.uids)
+        # Too big to mirror the UID list: STATUS gives the total and the upper UID bound
+        status = await client.status(client.selected or "INBOX")
+        below = last_uid or status.get("UIDNEXT") or (client.uidnext or 1)
+        take, more = await _window_search(client, criteria, below, want)
+        return take, more, status.get("MESSAGES", client.exists) if last_uid is None else 0
+
+    if last_uid:
+        take, more = await _window_search(client, criteria, last_uid, want)
+        return take, more, 0
+    if "ESEARCH" in client.capabilities:
+        # The server counts and finds the newest match; only the page itself is searched for UIDs
+        agg = await client.uid_esearch("COUNT MAX", *criteria)
+        if not agg.get("COUNT"):
+            return [], False, 0
+        take, more = await _window_search(client, criteria, agg["MAX"] + 1, want)
+        return take, more, agg["COUNT"]
+    found = await client.uid_search(*_search_criteria(from_filter))
+    uids, take = _page(found, limit, None)
+    return take, len(uids) > len(take), len(found)
+
+
+async def _list_page(
+    client: AsyncImapClient, email_addr: str, from_filter: Optional[str], limit: int, last_uid: Optional[int], items: str,
+    known: Optional[Callable[[List[int]], Awaitable[Set[int]]]] = None,
+) -> Tuple[List[int], bool, int, Dict[int, Dict[str, Any]]]:
+    """
+    A page of UIDs as _list_uids returns it, plus `items` fetched for them.
+
+    With a warm sync state, an unfiltered page is fetched optimistically: the
+    delta search is pipelined with a FETCH of the page as the state has it
+    (and of anything past UIDNEXT on the first page), so the page usually
+    costs one round trip. UIDs the guess missed are fetched afterwards.
+    UIDs for which `known` says the caller already has the items are not fetched.
+    """
+    state = None if from_filter else get_sync_state(email_addr, client.selected or "INBOX")
+    fetched: Dict[int, Dict[str, Any]] = {}
+    if (
+        state is not None
+        and state.uidvalidity == client.uidvalidity
+        # Many unseen arrivals would make the "uidnext:*" fetch expensive
+        and client.exists - len(state.uids) <= max(1, min(limit, 50))
+    ):
+        guess, _ = state.page(limit, last_uid)
+        if guess and known is not None:
+            have = await known(guess)
+            guess = [uid for uid in guess if uid not in have]
+        fetch_set = [_uid_set(guess)] if guess else []
+        if last_uid is None:
+            fetch_set.append(f"{state.uidnext}:*")
+        commands: List[Tuple[str, ...]] = [("UID SEARCH", "UID", f"{state.uidnext}:*")]
+        if fetch_set:
+            commands.append(("UID FETCH", ",".join(fetch_set), f"({items})"))
+        buf = bytearray()
+        responses = await client.pipeline(*commands, into=buf)
+        for resp in responses:
+            if resp.status != "OK":
+                raise ImapError(f"Listing failed: {resp.status} {resp.text}")
+        fetched = fetched_items(buf)
+        state = await sync_mailbox(client, email_addr, delta=search_uids(responses[0]))
+        take, more = state.page(limit, last_uid)
+        total = len(state.uids)
+    else:
+        take, more, total = await _list_uids(client, email_addr, from_filter, limit, last_uid)
+    missing = [uid for uid in take if uid not in fetched]
+    if missing and known is not None:
+        have = await known(missing)
+        missing = [uid for uid in missing if uid not in have]
+    if missing:
+        fetched.update(await client.uid_fetch(missing, f"({items})"))
+    return take, more, total, fetched
+
+
+async def imap_xoauth_get_body_async(email_addr: str, access_token: str, uid: int, mailbox: str = "INBOX") -> Buffer:
+    store = get_mail_store()
+    state = get_sync_state(email_addr, mailbox)
+    if store is not None and state is not None:
+        # A synced mailbox knows its UIDVALIDITY: a stored body needs no connection at all
+        stored = await store.mailbox(email_addr, mailbox, state.uidvalidity).get_async(KIND_BODY, [uid])
+        if uid in stored:
+            return stored[uid]
+    async with _POOL.connection(email_addr, access_token, mailbox) as client:
+        body = (await _fetch_bodies(client, [uid])).get(uid)
+        if body is None:
+            raise ImapError("Fetch BODY failed")
+        return body
+
+
+async def imap_xoauth_fetch_bodies_async(
+    email_addr: str, access_token: str, uids: List[int], max_body_bytes: Optional[int] = None, mailbox: str = "INBOX"
+) -> Dict[int, Buffer]:
+    """Batch fetch bodies for given UIDs (text sections capped at max_body_bytes when set). Returns uid -> raw message."""
+    if not uids:
+        return {}
+    async with _POOL.connection(email_addr, access_token, mailbox) as client:
+        return await _fetch_bodies(client, uids, max_body_bytes)
+
+
+async def _list_with_bodies(
+    client: AsyncImapClient,
+    email_addr: str,
+    from_filter: Optional[str],
+    limit: int,
+    last_uid: Optional[int],
+    include_bodies: bool,
+    max_body_bytes: Optional[int],
+) -> Tuple[List[Tuple[int, Envelope]], Optional[int], Dict[int, Buffer], int]:
+    """
+    With the on-disk mirror, envelopes (and bodies) already stored are read
+    from disk and left out of the page FETCH. Stored envelopes keep the flags
+    they were first fetched with.
+    """
+    mirror = _mirror(client)
+    stored_rows: Dict[int, bytes] = {}
+    stored_bodies: Dict[int, Buffer] = {}
+
+    async def known(uids: List[int]) -> Set[int]:
+        assert mirror is not None
+        stored_rows.update(await mirror.get_async(KIND_ENVELOPE, [uid for uid in uids if uid not in stored_rows]))
+        have = {uid for uid in uids if uid in stored_rows}
+        if not include_bodies:
+            return have
+        stored_bodies.update(await _stored_bodies(mirror, [uid for uid in have if uid not in stored_bodies], max_body_bytes))
+        return {uid for uid in have if uid in stored_bodies}
+
+    take, more, total, fetched = await _list_page(
+        client, email_addr, from_filter, limit, last_uid, _page_items(include_bodies, max_body_bytes),
+        known=known if mirror is not None else None,
+    )
+    total_count = total if last_uid is None else 0
+    if not take:
+        return [], None, {}, total_count
+    rows: List[Tuple[int, Envelope]] = []
+    for uid in take:
+        if "ENVELOPE" in fetched.get(uid, {}):
+            rows.append((uid, _envelope(fetched[uid])))
+        elif uid in stored_rows:
+            rows.append((uid, _envelope_from_json(stored_rows[uid])))
+    bodies_map: Dict[int, Buffer] = {}
+    fresh: Dict[int, Buffer] = {}
+    if include_bodies and rows:
+        bodies_map = {uid: stored_bodies[uid] for uid, _ in rows if uid in stored_bodies}
+        uids = [uid for uid, _ in rows if uid not in bodies_map]
+        if uids and max_body_bytes:
+            fresh = await _fetch_capped(client, uids, fetched, max_body_bytes)
+        elif uids:
+            fresh = {uid: fetched[uid]["BODY[]"] for uid in uids if "BODY[]" in fetched.get(uid, {})}
+            missing = [uid for uid in uids if uid not in fresh]
+            if missing:
+                # Mirrored by _fetch_bodies itself
+                bodies_map.update(await _fetch_bodies(client, missing))
+        bodies_map.update(fresh)
+    if mirror is not None:
+        await mirror.put_async(KIND_ENVELOPE, {uid: _envelope_json(env) for uid, env in rows if uid not in stored_rows})
+        await mirror.put_async(body_kind(max_body_bytes), fresh)
+    next_token = take[-1] if more else None
+    return rows, next_token, bodies_map, total_count
+
+
+async def imap_xoauth_list_envelopes_async(
+    email_addr: str, access_token: str, from_filter: Optional[str], limit: int, last_uid: Optional[int],
+    include_bodies: bool = False, max_body_bytes: Optional[int] = None, mailbox: str = "INBOX"
+) -> Tuple[List[Tuple[int, Envelope]], Optional[int], Dict[int, Buffer], int]:
+    """
+    List a page as (uid, Envelope) rows, plus bodies when asked, over one pooled connection.
+    Rows come from FETCH (UID ENVELOPE INTERNALDATE RFC822.SIZE FLAGS) plus the
+    From field: the server parses the headers, so no header block is downloaded
+    or parsed per row.
+    Returns: (rows, next_uid, bodies_map, total_count)
+    total_count is only computed on the first page (last_uid is None)
+    """
+    async with _POOL.connection(email_addr, access_token, mailbox) as client:
+        return await _list_with_bodies(client, email_addr, from_filter, limit, last_uid, include_bodies, max_body_bytes)
+
+
+async def imap_xoauth_recent_bodies_async(
+    email_addr: str, access_token: str, from_filter: Optional[str], since: datetime, limit: int,
+    max_body_bytes: Optional[int] = None, mailbox: str = "INBOX"
+) -> Tuple[List[Tuple[int, Optional[datetime]]], Dict[int, Buffer]]:
+    """
+    Bodies of the newest `limit` messages that arrived at or after `since`
+    (timezone-aware). SEARCH SINCE narrows the mailbox by day on the server,
+    the INTERNALDATE of those candidates cuts it to the instant, and only the
+    messages left are downloaded.
+    Returns newest-first (uid, arrival) rows and uid -> raw message.
+    """
+    async with _POOL.connection(email_addr, access_token, mailbox) as client:
+        _, take = _page(await client.uid_search(*_search_criteria(from_filter, since)), limit, None)
+        if not take:
+            return [], {}
+        dates = await client.uid_fetch(take, "(UID INTERNALDATE)")
+        rows: List[Tuple[int, Optional[datetime]]] = []
+        for uid in take:
+            arrived = parse_internaldate(dates.get(uid, {}).get("INTERNALDATE"))
+            # Without a usable INTERNALDATE the caller checks the Date header instead
+            if arrived is None or arrived >= since:
+                rows.append((uid, arrived))
+        bodies = await _fetch_bodies(client, [uid for uid, _ in rows], max_body_bytes) if rows else {}
+        return rows, bodies
+
+
+async def imap_xoauth_watch_bodies_async(
+    email_addr: str,
+    access_token: str,
+    from_filter: Optional[str],
+    timeout: float,
+    initial_limit: int = 0,
+    heartbeat: float = IMAP_IDLE_HEARTBEAT_SECONDS,
+    max_body_bytes: Optional[int] = None,
+    mailbox: str = "INBOX",
+    since: Optional[datetime] = None,
+) -> AsyncIterator[Dict[int, Buffer]]:
+    """
+    Yield uid -> raw body maps for messages in `mailbox`, holding one IDLE session.
+
+    The first batch is the newest `initial_limit` matching messages (skipped when 0;
+    with `since`, only those received on or after the day before it), then each
+    batch is the messages that arrived since the previous one. An empty map is
+    yielded every `heartbeat` seconds of silence so callers can keep a stream
+    alive. Ends when `timeout` elapses; use contextlib.aclosing to stop early.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    criteria = [] if not from_filter else ["FROM", _quote(from_filter)]
+    async with _POOL.connection(email_addr, access_token, mailbox) as client:
+        # "UID *" matches only the newest message: a one-line way to learn the current high-water mark
+        newest = await client.uid_search("UID", "*")
+        next_uid = max(newest, default=0) + 1
+        if initial_limit > 0:
+            _, take = _page(await client.uid_search(*_search_criteria(from_filter, since)), initial_limit, None)
+            if take:
+                yield await _fetch_bodies(client, take, max_body_bytes)
+        while True:
+            # "n:*" also matches the newest message when n is past it, so filter client-side
+            found = [u for u in await client.uid_search("UID", f"{next_uid}:*", *criteria) if u >= next_uid]
+            if found:
+                next_uid = max(found) + 1
+                yield await _fetch_bodies(client, sorted(found, reverse=True), max_body_bytes)
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            if not await client.idle(min(remaining, heartbeat)):
+                yield {}
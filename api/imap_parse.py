@@ -0,0 +1,384 @@
+"""
+Parsers for IMAP response syntax: parenthesized lists with literals, FETCH
+replies and BODYSTRUCTURE.
+
+FETCH replies are parsed straight out of the buffer the client read them
+into; literal payloads come back as memoryview slices of it, never copies.
+"""
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from email.message import Message
+from email.parser import Parser
+from email.policy import compat32
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+_SPACE = frozenset(b" \t\r\n")
+_ATOM_END = frozenset(b" \t\r\n()")
+
+
+def _tokens(chunks: List[bytes]) -> Iterator[Tuple[str, Any]]:
+    """Yield ("(", None), (")", None), ("str", bytes) or ("atom", str) tokens."""
+    for index, chunk in enumerate(chunks):
+        if index % 2:
+            yield "str", chunk
+            continue
+        pos, n = 0, len(chunk)
+        while pos < n:
+            c = chunk[pos]
+            if c in _SPACE:
+                pos += 1
+            elif c == 0x28:  # (
+                yield "(", None
+                pos += 1
+            elif c == 0x29:  # )
+                yield ")", None
+                pos += 1
+            elif c == 0x22:  # "
+                out = bytearray()
+                pos += 1
+                while pos < n and chunk[pos] != 0x22:
+                    if chunk[pos] == 0x5C and pos + 1 < n:  # backslash escape
+                        pos += 1
+                    out.append(chunk[pos])
+                    pos += 1
+                pos += 1
+                yield "str", bytes(out)
+            else:
+                start = pos
+                depth = 0
+                # Section specs like BODY[HEADER.FIELDS (FROM TO)]<0> are one atom
+                while pos < n and (depth or chunk[pos] not in _ATOM_END):
+                    if chunk[pos] == 0x5B:  # [
+                        depth += 1
+                    elif chunk[pos] == 0x5D:  # ]
+                        depth -= 1
+                    pos += 1
+                yield "atom", chunk[start:pos].decode("ascii", errors="replace")
+
+
+def parse_list(chunks: List[bytes]) -> List[Any]:
+    """
+    Parse chunks into nested lists. Quoted strings become bytes, literals stay
+    the buffers passed in, NIL becomes None, numbers become int and other
+    atoms stay str.
+    """
+    root: List[Any] = []
+    stack: List[List[Any]] = [root]
+    for kind, value in _tokens(chunks):
+        if kind == "(":
+            child: List[Any] = []
+            stack[-1].append(child)
+            stack.append(child)
+        elif kind == ")":
+            if len(stack) > 1:
+                stack.pop()
+        elif kind == "str":
+            stack[-1].append(value)
+        elif value.upper() == "NIL":
+            stack[-1].append(None)
+        elif value.isdigit():
+            stack[-1].append(int(value))
+        else:
+            stack[-1].append(value)
+    return root
+
+
+def item_key(name: str) -> str:
+    """Normalize a FETCH item name as the server echoes it (BODY.PEEK[1]<0> -> BODY[1]<0>)."""
+    return name.upper().replace(".PEEK", "")
+
+
+# ===== FETCH replies =====
+
+ReplyBuffer = Union[bytes, bytearray]
+Buffer = Union[bytes, bytearray, memoryview]
+
+_FETCH_HEAD = re.compile(rb"\* (\d+) FETCH \(", re.IGNORECASE)
+# One match per item: name, then exactly one of
+#   {n} literal | number | "quoted" | flat (atom list) | "(" nested list | atom
+_FETCH_ITEM = re.compile(
+    rb' *([^\s()\[{]+(?:\[[^\]]*\])?(?:<\d+>)?) '
+    rb'(?:\{(\d+)\}\r\n|(\d+)(?=[ )])|"((?:[^"\\]|\\.)*)"|\(([^()"{]*)\)|(\()|([^\s()]+))'
+)
+_LITERAL = re.compile(rb"\{(\d+)\}\r\n")
+_QUOTED = re.compile(rb'"((?:[^"\\]|\\.)*)"')
+_LIST_SPECIAL = re.compile(rb'[()"{]')
+_ITEM_LITERAL, _ITEM_NUMBER, _ITEM_QUOTED, _ITEM_FLAT, _ITEM_LIST, _ITEM_ATOM = range(2, 8)
+
+@dataclass
+class FetchRecord:
+    seq: int
+    uid: Optional[int] = None
+    size: Optional[int] = None
+    flags: Tuple[str, ...] = ()
+    # Literals and quoted strings are memoryview slices of the reply buffer;
+    # lists (BODYSTRUCTURE, ENVELOPE) are parsed with parse_list
+    items: Dict[str, Any] = field(default_factory=dict)
+
+
+@lru_cache(maxsize=256)
+def _item_name(raw: bytes) -> str:
+    return item_key(raw.decode("ascii", errors="replace"))
+
+
+def _atom(token: bytes) -> Any:
+    if token.isdigit():
+        return int(token)
+    text = token.decode("ascii", errors="replace")
+    return None if text.upper() == "NIL" else text
+
+
+def _scan_list(data: ReplyBuffer, view: memoryview, pos: int) -> Tuple[int, List[Any]]:
+    """Find the end of the list opening at data[pos] and return (end, chunks) for parse_list."""
+    chunks: List[Any] = []
+    text_start = pos
+    depth = 0
+    while True:
+        m = _LIST_SPECIAL.search(data, pos)
+        if m is None:
+            raise ValueError("Unterminated list in FETCH response")
+        pos = m.start()
+        c = data[pos]
+        if c == 0x28:  # (
+            depth += 1
+            pos += 1
+        elif c == 0x29:  # )
+            depth -= 1
+            pos += 1
+            if depth == 0:
+                chunks.append(bytes(view[text_start:pos]))
+                return pos, chunks
+        elif c == 0x22:  # "
+            q = _QUOTED.match(data, pos)
+            if q is None:
+                raise ValueError("Unterminated string in FETCH response")
+            pos = q.end()
+        else:
+            lit = _LITERAL.match(data, pos)
+            if lit is None:
+                pos += 1
+                continue
+            size = int(lit.group(1))
+            chunks.append(bytes(view[text_start:pos]))
+            chunks.append(view[lit.end():lit.end() + size])
+            pos = text_start = lit.end() + size
+
+
+def _skip_line(data: ReplyBuffer, pos: int) -> int:
+    """Offset just past the response starting at pos, stepping over any literals it carries."""
+    while True:
+        eol = data.find(b"\r\n", pos)
+        if eol < 0:
+            return len(data)
+        start = data.rfind(b"{", pos, eol)
+        if start >= 0 and data[eol - 1] == 0x7D:  # line ends with {n}
+            digits = bytes(data[start + 1:eol - 1])
+            if digits.isdigit():
+                pos = eol + 2 + int(digits)
+                continue
+        return eol + 2
+
+
+def iter_fetch(data: ReplyBuffer) -> Iterator[FetchRecord]:
+    """
+    Parse FETCH responses out of a raw reply buffer (wire format, literals
+    inline). Literal payloads are returned as memoryview slices of `data`, so
+    message bodies are never copied; other responses are skipped.
+    """
+    view = memoryview(data)
+    n = len(data)
+    pos = 0
+    while pos < n:
+        head = _FETCH_HEAD.match(data, pos)
+        if head is None:
+            pos = _skip_line(data, pos)
+            continue
+        record = FetchRecord(seq=int(head.group(1)))
+        items = record.items
+        pos = head.end()
+        while True:
+            m = _FETCH_ITEM.match(data, pos)
+            if m is None:
+                break
+            kind = m.lastindex
+            value: Any
+            if kind == _ITEM_LITERAL:
+                pos = m.end() + int(m.group(_ITEM_LITERAL))
+                value = view[m.end():pos]
+            elif kind == _ITEM_NUMBER:
+                value = int(m.group(_ITEM_NUMBER))
+                pos = m.end()
+            elif kind == _ITEM_QUOTED:
+                quoted = m.group(_ITEM_QUOTED)
+                value = view[m.start(kind):m.end(kind)] if b"\\" not in quoted else re.sub(rb"\\(.)", rb"\1", quoted)
+                pos = m.end()
+            elif kind == _ITEM_FLAT:
+                value = [_atom(a) for a in m.group(_ITEM_FLAT).split()]
+                pos = m.end()
+            elif kind == _ITEM_LIST:
+                pos, chunks = _scan_list(data, view, m.start(_ITEM_LIST))
+                parsed = parse_list(chunks)
+                value = parsed[0] if parsed else []
+            else:
+                value = _atom(m.group(_ITEM_ATOM))
+                pos = m.end()
+            items[_item_name(m.group(1))] = value
+        if isinstance(items.get("UID"), int):
+            record.uid = items["UID"]
+        if isinstance(items.get("RFC822.SIZE"), int):
+            record.size = items["RFC822.SIZE"]
+        if isinstance(items.get("FLAGS"), list):
+            record.flags = tuple(str(f) for f in items["FLAGS"])
+        yield record
+        pos = _skip_line(data, pos)
+
+
+def message_from_buffer(data: Buffer) -> Message:
+    """email.message_from_bytes for any buffer, memoryview slices included, without an extra bytes copy."""
+    return Parser(policy=compat32).parsestr(str(data, "ascii", "surrogateescape"))
+
+
+# ===== ENVELOPE =====
+
+@dataclass
+class Envelope:
+    # Raw header values: encoded words are left for the caller to decode
+    date: str = ""
+    subject: str = ""
+    from_: List[Tuple[str, str]] = field(default_factory=list)  # (display name, address)
+    to: List[Tuple[str, str]] = field(default_factory=list)
+    message_id: str = ""
+    # Listing metadata fetched alongside ENVELOPE
+    internaldate: str = ""
+    size: int = 0
+    flags: Tuple[str, ...] = ()
+    # Raw From field (BODY[HEADER.FIELDS (FROM)]): keeps the quoting ENVELOPE drops
+    from_header: str = ""
+
+
+def _addresses(value: Any) -> List[Tuple[str, str]]:
+    out: List[Tuple[str, str]] = []
+    if not isinstance(value, list):
+        return out
+    for address in value:
+        if not isinstance(address, list) or len(address) < 4:
+            continue
+        name, _, mailbox, host = address[:4]
+        if host is None:
+            continue  # Group start/end markers (RFC 3501 7.4.2)
+        out.append((_text(name), f"{_text(mailbox)}@{_text(host)}"))
+    return out
+
+
+def parse_envelope(value: Any) -> Envelope:
+    """Envelope from a parsed ENVELOPE list (date subject from sender reply-to to cc bcc in-reply-to message-id)."""
+    fields = value if isinstance(value, list) else []
+
+    def get(index: int) -> Any:
+        return fields[index] if len(fields) > index else None
+
+    return Envelope(
+        date=_text(get(0)),
+        subject=_text(get(1)),
+        from_=_addresses(get(2)),
+        to=_addresses(get(5)),
+        message_id=_text(get(9)),
+    )
+
+
+_MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+_INTERNALDATE_PATTERN = re.compile(r"^\s*(\d{1,2})-([A-Za-z]{3})-(\d{4}) (\d{2}):(\d{2}):(\d{2}) ([+-])(\d{2})(\d{2})\s*$")
+
+
+def parse_internaldate(value: Any) -> Optional[datetime]:
+    """Timezone-aware datetime of an INTERNALDATE ("06-Oct-2025 10:05:00 +0000"), None if malformed."""
+    text = _text(value)
+    m = _INTERNALDATE_PATTERN.match(text)
+    if not m or m.group(2).title() not in _MONTHS:
+        return None
+    day, month, year, hour, minute, second = (
+        int(m.group(1)), _MONTHS.index(m.group(2).title()) + 1, int(m.group(3)),
+        int(m.group(4)), int(m.group(5)), int(m.group(6)),
+    )
+    offset = timedelta(hours=int(m.group(8)), minutes=int(m.group(9)))
+    try:
+        return datetime(year, month, day, hour, minute, second, tzinfo=timezone(-offset if m.group(7) == "-" else offset))
+    except ValueError:
+        return None
+
+
+def search_date(value: datetime) -> str:
+    """A date as SEARCH SINCE/BEFORE take it ("6-Oct-2025"); month names are not locale-dependent."""
+    return f"{value.day}-{_MONTHS[value.month - 1]}-{value.year}"
+
+
+# ===== BODYSTRUCTURE =====
+
+@dataclass
+class BodyPart:
+    section: str
+    content_type: str
+    charset: str
+    encoding: str
+    size: int
+
+
+def _text(value: Any) -> str:
+    if isinstance(value, (bytes, memoryview)):
+        return bytes(value).decode("utf-8", errors="replace")
+    return "" if value is None else str(value)
+
+
+def _params(value: Any) -> Dict[str, str]:
+    if not isinstance(value, list):
+        return {}
+    return {_text(value[i]).lower(): _text(value[i + 1]) for i in range(0, len(value) - 1, 2)}
+
+
+def _is_attachment(fields: List[Any], disposition_index: int) -> bool:
+    disposition = fields[disposition_index] if len(fields) > disposition_index else None
+    return isinstance(disposition, list) and bool(disposition) and _text(disposition[0]).lower() == "attachment"
+
+
+def walk_bodystructure(node: Any, section: str = "") -> Iterator[BodyPart]:
+    """Yield the leaf parts of a BODYSTRUCTURE with their section numbers (message/rfc822 is not entered)."""
+    if not isinstance(node, list) or not node:
+        return
+    if isinstance(node[0], list):
+        # multipart: (part1)(part2)... "subtype" ext...
+        number = 0
+        for child in node:
+            if not isinstance(child, list):
+                break
+            number += 1
+            yield from walk_bodystructure(child, f"{section}.{number}" if section else str(number))
+        return
+    ctype = f"{_text(node[0])}/{_text(node[1] if len(node) > 1 else '')}".lower()
+    # text/* carries a line count before the extension data, other types do not
+    disposition_index = 9 if ctype.startswith("text/") else 8
+    if _is_attachment(node, disposition_index):
+        return
+    yield BodyPart(
+        # A non-multipart message has its body at section 1
+        section=section or "1",
+        content_type=ctype,
+        charset=_params(node[2] if len(node) > 2 else None).get("charset", ""),
+        encoding=_text(node[5] if len(node) > 5 else "7bit").lower() or "7bit",
+        size=node[6] if len(node) > 6 and isinstance(node[6], int) else 0,
+    )
+
+
+def find_text_parts(bodystructure: Any) -> Tuple[Optional[BodyPart], Optional[BodyPart]]:
+    """First inline text/plain and text/html parts of a message."""
+    plain: Optional[BodyPart] = None
+    html: Optional[BodyPart] = None
+    for part in walk_bodystructure(bodystructure):
+        if part.content_type == "text/plain" and plain is None:
+            plain = part
+        elif part.content_type == "text/html" and html is None:
+            html = part
+    return plain, html
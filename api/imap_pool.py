@@ -0,0 +1,230 @@
+"""
+Pool of authenticated, mailbox-selected IMAP connections.
+
+Connections are keyed by (account, mailbox) so a caller gets a session that is
+already past XOAUTH2 and SELECT. The pool itself does not know how to talk
+IMAP: the caller supplies connect / noop / close callables.
+"""
+from __future__ import annotations
+
+import hashlib
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from .constants import (
+    IMAP_POOL_MAX_IDLE_SECONDS,
+    IMAP_POOL_MAX_PER_ACCOUNT,
+    IMAP_POOL_NOOP_AFTER_SECONDS,
+)
+
+
+def token_fingerprint(access_token: str) -> str:
+    """Short, non-reversible id of an access token (never keep the token itself as a key)."""
+    return hashlib.sha256((access_token or "").encode()).hexdigest()[:16]
+
+
+@dataclass
+class _PooledConnection:
+    conn: Any
+    token_fp: str
+    last_used: float
+
+
+@dataclass
+class PoolStats:
+    hits: int = 0
+    misses: int = 0
+    overflow: int = 0
+    health_failures: int = 0
+    idle_evictions: int = 0
+    token_evictions: int = 0
+    discarded: int = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = asdict(self)
+        total = self.hits + self.misses
+        data["hit_rate"] = round(self.hits / total, 4) if total else 0.0
+        return data
+
+
+class _PoolBookkeeping:
+    """Idle lists, per-account counters, token tracking and stats; never awaits."""
+
+    def __init__(self, max_idle_seconds: float, max_per_account: int) -> None:
+        self.max_idle_seconds = max_idle_seconds
+        self.max_per_account = max(1, max_per_account)
+        self.counters = PoolStats()
+        self._idle: Dict[Tuple[str, str], Deque[_PooledConnection]] = {}
+        self._in_use: Dict[str, int] = {}
+        self._tokens: Dict[str, str] = {}
+
+    @staticmethod
+    def _key(email_addr: str, mailbox: str) -> Tuple[str, str]:
+        return (email_addr or "").strip().lower(), mailbox or "INBOX"
+
+    def _idle_count(self, account: str) -> int:
+        return sum(len(q) for (acc, _), q in self._idle.items() if acc == account)
+
+    def _collect_stale(self, key: Tuple[str, str], token_fp: str, now: float) -> List[Any]:
+        """Drop idle connections that are too old or belong to a previous token."""
+        account = key[0]
+        stale: List[Any] = []
+        if self._tokens.get(account) not in (None, token_fp):
+            for (acc, mbox) in list(self._idle):
+                if acc != account:
+                    continue
+                queue = self._idle.pop((acc, mbox))
+                self.counters.token_evictions += len(queue)
+                stale.extend(p.conn for p in queue)
+        self._tokens[account] = token_fp
+        queue = self._idle.get(key)
+        if queue:
+            while queue and now - queue[0].last_used > self.max_idle_seconds:
+                stale.append(queue.popleft().conn)
+                self.counters.idle_evictions += 1
+        return stale
+
+    def _pop_idle(self, key: Tuple[str, str]) -> Optional[_PooledConnection]:
+        queue = self._idle.get(key)
+        if not queue:
+            return None
+        # Most recently used first: it is the one least likely to have been dropped by the server
+        return queue.pop()
+
+    def _reserve(self, key: Tuple[str, str]) -> bool:
+        """Count a new connection against the account cap. False means "open but do not keep"."""
+        account = key[0]
+        if self._in_use.get(account, 0) + self._idle_count(account) >= self.max_per_account:
+            self.counters.overflow += 1
+            return False
+        self._in_use[account] = self._in_use.get(account, 0) + 1
+        return True
+
+    def _checkout(self, key: Tuple[str, str]) -> None:
+        self._in_use[key[0]] = self._in_use.get(key[0], 0) + 1
+
+    def _unreserve(self, key: Tuple[str, str]) -> None:
+        account = key[0]
+        self._in_use[account] = max(0, self._in_use.get(account, 0) - 1)
+        if not self._in_use[account]:
+            self._in_use.pop(account, None)
+
+    def _checkin(self, key: Tuple[str, str], pooled: _PooledConnection, reusable: bool) -> bool:
+        """Return True when the connection went back to the idle list."""
+        account = key[0]
+        self._unreserve(key)
+        if not reusable or self._tokens.get(account) != pooled.token_fp:
+            return False
+        pooled.last_used = time.monotonic()
+        self._idle.setdefault(key, deque()).append(pooled)
+        return True
+
+    def _drain(self, account: Optional[str] = None) -> List[Any]:
+        conns: List[Any] = []
+        for key in list(self._idle):
+            if account is None or key[0] == account:
+                conns.extend(p.conn for p in self._idle.pop(key))
+        if account is None:
+            self._tokens.clear()
+        else:
+            self._tokens.pop(account, None)
+        return conns
+
+    def snapshot(self) -> Dict[str, Any]:
+        data = self.counters.as_dict()
+        data["idle"] = sum(len(q) for q in self._idle.values())
+        data["in_use"] = sum(self._in_use.values())
+        data["accounts"] = len(self._tokens)
+        return data
+
+
+class AsyncImapConnectionPool(_PoolBookkeeping):
+    """Pool for asyncio connections. Bookkeeping never awaits, so no lock is needed on one loop."""
+
+    def __init__(
+        self,
+        connect: Callable[[str, str, str], Awaitable[Any]],
+        noop: Callable[[Any], Awaitable[bool]],
+        close: Callable[[Any], Awaitable[None]],
+        max_idle_seconds: float = IMAP_POOL_MAX_IDLE_SECONDS,
+        max_per_account: int = IMAP_POOL_MAX_PER_ACCOUNT,
+        noop_after_seconds: float = IMAP_POOL_NOOP_AFTER_SECONDS,
+    ) -> None:
+        super().__init__(max_idle_seconds, max_per_account)
+        self._connect = connect
+        self._noop = noop
+        self._close = close
+        self._noop_after = noop_after_seconds
+
+    async def _healthy(self, pooled: _PooledConnection) -> bool:
+        if time.monotonic() - pooled.last_used < self._noop_after:
+            return True
+        try:
+            return bool(await self._noop(pooled.conn))
+        except Exception:
+            return False
+
+    async def _close_all(self, conns: List[Any]) -> None:
+        for conn in conns:
+            try:
+                await self._close(conn)
+            except Exception:
+                pass
+
+    @asynccontextmanager
+    async def connection(self, email_addr: str, access_token: str, mailbox: str = "INBOX") -> AsyncIterator[Any]:
+        """Yield a ready connection; it is returned to the pool on success and dropped on error or cancellation."""
+        key = self._key(email_addr, mailbox)
+        token_fp = token_fingerprint(access_token)
+        pooled: Optional[_PooledConnection] = None
+        keep = True
+        while True:
+            stale = self._collect_stale(key, token_fp, time.monotonic())
+            candidate = self._pop_idle(key)
+            if candidate is not None:
+                self._checkout(key)
+            await self._close_all(stale)
+            if candidate is None:
+                break
+            if await self._healthy(candidate):
+                pooled = candidate
+                break
+            self.counters.health_failures += 1
+            self._checkin(key, candidate, reusable=False)
+            await self._close_all([candidate.conn])
+
+        if pooled is not None:
+            self.counters.hits += 1
+        else:
+            self.counters.misses += 1
+            keep = self._reserve(key)
+            try:
+                conn = await self._connect(email_addr, access_token, key[1])
+            except BaseException:
+                if keep:
+                    self._unreserve(key)
+                raise
+            pooled = _PooledConnection(conn=conn, token_fp=token_fp, last_used=time.monotonic())
+
+        ok = False
+        try:
+            yield pooled.conn
+            ok = True
+        finally:
+            returned = self._checkin(key, pooled, reusable=ok) if keep else False
+            if not ok:
+                self.counters.discarded += 1
+            if not returned:
+                await self._close_all([pooled.conn])
+
+    async def evict_account(self, email_addr: str) -> None:
+        await self._close_all(self._drain(self._key(email_addr, "INBOX")[0]))
+
+    async def close_all(self) -> None:
+        await self._close_all(self._drain())
+
+    def stats(self) -> Dict[str, Any]:
+        return self.snapshot()
@@ -0,0 +1,137 @@
+"""
+Incremental per-mailbox UID sync (UIDVALIDITY / UIDNEXT / HIGHESTMODSEQ).
+
+A mailbox is searched with `UID SEARCH ALL` once; afterwards only
+`UID SEARCH UID <uidnext>:*` is issued to pick up new mail. Expunges are
+applied from QRESYNC VANISHED (CHANGEDSINCE) when the server supports it,
+otherwise a message-count mismatch forces a full resync, as does a change of
+UIDVALIDITY.
+"""
+from __future__ import annotations
+
+import bisect
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from .constants import IMAP_SYNC_MAX_MAILBOXES
+
+if TYPE_CHECKING:
+    from .imap_async import AsyncImapClient
+
+
+@dataclass
+class MailboxSyncState:
+    uidvalidity: int
+    uidnext: int
+    highestmodseq: Optional[int] = None
+    uids: List[int] = field(default_factory=list)  # ascending
+    synced_at: float = 0.0
+
+    def page(self, limit: int, last_uid: Optional[int]) -> Tuple[List[int], bool]:
+        """Newest-first UIDs below last_uid, and whether more remain after them."""
+        end = bisect.bisect_left(self.uids, last_uid) if last_uid else len(self.uids)
+        start = max(0, end - max(1, min(limit, 50)))
+        return self.uids[start:end][::-1], start > 0
+
+
+@dataclass
+class SyncStats:
+    full_resyncs: int = 0
+    uidvalidity_changes: int = 0
+    delta_syncs: int = 0
+    new_uids: int = 0
+    vanished_uids: int = 0
+
+
+_STATES: "OrderedDict[Tuple[str, str], MailboxSyncState]" = OrderedDict()
+_STATS = SyncStats()
+
+
+def _key(email_addr: str, mailbox: str) -> Tuple[str, str]:
+    return (email_addr or "").strip().lower(), mailbox or "INBOX"
+
+
+def get_sync_state(email_addr: str, mailbox: str = "INBOX") -> Optional[MailboxSyncState]:
+    return _STATES.get(_key(email_addr, mailbox))
+
+
+def forget_sync_state(email_addr: str, mailbox: Optional[str] = None) -> None:
+    account = _key(email_addr, "")[0]
+    for key in list(_STATES):
+        if key[0] == account and (mailbox is None or key[1] == mailbox):
+            _STATES.pop(key, None)
+
+
+def imap_sync_stats() -> Dict[str, Any]:
+    data: Dict[str, Any] = asdict(_STATS)
+    data["mailboxes"] = len(_STATES)
+    return data
+
+
+def _store(key: Tuple[str, str], state: MailboxSyncState) -> MailboxSyncState:
+    _STATES[key] = state
+    _STATES.move_to_end(key)
+    while len(_STATES) > IMAP_SYNC_MAX_MAILBOXES:
+        _STATES.popitem(last=False)
+    return state
+
+
+async def _full_resync(client: AsyncImapClient, key: Tuple[str, str]) -> MailboxSyncState:
+    _STATS.full_resyncs += 1
+    uids = sorted(set(await client.uid_search("ALL")))
+    client.vanished = []
+    uidnext = max(client.uidnext or 0, (uids[-1] + 1) if uids else 1)
+    return _store(key, MailboxSyncState(
+        uidvalidity=client.uidvalidity or 0,
+        uidnext=uidnext,
+        highestmodseq=client.highestmodseq,
+        uids=uids,
+        synced_at=time.time(),
+    ))
+
+
+async def sync_mailbox(
+    client: AsyncImapClient, email_addr: str, delta: Optional[List[int]] = None
+) -> MailboxSyncState:
+    """
+    Bring the sync state of the client's selected mailbox up to date and return it.
+    `delta` is the answer to `UID SEARCH UID <state.uidnext>:*` when the caller
+    already sent it (pipelined with other commands); a full resync ignores it.
+    """
+    key = _key(email_addr, client.selected or "INBOX")
+    state = _STATES.get(key)
+    if state is None or client.uidvalidity is None:
+        return await _full_resync(client, key)
+    if state.uidvalidity != client.uidvalidity:
+        # Every cached UID is meaningless now
+        _STATS.uidvalidity_changes += 1
+        return await _full_resync(client, key)
+
+    _STATS.delta_syncs += 1
+    found = delta if delta is not None else await client.uid_search("UID", f"{state.uidnext}:*")
+    # "n:*" also matches the newest message when n is past it, so filter client-side.
+    # Re-read uidnext after the await: another connection of the same account may have advanced it.
+    new = sorted(u for u in found if u >= state.uidnext)
+    if new:
+        state.uids.extend(new)
+        state.uidnext = new[-1] + 1
+        _STATS.new_uids += len(new)
+
+    gone = set(client.vanished)
+    client.vanished = []
+    if len(state.uids) - len(gone) != client.exists and client.qresync_enabled and state.highestmodseq:
+        gone.update(await client.uid_vanished_since(state.highestmodseq))
+    if gone:
+        state.uids = [u for u in state.uids if u not in gone]
+        _STATS.vanished_uids += len(gone)
+    if len(state.uids) != client.exists:
+        # Something was expunged and the server cannot tell us what
+        return await _full_resync(client, key)
+
+    if client.highestmodseq:
+        state.highestmodseq = client.highestmodseq
+    state.synced_at = time.time()
+    _STATES.move_to_end(key)
+    return state
@@ -0,0 +1,317 @@
+"""
+On-disk mirror of fetched mail: SQLite index plus content-addressed blob files.
+
+Entries are keyed by (account, folder, UIDVALIDITY, message key, kind). For
+IMAP the key is the UID, which only means something together with the
+mailbox's UIDVALIDITY; Graph entries use immutable message IDs under the
+"graph" folder with UIDVALIDITY 0. Blobs are stored once per SHA-256 under
+blobs/ab/<digest>, however many entries point at them.
+
+The mirror is opt-in (MAIL_STORE_DIR). Least-recently-read entries are
+evicted once the blobs outgrow the byte budget.
+
+MailStore methods block on disk and are thread-safe; coroutines use the
+StoredMailbox *_async methods, which run them in a worker thread.
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, TypeVar, Union
+
+from .config import get_mail_store_dir, get_mail_store_max_bytes
+from .constants import MAIL_STORE_EVICT_TO, MAIL_STORE_MAX_BYTES
+
+K = TypeVar("K")
+
+Blob = Union[bytes, bytearray, memoryview]
+
+# Entry kinds
+KIND_BODY = "body"  # Whole raw message
+KIND_ENVELOPE = "envelope"  # JSON of an imap_parse.Envelope
+KIND_GRAPH = "graph"  # JSON of a converted Graph message with its body
+
+GRAPH_FOLDER = "graph"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    account TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    msg_key TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    blob TEXT NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (account, folder, uidvalidity, msg_key, kind)
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE INDEX IF NOT EXISTS entries_blob ON entries (blob);
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+"""
+
+# SQLite's default limit on host parameters is 999
+_CHUNK = 500
+
+
+def body_kind(max_body_bytes: Optional[int]) -> str:
+    """Kind for bodies fetched with a cap: capped stand-ins only match the same cap."""
+    return KIND_BODY if not max_body_bytes else f"{KIND_BODY}<{max_body_bytes}>"
+
+
+def _locked(method: Callable[..., Any]) -> Callable[..., Any]:
+    @functools.wraps(method)
+    def wrapper(self: "MailStore", *args: Any, **kwargs: Any) -> Any:
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _account(email_addr: str) -> str:
+    return (email_addr or "").strip().lower()
+
+
+@dataclass
+class MailStoreStats:
+    hits: int = 0
+    misses: int = 0
+    writes: int = 0
+    evicted: int = 0
+    purged: int = 0
+
+
+class MailStore:
+    def __init__(self, root: Union[str, Path], max_bytes: int = MAIL_STORE_MAX_BYTES) -> None:
+        self.root = Path(root)
+        self.blob_dir = self.root / "blobs"
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.counters = MailStoreStats()
+        # Autocommit; writes are grouped with explicit BEGIN/COMMIT
+        self._db = sqlite3.connect(str(self.root / "mail.sqlite3"), isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._bytes: int = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        # Last UIDVALIDITY seen per (account, folder); a change drops the older generation
+        self._generations: Dict[Tuple[str, str], int] = {}
+        # One connection shared by worker threads: a transaction must not interleave with another
+        self._lock = threading.RLock()
+
+    @_locked
+    def close(self) -> None:
+        self._db.close()
+
+    def mailbox(self, email_addr: str, folder: str, uidvalidity: int) -> "StoredMailbox":
+        return StoredMailbox(self, _account(email_addr), folder, uidvalidity)
+
+    def graph(self, email_addr: str) -> "StoredMailbox":
+        return StoredMailbox(self, _account(email_addr), GRAPH_FOLDER, 0)
+
+    # ----- blobs -----
+
+    def _blob_path(self, digest: str) -> Path:
+        return self.blob_dir / digest[:2] / digest
+
+    def _write_blob(self, data: Blob) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        if self._db.execute("SELECT 1 FROM blobs WHERE hash = ?", (digest,)).fetchone():
+            return digest
+        path = self._blob_path(digest)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self._db.execute("INSERT INTO blobs (hash, size) VALUES (?, ?)", (digest, len(data)))
+        self._bytes += len(data)
+        return digest
+
+    def _drop_orphans(self) -> None:
+        """Delete blobs no entry points at any more."""
+        rows = self._db.execute(
+            "SELECT hash, size FROM blobs WHERE hash NOT IN (SELECT blob FROM entries)"
+        ).fetchall()
+        for digest, size in rows:
+            try:
+                self._blob_path(digest).unlink()
+            except FileNotFoundError:
+                pass
+            self._bytes -= size
+        self._db.executemany("DELETE FROM blobs WHERE hash = ?", [(digest,) for digest, _ in rows])
+
+    # ----- entries -----
+
+    @_locked
+    def get(self, account: str, folder: str, uidvalidity: int, kind: str, keys: List[str]) -> Dict[str, bytes]:
+        found: Dict[str, bytes] = {}
+        stale: List[str] = []
+        for i in range(0, len(keys), _CHUNK):
+            chunk = keys[i:i + _CHUNK]
+            rows = self._db.execute(
+                "SELECT msg_key, blob FROM entries WHERE account = ? AND folder = ? AND uidvalidity = ? AND kind = ?"
+                f" AND msg_key IN ({','.join('?' * len(chunk))})",
+                (account, folder, uidvalidity, kind, *chunk),
+            ).fetchall()
+            for key, digest in rows:
+                try:
+                    found[key] = self._blob_path(digest).read_bytes()
+                except FileNotFoundError:
+                    stale.append(key)
+        if found or stale:
+            self._db.execute("BEGIN")
+            now = time.time()
+            self._db.executemany(
+                "UPDATE entries SET accessed = ? WHERE account = ? AND folder = ? AND uidvalidity = ? AND msg_key = ? AND kind = ?",
+                [(now, account, folder, uidvalidity, key, kind) for key in found],
+            )
+            self._db.executemany(
+                "DELETE FROM entries WHERE account = ? AND folder = ? AND uidvalidity = ? AND msg_key = ? AND kind = ?",
+                [(account, folder, uidvalidity, key, kind) for key in stale],
+            )
+            self._db.execute("COMMIT")
+        self.counters.hits += len(found)
+        self.counters.misses += len(keys) - len(found)
+        return found
+
+    @_locked
+    def put(self, account: str, folder: str, uidvalidity: int, kind: str, items: Dict[str, Blob]) -> None:
+        if not items:
+            return
+        self._db.execute("BEGIN")
+        try:
+            generation = (account, folder)
+            dropped = False
+            if self._generations.get(generation) != uidvalidity:
+                # UIDs of an older UIDVALIDITY may now name other messages
+                dropped = self._db.execute(
+                    "DELETE FROM entries WHERE account = ? AND folder = ? AND uidvalidity != ?",
+                    (account, folder, uidvalidity),
+                ).rowcount > 0
+                self._generations[generation] = uidvalidity
+            now = time.time()
+            for key, data in items.items():
+                digest = self._write_blob(data)
+                old = self._db.execute(
+                    "SELECT blob FROM entries WHERE account = ? AND folder = ? AND uidvalidity = ? AND msg_key = ? AND kind = ?",
+                    (account, folder, uidvalidity, key, kind),
+                ).fetchone()
+                self._db.execute(
+                    "INSERT OR REPLACE INTO entries (account, folder, uidvalidity, msg_key, kind, blob, accessed)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (account, folder, uidvalidity, key, kind, digest, now),
+                )
+                dropped = dropped or (old is not None and old[0] != digest)
+            if dropped:
+                self._drop_orphans()
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            # Blob files written before the failure are orphans now; recount from the index
+            self._bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            raise
+        self.counters.writes += len(items)
+        if self._bytes > self.max_bytes:
+            self.evict()
+
+    @_locked
+    def evict(self) -> int:
+        """Drop least-recently-read entries until the blobs fit MAIL_STORE_EVICT_TO of the budget."""
+        target = int(self.max_bytes * MAIL_STORE_EVICT_TO)
+        dropped = 0
+        while self._bytes > target:
+            victims: List[Tuple[int]] = []
+            freed = 0
+            # Oldest first, just enough of them (shared blobs may free less; the loop then goes on)
+            for rowid, size in self._db.execute(
+                "SELECT entries.rowid, blobs.size FROM entries JOIN blobs ON blobs.hash = entries.blob"
+                " ORDER BY entries.accessed LIMIT ?", (_CHUNK,)
+            ).fetchall():
+                victims.append((rowid,))
+                freed += size
+                if self._bytes - freed <= target:
+                    break
+            if not victims:
+                break
+            self._db.execute("BEGIN")
+            self._db.executemany("DELETE FROM entries WHERE rowid = ?", victims)
+            self._drop_orphans()
+            self._db.execute("COMMIT")
+            dropped += len(victims)
+        self.counters.evicted += dropped
+        return dropped
+
+    @_locked
+    def purge_account(self, email_addr: str) -> int:
+        """Forget everything stored for an account; returns the number of entries removed."""
+        account = _account(email_addr)
+        self._db.execute("BEGIN")
+        removed = self._db.execute("DELETE FROM entries WHERE account = ?", (account,)).rowcount
+        self._drop_orphans()
+        self._db.execute("COMMIT")
+        for generation in [g for g in self._generations if g[0] == account]:
+            self._generations.pop(generation, None)
+        self.counters.purged += removed
+        return removed
+
+    @_locked
+    def stats(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = asdict(self.counters)
+        data["entries"] = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        data["bytes"] = self._bytes
+        data["max_bytes"] = self.max_bytes
+        return data
+
+
+@dataclass
+class StoredMailbox:
+    """One (account, folder, UIDVALIDITY) slice of the store; keys may be UIDs or Graph IDs."""
+
+    store: MailStore
+    account: str
+    folder: str
+    uidvalidity: int
+
+    def get(self, kind: str, keys: Iterable[K]) -> Dict[K, bytes]:
+        by_name = {str(key): key for key in keys}
+        found = self.store.get(self.account, self.folder, self.uidvalidity, kind, list(by_name))
+        return {by_name[name]: data for name, data in found.items()}
+
+    def put(self, kind: str, items: Dict[Any, Blob]) -> None:
+        self.store.put(self.account, self.folder, self.uidvalidity, kind, {str(k): v for k, v in items.items()})
+
+    async def get_async(self, kind: str, keys: Iterable[K]) -> Dict[K, bytes]:
+        return await asyncio.to_thread(self.get, kind, list(keys))
+
+    async def put_async(self, kind: str, items: Dict[Any, Blob]) -> None:
+        if items:
+            await asyncio.to_thread(self.put, kind, items)
+
+
+_STORE: Optional[MailStore] = None
+_CONFIGURED = False
+
+
+def get_mail_store() -> Optional[MailStore]:
+    """The process-wide mirror, opened on first use; None when MAIL_STORE_DIR is unset."""
+    global _STORE, _CONFIGURED
+    if not _CONFIGURED:
+        _CONFIGURED = True
+        root = get_mail_store_dir()
+        if root:
+            _STORE = MailStore(root, get_mail_store_max_bytes() or MAIL_STORE_MAX_BYTES)
+    return _STORE
+
+
+def mail_store_stats() -> Dict[str, Any]:
+    store = get_mail_store()
+    return store.stats() if store is not None else {"enabled": False}
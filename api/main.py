@@ -1,7 +1,10 @@
 from __future__ import annotations
 
+import asyncio
+import json
 import re
-from typing import Any, Dict, List, Optional, Tuple
+from contextlib import aclosing, asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
@@ -11,27 +14,77 @@ import secrets
 import hashlib
 import base64
 import time
+from datetime import datetime
 import httpx
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi.responses import RedirectResponse, JSONResponse, PlainTextResponse, StreamingResponse
 import email as pyemail
 from email.header import decode_header, make_header
 
-from .credentials import parse_cred_string, select_provider
-from .outlook_imap import exchange_refresh_token_outlook, imap_xoauth_list, imap_xoauth_get_body, imap_xoauth_fetch_bodies, imap_xoauth_list_and_bodies
-from .otp_utils import html_to_text, extract_otp_from_text, within_window
+from .credentials import format_cred_string, parse_cred_string, select_provider
+from .outlook_imap import exchange_refresh_token_outlook
+from .imap_async import (
+    imap_xoauth_fetch_bodies_async, imap_xoauth_get_body_async, imap_xoauth_list_envelopes_async,
+    imap_xoauth_recent_bodies_async, imap_xoauth_watch_bodies_async, imap_async_pool_stats, close_imap_async_pool
+)
+from .imap_parse import Buffer, Envelope, message_from_buffer
+from .folders import (
+    normalize_folders, imap_mailbox, graph_folder, encode_page_token, decode_page_token,
+    merge_pages, date_key, gather_folders, first_found, merge_streams
+)
+from .imap_sync import imap_sync_stats
+from .graph_push import (
+    GraphSubscription, accept_graph_notifications, close_graph_push, ensure_graph_subscription, graph_push_stats,
+    remove_graph_subscription, renew_due_subscriptions, wait_for_graph_mail
+)
+from .graph_scheduler import graph_scheduler_stats
+from .graph_sync import get_graph_sync_state, graph_sync_stats, sync_graph_folder
+from .mail_store import KIND_GRAPH, get_mail_store, mail_store_stats
+from .parse_cache import message_key, parse_cache_stats, parsed
+from .prefetch import (
+    KIND_BODY, KIND_PAGE, close_prefetch, prefetch_key, prefetch_stats, schedule_prefetch, take_prefetched
+)
+from .ttl_cache import TTLCache
+from .http_client import close_http_client, get_http_client, http_client_stats
+from .state_store import StateStoreError, close_state_store, get_state_store, state_store_stats
+from .otp_utils import html_to_text, extract_otp_from_text, parse_mail_date, window_start
 from .models import EmailMessage, PageResult
 from .config import (
     get_ui_origins, get_client_id, get_client_secret, get_tenant,
-    get_outlook_scope, get_oauth_redirect_uri, is_development, get_test_cred_string
+    get_outlook_scope, get_oauth_redirect_uri, is_development, get_test_cred_string, get_graph_text_bodies,
+    get_graph_notification_url, get_prefetch_enabled
 )
 from .constants import (
     DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, MIN_PAGE_SIZE,
     DEFAULT_OTP_TOP_EMAILS, DEFAULT_TIME_WINDOW_MINUTES,
+    DEFAULT_OTP_WAIT_SECONDS, MAX_OTP_WAIT_SECONDS, OTP_WAIT_POLL_SECONDS,
+    DEFAULT_OTP_MAX_BODY_BYTES, MIN_MAX_BODY_BYTES,
     STATE_TTL_SECONDS, TOKEN_EXPIRY_BUFFER_SECONDS,
+    TOKEN_REFRESH_CHECK_SECONDS, TOKEN_REFRESH_AHEAD_SECONDS, TOKEN_REFRESH_ACTIVE_SECONDS, TOKEN_ROTATED_MAX_ACCOUNTS,
+    REFRESH_TOKEN_STORE_TTL_SECONDS, PROVIDER_MEMO_TTL_SECONDS, PROVIDER_RACE_GRAPH_GRACE_SECONDS, TOKEN_CACHE_MAX_ENTRIES,
+    GRAPH_SUBSCRIPTION_CHECK_SECONDS, PREFETCH_TOP_BODIES,
     ERROR_IMAP, ERROR_INVALID_CREDENTIALS
 )
 
-app = FastAPI(title="Hotmail Reader API")
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI) -> AsyncIterator[None]:
+    get_state_store()  # Open it (and load any snapshot) before the first request
+    get_http_client()
+    background = [asyncio.create_task(_token_refresher()), asyncio.create_task(_subscription_renewer())]
+    try:
+        yield
+    finally:
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        await close_prefetch()
+        await close_graph_push()
+        await close_imap_async_pool()
+        await close_state_store()
+        await close_http_client()
+
+
+app = FastAPI(title="Hotmail Reader API", lifespan=_lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -46,12 +99,38 @@ def health() -> dict:
     return {"status": "ok"}
 
 
+@app.get("/stats")
+def stats() -> Dict[str, Any]:
+    return {
+        "imap_pool": imap_async_pool_stats(),
+        "imap_sync": imap_sync_stats(),
+        "graph_sync": graph_sync_stats(),
+        "graph_scheduler": graph_scheduler_stats(),
+        "graph_push": graph_push_stats(),
+        "mail_store": mail_store_stats(),
+        "token_cache": {
+            **_TOKEN_CACHE.stats(),
+            "active_accounts": len(_TOKEN_LAST_USED),
+            "rotated_refresh_tokens": len(_REFRESH_TOKENS),
+        },
+        "token_provider": {**_PROVIDER_STATS, "remembered": len(_PROVIDER_MEMO)},
+        "state_store": state_store_stats(),
+        "http_client": http_client_stats(),
+        "parse_cache": parse_cache_stats(),
+        "prefetch": prefetch_stats(),
+    }
+
+
 class MessagesRequest(BaseModel):
     credString: str
     from_: Optional[str] = None
     page_size: Optional[int] = Field(default=DEFAULT_PAGE_SIZE, ge=MIN_PAGE_SIZE, le=MAX_PAGE_SIZE)
     page_token: Optional[str] = None
     include_body: Optional[bool] = False
+    # IMAP only: cap on bytes read per text section; None downloads whole messages
+    max_body_bytes: Optional[int] = Field(default=None, ge=MIN_MAX_BODY_BYTES)
+    # "inbox", "junk" or a mailbox / folder id; several folders are scanned concurrently and merged by date
+    folders: Optional[List[str]] = None
 
 
 class OtpRequest(BaseModel):
@@ -59,11 +138,25 @@ class OtpRequest(BaseModel):
     from_: Optional[str] = None
     regex: Optional[str] = None
     time_window_minutes: Optional[int] = Field(default=DEFAULT_TIME_WINDOW_MINUTES, ge=1)
+    # IMAP only: cap on bytes read per text section; None downloads whole messages
+    max_body_bytes: Optional[int] = Field(default=DEFAULT_OTP_MAX_BODY_BYTES, ge=MIN_MAX_BODY_BYTES)
+    # Folders are scanned concurrently; the first code found wins
+    folders: Optional[List[str]] = None
+
+
+class OtpWaitRequest(OtpRequest):
+    timeout_seconds: Optional[int] = Field(default=DEFAULT_OTP_WAIT_SECONDS, ge=1, le=MAX_OTP_WAIT_SECONDS)
+    only_new: Optional[bool] = False  # Ignore codes already in the mailbox when the wait starts
+
+
+class PurgeRequest(BaseModel):
+    credString: str
 
 
 class MessageBodyRequest(BaseModel):
     credString: str
     id: str = Field(..., description="IMAP UID")
+    folder: Optional[str] = None  # IMAP only: folder the UID belongs to (default inbox)
 
 
 @app.get("/dev/cred")
@@ -74,24 +167,29 @@ def dev_cred() -> Dict[str, Optional[str]]:
 
 
 # ===== OAuth 2.0 Authorization Code Flow with PKCE (S256) =====
-_STATE_STORE: Dict[str, Dict[str, Any]] = {}
-_TOKEN_CACHE: Dict[str, Dict[str, Any]] = {}
-
-
-def _cleanup_expired_states() -> None:
-    """Remove expired states from STATE_STORE."""
-    now = time.time()
-    expired = [k for k, v in _STATE_STORE.items() if now - v.get("ts", 0) > STATE_TTL_SECONDS]
-    for k in expired:
-        _STATE_STORE.pop(k, None)
+# OAuth state lives in the shared state store ("oauth_state") so the callback may reach any worker;
+# tokens are cached here per process and shared through the store ("token", "refresh")
+# Entries leave the cache TOKEN_EXPIRY_BUFFER_SECONDS before the token itself expires
+_TOKEN_CACHE: "TTLCache[str, Dict[str, Any]]" = TTLCache(TOKEN_CACHE_MAX_ENTRIES)
+# Refresh-token exchanges in progress, by _cache_key
+_TOKEN_INFLIGHT: Dict[str, "asyncio.Task[Tuple[str, str]]"] = {}
+# When each _cache_key last served a request; only recently active accounts are refreshed ahead of expiry
+_TOKEN_LAST_USED: "TTLCache[str, float]" = TTLCache(TOKEN_CACHE_MAX_ENTRIES)
+# Newest refresh token Microsoft returned for a credential (keyed by the _cache_key of the one the client holds)
+_REFRESH_TOKENS: "TTLCache[str, str]" = TTLCache(TOKEN_ROTATED_MAX_ACCOUNTS)
+# Provider ("graph"/"imap") whose exchange worked for an account + client_id
+_PROVIDER_MEMO: "TTLCache[str, str]" = TTLCache(TOKEN_CACHE_MAX_ENTRIES)
+# Exchange wins per provider, and how the provider was picked
+_PROVIDER_STATS: Dict[str, int] = {
+    "graph": 0, "imap": 0, "raced": 0, "memo_hits": 0, "memo_stale": 0, "unsettled": 0
+}
 
 
 def _cleanup_expired_tokens() -> None:
-    """Remove expired tokens from TOKEN_CACHE."""
+    """Remove expired tokens from TOKEN_CACHE (and idle accounts, stale provider memos)."""
     now = time.time()
-    expired = [k for k, v in _TOKEN_CACHE.items() if v.get("expires_at", 0) - TOKEN_EXPIRY_BUFFER_SECONDS <= now]
-    for k in expired:
-        _TOKEN_CACHE.pop(k, None)
+    for cache in (_TOKEN_CACHE, _TOKEN_LAST_USED, _REFRESH_TOKENS, _PROVIDER_MEMO):
+        cache.expire(now)
 
 
 def _b64url(data: bytes) -> str:
@@ -109,7 +207,7 @@ def _code_challenge_s256(verifier: str) -> str:
 
 
 @app.get("/oauth/authorize")
-def oauth_authorize() -> RedirectResponse:
+async def oauth_authorize() -> RedirectResponse:
     client_id = get_client_id()
     if not client_id:
         raise HTTPException(
@@ -120,13 +218,10 @@ def oauth_authorize() -> RedirectResponse:
     scope = get_outlook_scope()
     redirect_uri = get_oauth_redirect_uri()
 
-    # Cleanup expired states before creating new one
-    _cleanup_expired_states()
-
     state = _b64url(secrets.token_bytes(24))
     verifier = _gen_code_verifier()
     challenge = _code_challenge_s256(verifier)
-    _STATE_STORE[state] = {"verifier": verifier, "ts": time.time()}
+    await get_state_store().set("oauth_state", state, {"verifier": verifier, "ts": time.time()}, STATE_TTL_SECONDS)
 
     auth_url = (
         f"https://login.microsoftonline.com/{tenant}/oauth2/v2.0/authorize"
@@ -153,10 +248,7 @@ async def oauth_callback(request: Request) -> JSONResponse:
     if not code or not state:
         raise HTTPException(status_code=400, detail="missing code/state")
 
-    # Cleanup expired states first
-    _cleanup_expired_states()
-    
-    entry = _STATE_STORE.pop(state, None)
+    entry = await get_state_store().pop("oauth_state", state)
     if not entry:
         raise HTTPException(status_code=400, detail="state_not_found_or_expired")
     
@@ -185,21 +277,20 @@ async def oauth_callback(request: Request) -> JSONResponse:
     if client_secret:
         data["client_secret"] = client_secret
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        try:
-            resp = await client.post(token_url, data=data)
-            resp.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            snippet = (e.response.text or "")[:300].replace("\n", " ")
-            raise HTTPException(status_code=400, detail=f"token_exchange_failed: {snippet}")
-        token_json = resp.json()
-        refresh_token = token_json.get("refresh_token")
-        access_token = token_json.get("access_token")
-        if not refresh_token or not access_token:
-            raise HTTPException(status_code=400, detail="missing_tokens_in_response")
-
-        # Không gọi Graph /me nữa; nếu muốn có email, yêu cầu scope openid profile và đọc id_token.
-        me_email = None
+    try:
+        resp = await get_http_client().post(token_url, data=data)
+        resp.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        snippet = (e.response.text or "")[:300].replace("\n", " ")
+        raise HTTPException(status_code=400, detail=f"token_exchange_failed: {snippet}")
+    token_json = resp.json()
+    refresh_token = token_json.get("refresh_token")
+    access_token = token_json.get("access_token")
+    if not refresh_token or not access_token:
+        raise HTTPException(status_code=400, detail="missing_tokens_in_response")
+
+    # Không gọi Graph /me nữa; nếu muốn có email, yêu cầu scope openid profile và đọc id_token.
+    me_email = None
 
     cred_email = me_email or ""
     cred_string = f"{cred_email}||{refresh_token}|{client_id}"
@@ -217,98 +308,313 @@ async def get_outlook_access_token(email: str, client_id: str, refresh_token: st
     """
     Get access token and detect provider type (graph or imap).
     Returns: (access_token, provider_type)
+
+    Concurrent callers with the same cache key share one in-flight exchange.
     """
     # Cleanup expired tokens before checking cache
     _cleanup_expired_tokens()
     
     now = time.time()
     key = _cache_key(email, client_id, refresh_token)
+    _TOKEN_LAST_USED.put(key, now, now + TOKEN_REFRESH_ACTIVE_SECONDS)
     entry = _TOKEN_CACHE.get(key)
     if entry and entry.get("expires_at", 0) - TOKEN_EXPIRY_BUFFER_SECONDS > now:
         return entry["access_token"], entry.get("provider", "graph")
-    
-    # Try Graph API token exchange first (more common and reliable)
+    # Shielded: a caller that goes away does not cancel the exchange the others are waiting on
+    return await asyncio.shield(_start_token_exchange(key, email, client_id, refresh_token, password))
+
+
+def _start_token_exchange(
+    key: str, email: str, client_id: str, refresh_token: str, password: str | None
+) -> "asyncio.Task[Tuple[str, str]]":
+    """The in-flight exchange for `key`, started if there is none."""
+    task = _TOKEN_INFLIGHT.get(key)
+    if task is None or task.done():
+        task = asyncio.ensure_future(_exchange_access_token(key, email, client_id, refresh_token, password))
+        _TOKEN_INFLIGHT[key] = task
+        task.add_done_callback(lambda t: _token_exchange_done(key, t))
+    return task
+
+
+async def _remember_token(
+    key: str, email: str, client_id: str, refresh_token: str,
+    access_token: str, expires_in: int, provider: str, new_refresh: Optional[str]
+) -> None:
+    now = time.time()
+    entry = {
+        "access_token": access_token,
+        "expires_at": now + int(expires_in),
+        "provider": provider,
+        # What the background refresher needs to renew the token before it expires
+        "email": email,
+        "client_id": client_id,
+        "refresh_token": new_refresh or refresh_token,
+    }
+    _cache_token(key, entry)
+    if new_refresh:
+        _REFRESH_TOKENS.put(key, new_refresh, now + REFRESH_TOKEN_STORE_TTL_SECONDS)
+    # Other workers (and this one after a restart) pick the token up from the shared store
+    try:
+        store = get_state_store()
+        await store.set("token", key, entry, int(expires_in))
+        if new_refresh:
+            await store.set("refresh", key, {"refresh_token": new_refresh}, REFRESH_TOKEN_STORE_TTL_SECONDS)
+    except StateStoreError as e:
+        print(f"State store write failed: {e}")
+
+
+async def _shared_token_state(key: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """(access token entry, newest refresh token) another worker left in the state store."""
+    try:
+        store = get_state_store()
+        entry = await store.get("token", key)
+        refresh = await store.get("refresh", key)
+    except StateStoreError as e:
+        print(f"State store read failed: {e}")
+        return None, None
+    return entry, (refresh or {}).get("refresh_token")
+
+
+def _cache_token(key: str, entry: Dict[str, Any]) -> None:
+    _TOKEN_CACHE.put(key, entry, entry["expires_at"] - TOKEN_EXPIRY_BUFFER_SECONDS)
+
+
+async def refresh_due_tokens(now: Optional[float] = None) -> int:
+    """
+    Renew cached access tokens of recently active accounts that expire within
+    TOKEN_REFRESH_AHEAD_SECONDS. Returns how many exchanges succeeded.
+    """
+    now = time.time() if now is None else now
+    due = [
+        (key, entry) for key, entry in list(_TOKEN_CACHE.items())
+        if now - _TOKEN_LAST_USED.get(key, 0) <= TOKEN_REFRESH_ACTIVE_SECONDS
+        and entry.get("expires_at", 0) - now <= TOKEN_REFRESH_AHEAD_SECONDS
+        and entry.get("client_id") and entry.get("refresh_token")
+    ]
+    # Joins any exchange a request has already started; the password fallback is left to requests
+    tasks = [
+        _start_token_exchange(key, entry["email"], entry["client_id"], entry["refresh_token"], None)
+        for key, entry in due
+    ]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    return sum(1 for r in results if not isinstance(r, BaseException))
+
+
+async def _token_refresher() -> None:
+    while True:
+        await asyncio.sleep(TOKEN_REFRESH_CHECK_SECONDS)
+        try:
+            refreshed = await refresh_due_tokens()
+            if refreshed:
+                print(f"Background token refresh: {refreshed} account(s) renewed")
+        except Exception as e:
+            print(f"Background token refresh failed: {e}")
+
+
+async def _subscription_token(sub: GraphSubscription) -> str:
+    token, _ = await get_outlook_access_token(sub.email, sub.client_id, sub.refresh_token)
+    return token
+
+
+async def _subscription_renewer() -> None:
+    while True:
+        await asyncio.sleep(GRAPH_SUBSCRIPTION_CHECK_SECONDS)
+        try:
+            renewed = await renew_due_subscriptions(_subscription_token)
+            if renewed:
+                print(f"Graph subscriptions renewed: {renewed}")
+        except Exception as e:
+            print(f"Graph subscription renewal failed: {e}")
+
+
+def _token_exchange_done(key: str, task: "asyncio.Task[Tuple[str, str]]") -> None:
+    if _TOKEN_INFLIGHT.get(key) is task:
+        _TOKEN_INFLIGHT.pop(key, None)
+    if not task.cancelled():
+        # Mark the error as retrieved even when every waiter has gone
+        task.exception()
+
+
+async def _exchange_access_token(key: str, email: str, client_id: str, refresh_token: str, password: str | None) -> Tuple[str, str]:
+    """The refresh-token exchange behind get_outlook_access_token; fills _TOKEN_CACHE."""
+    shared, shared_refresh = await _shared_token_state(key)
+    # Newer than ours means another worker already exchanged (or refreshed ahead of expiry)
+    if (
+        shared
+        and shared.get("expires_at", 0) > _TOKEN_CACHE.get(key, {}).get("expires_at", 0)
+        and shared.get("expires_at", 0) - TOKEN_EXPIRY_BUFFER_SECONDS > time.time()
+    ):
+        _cache_token(key, shared)
+        return shared["access_token"], shared.get("provider", "graph")
+    # The newest refresh token issued for this credential, when Microsoft has rotated it
+    refresh_token = _REFRESH_TOKENS.get(key) or shared_refresh or refresh_token
     try:
+        access_token, expires_in, new_refresh, provider = await _exchange_detecting_provider(email, client_id, refresh_token)
+        await _remember_token(key, email, client_id, refresh_token, access_token, expires_in, provider, new_refresh)
+        print(f"Token exchange successful, provider: {provider}")
+        return access_token, provider
+    except _ExchangeFailed as failed:
+        e1, e2 = failed.errors.get("graph"), failed.errors.get("imap")
+        # Check if refresh token expired (specific error codes)
+        error_str = str(e1).lower() + str(e2).lower()
+        is_token_expired = any(err in error_str for err in [
+            "invalid_grant", "aadsts70000", "70000", "expired", "aadsts50173", "50173",
+            "interaction_required", "token has been revoked", "revoked"
+        ])
+
+        print(f"Token expired check: is_expired={is_token_expired}, has_password={password is not None}")
+        print(f"Error string sample: {error_str[:200]}")
+
+        if is_token_expired and password:
+            print(f"Refresh token expired, attempting password-based refresh for {email}...")
+            try:
+                from oauth_refresh import refresh_token_with_password
+                token_data = await refresh_token_with_password(email, password, client_id)
+                new_refresh_token = token_data.get("refresh_token")
+
+                if not new_refresh_token:
+                    raise ValueError("No refresh_token returned from password-based auth")
+
+                print(f"Got new refresh token via password auth, retrying token exchange...")
+
+                # Retry with new refresh token; keep it for credential update
+                access_token, expires_in, rotated, provider = await _exchange_detecting_provider(
+                    email, client_id, new_refresh_token
+                )
+                await _remember_token(
+                    key, email, client_id, new_refresh_token, access_token, expires_in, provider, rotated or new_refresh_token
+                )
+                print(f"Token refresh successful via password fallback, provider: {provider}")
+                return access_token, provider
+
+            except Exception as e_pwd:
+                print(f"Password-based token refresh failed: {e_pwd}")
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Token expired and password refresh failed: {e_pwd}"
+                )
+
+        print(f"Both token exchange methods failed. Graph: {e1}, IMAP: {e2}")
+        raise HTTPException(
+            status_code=400,
+            detail=f"Token exchange failed: Graph error: {e1}, IMAP error: {e2}"
+        )
+
+
+class _ExchangeFailed(Exception):
+    def __init__(self, errors: Dict[str, BaseException]) -> None:
+        super().__init__("; ".join(f"{p}: {e}" for p, e in errors.items()))
+        self.errors = errors
+
+
+def _provider_exchange(provider: str):
+    """Refresh-token exchange against the token scope `provider` detects."""
+    if provider == "graph":
         from .outlook_graph import exchange_refresh_token_graph
-        access_token, expires_in, new_refresh = await exchange_refresh_token_graph(client_id, refresh_token)
-        _TOKEN_CACHE[key] = {
-            "access_token": access_token, 
-            "expires_at": now + int(expires_in),
-            "provider": "graph"
-        }
-        print(f"Token exchange successful via Graph API, provider: graph")
-        return access_token, "graph"
-    except Exception as e1:
-        # Fallback to IMAP token exchange if Graph fails
-        print(f"Graph API token exchange failed: {e1}, trying IMAP...")
+        return exchange_refresh_token_graph
+    return exchange_refresh_token_outlook
+
+
+def _provider_key(email: str, client_id: str) -> str:
+    return f"{(email or '').strip().lower()}|{client_id}"
+
+
+async def _known_provider(memo_key: str) -> Optional[str]:
+    provider = _PROVIDER_MEMO.get(memo_key)
+    if provider:
+        return provider
+    try:
+        shared = await get_state_store().get("provider", memo_key)
+    except StateStoreError:
+        shared = None
+    if shared and shared.get("expires_at", 0) > time.time():
+        _PROVIDER_MEMO.put(memo_key, shared["provider"], shared["expires_at"])
+        return shared["provider"]
+    return None
+
+
+async def _remember_provider(memo_key: str, provider: str) -> None:
+    expires_at = time.time() + PROVIDER_MEMO_TTL_SECONDS
+    known = _PROVIDER_MEMO.get(memo_key)
+    # Sliding TTL; the shared copy is left alone until the provider changes
+    _PROVIDER_MEMO.put(memo_key, provider, expires_at)
+    if known == provider:
+        return
+    try:
+        await get_state_store().set(
+            "provider", memo_key, {"provider": provider, "expires_at": expires_at}, PROVIDER_MEMO_TTL_SECONDS
+        )
+    except StateStoreError as e:
+        print(f"State store write failed: {e}")
+
+
+def _exchanged(task: "asyncio.Future[Any]") -> bool:
+    """The exchange finished and succeeded (not still running, cancelled or failed)."""
+    return task.done() and not task.cancelled() and task.exception() is None
+
+
+async def _exchange_detecting_provider(
+    email: str, client_id: str, refresh_token: str
+) -> Tuple[str, int, Optional[str], str]:
+    """
+    Exchange the refresh token and tell which provider (graph or imap) its scope is for.
+
+    A provider remembered for the account is tried first and the other one only
+    if it fails. Otherwise both exchanges run concurrently. A token scoped for
+    Graph usually works for IMAP too, so Graph wins whenever both succeed: an
+    IMAP success waits up to PROVIDER_RACE_GRAPH_GRACE_SECONDS for Graph's
+    answer. If Graph has not answered by then, IMAP serves this request but is
+    not remembered, and the next exchange races again. Raises _ExchangeFailed
+    when both fail.
+    """
+    memo_key = _provider_key(email, client_id)
+    known = await _known_provider(memo_key)
+    errors: Dict[str, BaseException] = {}
+    remember = True
+    if known:
+        _PROVIDER_STATS["memo_hits"] += 1
+        for provider in (known, "imap" if known == "graph" else "graph"):
+            try:
+                access_token, expires_in, new_refresh = await _provider_exchange(provider)(client_id, refresh_token)
+            except Exception as e:
+                errors[provider] = e
+                continue
+            if provider != known:
+                _PROVIDER_STATS["memo_stale"] += 1
+            break
+        else:
+            raise _ExchangeFailed(errors)
+    else:
+        _PROVIDER_STATS["raced"] += 1
+        graph = asyncio.ensure_future(_provider_exchange("graph")(client_id, refresh_token))
+        imap = asyncio.ensure_future(_provider_exchange("imap")(client_id, refresh_token))
         try:
-            access_token, expires_in, new_refresh = await exchange_refresh_token_outlook(client_id, refresh_token)
-            _TOKEN_CACHE[key] = {
-                "access_token": access_token, 
-                "expires_at": now + int(expires_in),
-                "provider": "imap"
-            }
-            print(f"Token exchange successful via IMAP endpoint, provider: imap")
-            return access_token, "imap"
-        except Exception as e2:
-            # Check if refresh token expired (specific error codes)
-            error_str = str(e1).lower() + str(e2).lower()
-            is_token_expired = any(err in error_str for err in [
-                "invalid_grant", "aadsts70000", "70000", "expired", "aadsts50173", "50173",
-                "interaction_required", "token has been revoked", "revoked"
-            ])
-            
-            print(f"Token expired check: is_expired={is_token_expired}, has_password={password is not None}, password_value={password}")
-            print(f"Error string sample: {error_str[:200]}")
-            
-            if is_token_expired and password:
-                print(f"Refresh token expired, attempting password-based refresh for {email}...")
-                try:
-                    from oauth_refresh import refresh_token_with_password
-                    token_data = await refresh_token_with_password(email, password, client_id)
-                    new_refresh_token = token_data.get("refresh_token")
-                    
-                    if not new_refresh_token:
-                        raise ValueError("No refresh_token returned from password-based auth")
-                    
-                    print(f"Got new refresh token via password auth, retrying token exchange...")
-                    
-                    # Retry with new refresh token
-                    try:
-                        from .outlook_graph import exchange_refresh_token_graph
-                        access_token, expires_in, _ = await exchange_refresh_token_graph(client_id, new_refresh_token)
-                        _TOKEN_CACHE[key] = {
-                            "access_token": access_token,
-                            "expires_at": now + int(expires_in),
-                            "provider": "graph",
-                            "new_refresh_token": new_refresh_token  # Store for credential update
-                        }
-                        print(f"Token refresh successful via password fallback, provider: graph")
-                        return access_token, "graph"
-                    except Exception as e3:
-                        # Try IMAP fallback with new refresh token
-                        access_token, expires_in, _ = await exchange_refresh_token_outlook(client_id, new_refresh_token)
-                        _TOKEN_CACHE[key] = {
-                            "access_token": access_token,
-                            "expires_at": now + int(expires_in),
-                            "provider": "imap",
-                            "new_refresh_token": new_refresh_token  # Store for credential update
-                        }
-                        print(f"Token refresh successful via password fallback, provider: imap")
-                        return access_token, "imap"
-                        
-                except Exception as e_pwd:
-                    print(f"Password-based token refresh failed: {e_pwd}")
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"Token expired and password refresh failed: {e_pwd}"
-                    )
-            
-            print(f"Both token exchange methods failed. Graph: {e1}, IMAP: {e2}")
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Token exchange failed: Graph error: {e1}, IMAP error: {e2}"
-            )
+            await asyncio.wait((graph, imap), return_when=asyncio.FIRST_COMPLETED)
+            if graph.done():
+                if graph.exception() is not None:
+                    await asyncio.wait((imap,))
+            elif imap.exception() is None:
+                await asyncio.wait((graph,), timeout=PROVIDER_RACE_GRAPH_GRACE_SECONDS)
+            else:
+                await asyncio.wait((graph,))
+        finally:
+            graph.cancel()
+            imap.cancel()
+        if _exchanged(graph):
+            provider, winner = "graph", graph
+        elif _exchanged(imap):
+            provider, winner = "imap", imap
+            # Graph may yet have succeeded: only its failure makes IMAP the account's provider
+            remember = graph.done()
+            _PROVIDER_STATS["unsettled"] += not remember
+        else:
+            errors = {name: task.exception() for name, task in (("graph", graph), ("imap", imap))}
+            raise _ExchangeFailed(errors)
+        access_token, expires_in, new_refresh = winner.result()
+    _PROVIDER_STATS[provider] += 1
+    if remember:
+        await _remember_provider(memo_key, provider)
+    return access_token, expires_in, new_refresh, provider
 
 
 def _parse_addresses(h: str | None) -> List[str]:
@@ -322,6 +628,50 @@ def _parse_addresses(h: str | None) -> List[str]:
         return []
 
 
+_ADDRESS_SPECIALS = re.compile(r'[()<>@,;:\\".\[\]]')
+
+
+def _header_text(value: Any) -> str:
+    """Header value with RFC 2047 encoded words decoded, the way listings have always returned it."""
+    return str(make_header(decode_header(value or "")))
+
+
+def _display_address(name: str, addr: str) -> str:
+    """'Name <addr>' with the name decoded, quoted only when it holds RFC 5322 specials."""
+    name = _header_text(name)
+    if not name:
+        return addr
+    if _ADDRESS_SPECIALS.search(name):
+        name = '"' + name.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    return f"{name} <{addr}>" if addr else name
+
+
+def _imap_summary_from_header(msg: pyemail.message.Message) -> Dict[str, Any]:
+    """from_/to/subject/date of an IMAP message from its parsed header."""
+    return {
+        "from_": _header_text(msg.get("From", "")),
+        "to": _parse_addresses(msg.get("To")),
+        "subject": _header_text(msg.get("Subject", "")),
+        "date": msg.get("Date", ""),
+    }
+
+
+def _imap_summary_from_envelope(env: Envelope) -> Dict[str, Any]:
+    """Same fields as _imap_summary_from_header, from a server-parsed ENVELOPE."""
+    if env.from_header:
+        # The raw field keeps the sender's own quoting, which ENVELOPE drops
+        from_ = _header_text(env.from_header)
+    else:
+        name, addr = env.from_[0] if env.from_ else ("", "")
+        from_ = _display_address(name, addr)
+    return {
+        "from_": from_,
+        "to": [a or n for n, a in env.to if a or n],
+        "subject": _header_text(env.subject),
+        "date": env.date,
+    }
+
+
 def _extract_email_content(msg: pyemail.message.Message) -> str:
     """Extract text content from email message, preferring text/plain over HTML."""
     content = ""
@@ -386,12 +736,343 @@ def _sanitize_error_message(error: Exception, is_production: bool = False) -> st
     return f"{ERROR_IMAP}: {type(error).__name__}: {error_msg}"
 
 
+async def _graph_message_details(token: str, email: str, message_id: str) -> Dict[str, Any]:
+    """graph_get_message_details, served from the on-disk mirror when it has the message."""
+    from .outlook_graph import graph_get_message_details
+
+    store = get_mail_store()
+    if store is None:
+        return await graph_get_message_details(token, message_id, text_body=get_graph_text_bodies())
+    mirror = store.graph(email)
+    stored = await mirror.get_async(KIND_GRAPH, [message_id])
+    if message_id in stored:
+        return json.loads(stored[message_id])
+    msg_data = await graph_get_message_details(token, message_id, text_body=get_graph_text_bodies())
+    await mirror.put_async(KIND_GRAPH, {message_id: json.dumps(msg_data).encode()})
+    return msg_data
+
+
+async def _graph_messages_details(token: str, email: str, message_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """graph_get_messages_details for the messages the on-disk mirror does not already have."""
+    from .outlook_graph import graph_get_messages_details
+
+    store = get_mail_store()
+    mirror = store.graph(email) if store is not None else None
+    found = {k: json.loads(v) for k, v in (await mirror.get_async(KIND_GRAPH, message_ids)).items()} if mirror is not None else {}
+    missing = [message_id for message_id in message_ids if message_id not in found]
+    if missing:
+        fetched = await graph_get_messages_details(token, missing, text_body=get_graph_text_bodies())
+        if mirror is not None and fetched:
+            await mirror.put_async(KIND_GRAPH, {k: json.dumps(v).encode() for k, v in fetched.items()})
+        found.update(fetched)
+    return found
+
+
+async def _remember_graph_messages(email: str, messages_data: List[Dict[str, Any]]) -> None:
+    """Listings with bodies (not header-only ones) let listed messages answer /message from disk."""
+    store = get_mail_store()
+    if store is None:
+        return
+    await store.graph(email).put_async(KIND_GRAPH, {
+        m["id"]: json.dumps(m).encode() for m in messages_data if m.get("id") and (m.get("body_text") or m.get("body_html"))
+    })
+
+
+def _graph_content_and_otp(text: str, html: str) -> Tuple[str, Optional[str]]:
+    # Luôn ưu tiên chuyển html sang text nếu có html
+    if html:
+        text_for_otp = html_to_text(html)
+    else:
+        text_for_otp = text
+    # Trường content luôn là text đã chuyển đổi nếu có
+    content = text_for_otp or html or text
+    # Trích xuất OTP từ text đã chuyển đổi
+    otp = extract_otp_from_text(text_for_otp, None)
+    return content, otp
+
+
+def _graph_preview(msg_data: Dict[str, Any]) -> Tuple[str, str, str, Optional[str]]:
+    """(text, html, content, otp) of a listed Graph message."""
+    text = msg_data.get("body_text") or msg_data.get("body_preview") or ""
+    html = msg_data.get("body_html") or ""
+    content, otp = parsed(("graph", message_key(text, html)), lambda: _graph_content_and_otp(text, html))
+    return text, html, content, otp
+
+
+def _graph_needs_full_body(msg_data: Dict[str, Any]) -> bool:
+    text, html, _, otp = _graph_preview(msg_data)
+    # Nếu html chỉ chứa <head> hoặc không có OTP, cần lấy lại full body
+    return not otp or html.strip().lower().startswith("<html><head>") or (not text and not html)
+
+
+def _graph_message_item(
+    msg_data: Dict[str, Any], folder: str, full_msg: Optional[Dict[str, Any]] = None, include_body: bool = True
+) -> EmailMessage:
+    """
+    One /messages item from a converted Graph message, trích xuất OTP nếu có.
+    Without `include_body` the item has no content or html (OTP from bodyPreview only).
+    """
+    text, html, content, otp = _graph_preview(msg_data)
+    # Nội dung đầy đủ (nếu đã lấy lại): thử lại trích xuất OTP
+    if full_msg is not None:
+        text = full_msg.get("body_text") or full_msg.get("body_preview") or text
+        html = full_msg.get("body_html") or html
+        if text and not otp:
+            otp = extract_otp_from_text(text, None)
+        if not otp and html:
+            text_from_html = html_to_text(html)
+            otp = extract_otp_from_text(text_from_html, None)
+    return {
+        "id": msg_data["id"],
+        "from_": msg_data["from"],
+        "to": [msg_data["to"]] if msg_data["to"] else [],
+        "subject": msg_data["subject"],
+        "content": content if include_body else "",
+        "html": html if include_body else "",
+        "date": msg_data["date"],
+        "otp": otp,
+        "folder": folder,
+    }
+
+
+def _graph_has_body(msg_data: Dict[str, Any]) -> bool:
+    return bool(msg_data.get("body_text") or msg_data.get("body_html"))
+
+
+async def _graph_message_items(
+    token: str, email: str, messages: List[Tuple[str, Dict[str, Any]]], include_body: bool
+) -> List[EmailMessage]:
+    """
+    Items for (folder, message) pairs; with `include_body`, the bodies of
+    header-only messages and the full bodies still needed are fetched in one $batch.
+    """
+    details: Dict[str, Dict[str, Any]] = {}
+    if include_body:
+        wanted = [
+            msg_data["id"] for _, msg_data in messages
+            if not _graph_has_body(msg_data) or _graph_needs_full_body(msg_data)
+        ]
+        if wanted:
+            try:
+                details = await _graph_messages_details(token, email, wanted)
+            except Exception:
+                pass
+    return [
+        _graph_message_item(msg_data, folder, details.get(msg_data["id"]), include_body) for folder, msg_data in messages
+    ]
+
+
+def _imap_text_html_otp(body: Buffer) -> Tuple[str, str, Optional[str]]:
+    bmsg = message_from_buffer(body)
+    # Extract both text and html
+    text, html = _extract_email_text_and_html(bmsg)
+    otp = None
+    # OTP extraction logic: prioritize text, fallback to html->text
+    if text:
+        otp = extract_otp_from_text(text, None)
+    if not otp and html:
+        text_from_html = html_to_text(html)
+        otp = extract_otp_from_text(text_from_html, None)
+    return text, html, otp
+
+
+def _imap_message_item(uid: int, env: Envelope, body: Optional[Buffer], include_body: bool, folder: str) -> EmailMessage:
+    """One /messages item from an ENVELOPE row and, with include_body, its raw body."""
+    summary = _imap_summary_from_envelope(env)
+    text = ""
+    html = ""
+    otp = None
+    if include_body and body is not None:
+        text, html, otp = parsed(("imap", message_key(body)), lambda: _imap_text_html_otp(body))
+    return {
+        "id": str(uid),
+        "from_": summary["from_"],
+        "to": summary["to"],
+        "subject": summary["subject"],
+        "content": text if include_body else "",
+        "html": html if include_body else "",
+        "date": summary["date"],
+        "otp": otp,
+        "folder": folder,
+    }
+
+
+# Merge keys: Graph dates are formatted RFC 2822 headers, IMAP rows sort by INTERNALDATE (arrival time)
+_graph_date_key = date_key(pyemail.utils.parsedate_to_datetime)
+_internaldate_key = date_key(lambda value: datetime.strptime(value.strip(), "%d-%b-%Y %H:%M:%S %z"))
+
+
+async def _graph_messages_multi(token: str, email: str, req: MessagesRequest, folders: List[str], size: int) -> PageResult:
+    """One page merged by date across Graph folders; each folder's cursor is a $skip offset."""
+    from .outlook_graph import graph_list_and_convert
+
+    cursors = decode_page_token(req.page_token, folders)
+
+    async def scan(folder: str) -> Tuple[List[Dict[str, Any]], bool]:
+        messages_data, _, _ = await graph_list_and_convert(
+            token,
+            from_filter=req.from_,
+            limit=size,
+            skip_token=None,
+            include_bodies=req.include_body or False,
+            text_bodies=get_graph_text_bodies(),
+            folder=graph_folder(folder),
+            skip=int(cursors[folder] or 0),
+        )
+        # $skip paging has no skiptoken: a full page means there may be more
+        return messages_data, len(messages_data) >= size
+
+    pages = await gather_folders(cursors, scan)
+    taken, used, remaining = merge_pages(pages, size, lambda m: _graph_date_key(m.get("date")))
+    await _remember_graph_messages(email, [msg_data for _, msg_data in taken])
+    items = await _graph_message_items(token, email, taken, req.include_body or False)
+    next_cursors = {folder: str(int(cursors[folder] or 0) + used[folder]) for folder in remaining}
+    return {"items": items, "next_page_token": encode_page_token(next_cursors), "total": None}
+
+
+# Page token of a single-folder Graph listing served from its delta sync state:
+# "delta:<receivedDateTime>|<id>" of the last message shown, also past the synced part
+_DELTA_CURSOR = "delta:"
+
+
+def _graph_order_key(msg_data: Dict[str, Any]) -> Tuple[str, str]:
+    return msg_data.get("received") or "", msg_data["id"]
+
+
+async def _graph_list_before(
+    token: str, folder: str, before: Optional[Tuple[str, str]], limit: int, include_body: bool
+) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Newest-first messages older than the (receivedDateTime, id) key `before`,
+    from a listing filtered by Graph; and whether more follow.
+    """
+    from .outlook_graph import graph_list_and_convert
+
+    until = datetime.fromisoformat(before[0].replace("Z", "+00:00")) if before and before[0] else None
+    # The filter is inclusive: messages of the cursor's second come again and are dropped by key
+    messages_data, next_token, _ = await graph_list_and_convert(
+        token, limit=limit + 1, include_bodies=include_body, text_bodies=get_graph_text_bodies(),
+        folder=folder, until=until
+    )
+    rows = sorted(messages_data, key=_graph_order_key, reverse=True)
+    if before:
+        rows = [m for m in rows if _graph_order_key(m) < before]
+    return rows[:limit], len(rows) > limit or next_token is not None
+
+
+async def _graph_messages_synced(token: str, email: str, req: MessagesRequest, folder: str, size: int) -> PageResult:
+    """
+    One page of a Graph folder from its delta-synced state, newest first. Only
+    changes since the previous sync are transferred; a page reaching below
+    what the state holds whole is completed by a listing filtered below the
+    last message shown, so the cursor stays a (receivedDateTime, id) key.
+    """
+    state = await sync_graph_folder(token, email, graph_folder(folder))
+    before = None
+    if req.page_token:
+        received, _, message_id = req.page_token[len(_DELTA_CURSOR):].partition("|")
+        before = (received, message_id)
+    messages_data, more = state.page(size, before)
+    if not more and len(messages_data) < size:
+        cursor = _graph_order_key(messages_data[-1]) if messages_data else before
+        older, more = await _graph_list_before(
+            token, graph_folder(folder), cursor, size - len(messages_data), req.include_body or False
+        )
+        messages_data = messages_data + older
+    last = messages_data[-1] if messages_data else None
+    next_token = f"{_DELTA_CURSOR}{last['received']}|{last['id']}" if more and last else None
+    await _remember_graph_messages(email, messages_data)
+    items = await _graph_message_items(token, email, [(folder, m) for m in messages_data], req.include_body or False)
+    return {"items": items, "next_page_token": next_token, "total": None}
+
+
+async def _imap_messages_multi(email: str, token: str, req: MessagesRequest, folders: List[str], size: int) -> PageResult:
+    """
+    One page merged by INTERNALDATE across IMAP folders, one pooled session per
+    folder. Each folder's cursor is the last UID shown from it; bodies are only
+    fetched for the rows that made it into the merged page.
+    """
+    cursors = decode_page_token(req.page_token, folders)
+    totals: Dict[str, int] = {}
+
+    async def scan(folder: str) -> Tuple[List[Tuple[int, Envelope]], bool]:
+        rows, next_uid, _, total = await imap_xoauth_list_envelopes_async(
+            email, token, req.from_, size, int(cursors[folder]) if cursors[folder] else None,
+            mailbox=imap_mailbox(folder)
+        )
+        totals[folder] = total
+        return rows, next_uid is not None
+
+    pages = await gather_folders(cursors, scan)
+    taken, _, remaining = merge_pages(pages, size, lambda row: _internaldate_key(row[1].internaldate))
+
+    bodies: Dict[str, Dict[int, Buffer]] = {}
+    if req.include_body and taken:
+        shown = {folder: [uid for f, (uid, _) in taken if f == folder] for folder, _ in taken}
+        bodies = await gather_folders(
+            shown,
+            lambda folder: imap_xoauth_fetch_bodies_async(
+                email, token, shown[folder], req.max_body_bytes, mailbox=imap_mailbox(folder)
+            ),
+        )
+
+    items = [
+        _imap_message_item(uid, env, bodies.get(folder, {}).get(uid), req.include_body or False, folder)
+        for folder, (uid, env) in taken
+    ]
+    next_cursors = {}
+    for folder in remaining:
+        last = [uid for f, (uid, _) in taken if f == folder]
+        next_cursors[folder] = str(last[-1]) if last else cursors[folder]
+    total = sum(totals.values()) if not req.page_token else None
+    return {"items": items, "next_page_token": encode_page_token(next_cursors), "total": total}
+
+
+def _page_prefetch_key(req: MessagesRequest) -> str:
+    return prefetch_key(KIND_PAGE, req.model_dump())
+
+
+def _body_prefetch_key(req: MessageBodyRequest) -> str:
+    return prefetch_key(KIND_BODY, req.credString, req.id, imap_mailbox(req.folder))
+
+
+def _prefetch_after(req: MessagesRequest, page: PageResult) -> None:
+    """Queue the next page and, for header-only pages, the bodies of the newest messages."""
+    jobs = []
+    if page["next_page_token"]:
+        next_req = req.model_copy(update={"page_token": page["next_page_token"]})
+        jobs.append((KIND_PAGE, _page_prefetch_key(next_req), lambda: _messages(next_req)))
+    if not req.include_body:
+        for item in page["items"][:PREFETCH_TOP_BODIES]:
+            body_req = MessageBodyRequest(credString=req.credString, id=item["id"], folder=item.get("folder"))
+            jobs.append((KIND_BODY, _body_prefetch_key(body_req), lambda body_req=body_req: _message_body(body_req)))
+    schedule_prefetch(parse_cred_string(req.credString).email.lower(), jobs)
+
+
 @app.post("/messages")
 async def messages(req: MessagesRequest) -> PageResult:
+    """
+    One page of messages. With PREFETCH=1 it may come from a background
+    prefetch, and the next page and newest bodies are prefetched after it.
+    """
+    if not get_prefetch_enabled():
+        return await _messages(req)
+    page = await take_prefetched(KIND_PAGE, _page_prefetch_key(req))
+    if page is None:
+        page = await _messages(req)
+    _prefetch_after(req, page)
+    return page
+
+
+async def _messages(req: MessagesRequest) -> PageResult:
     creds = parse_cred_string(req.credString)
     provider = select_provider(creds)
     from_filter = req.from_
     size = max(MIN_PAGE_SIZE, min(req.page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+    try:
+        folders = normalize_folders(req.folders)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     if provider == "outlook_graph":
         # Use Microsoft Graph API
@@ -404,6 +1085,11 @@ async def messages(req: MessagesRequest) -> PageResult:
             if detected_provider == "imap":
                 provider = "outlook_imap"
                 # Fall through to IMAP logic below
+            elif len(folders) > 1:
+                return await _graph_messages_multi(token, creds.email, req, folders, size)
+            elif not from_filter and (not req.page_token or req.page_token.startswith(_DELTA_CURSOR)):
+                await _graph_push(token, creds)
+                return await _graph_messages_synced(token, creds.email, req, folders[0], size)
             else:
                 # Get messages via Graph API
                 messages_data, next_token, total_count = await graph_list_and_convert(
@@ -411,57 +1097,15 @@ async def messages(req: MessagesRequest) -> PageResult:
                     from_filter=from_filter,
                     limit=size,
                     skip_token=req.page_token,
-                    include_bodies=req.include_body or False
+                    include_bodies=req.include_body or False,
+                    text_bodies=get_graph_text_bodies(),
+                    folder=graph_folder(folders[0])
+                )
+                await _remember_graph_messages(creds.email, messages_data)
+                # Convert to EmailMessage format
+                items = await _graph_message_items(
+                    token, creds.email, [(folders[0], msg_data) for msg_data in messages_data], req.include_body or False
                 )
-                
-                # Convert to EmailMessage format, trích xuất OTP nếu có
-                from .outlook_graph import graph_get_message_details
-                items: List[EmailMessage] = []
-                for msg_data in messages_data:
-                    text = msg_data.get("body_text") or msg_data.get("body_preview") or ""
-                    html = msg_data.get("body_html") or ""
-                    # Debug: log body_html trước khi chuyển sang text
-                    print(f"[DEBUG] subject={msg_data['subject']}, body_html={repr(html)[:1000] if html else None}")
-                    otp = None
-                    need_full_body = False
-                    # Nếu html chỉ chứa <head> hoặc không có OTP, cần lấy lại full body
-                    if html.strip().lower().startswith("<html><head>") or (not text and not html):
-                        need_full_body = True
-                    # Luôn ưu tiên chuyển html sang text nếu có html
-                    if html:
-                        text_for_otp = html_to_text(html)
-                    else:
-                        text_for_otp = text
-                    # Trường content luôn là text đã chuyển đổi nếu có
-                    content = text_for_otp or html or text
-                    # Trích xuất OTP từ text đã chuyển đổi
-                    otp = extract_otp_from_text(text_for_otp, None)
-                    # Log đúng giá trị text_for_otp sau khi đã chuyển đổi
-                    print(f"[DEBUG] subject={msg_data['subject']}, text_for_otp={repr(text_for_otp)[:300]}, otp={otp}")
-                    # Nếu vẫn chưa có OTP hoặc html nghi ngờ, lấy lại full body
-                    if (not otp or need_full_body) and req.include_body:
-                        try:
-                            full_msg = await graph_get_message_details(token, msg_data["id"])
-                            text = full_msg.get("body_text") or full_msg.get("body_preview") or text
-                            html = full_msg.get("body_html") or html
-                            # Thử lại trích xuất OTP
-                            if text and not otp:
-                                otp = extract_otp_from_text(text, None)
-                            if not otp and html:
-                                text_from_html = html_to_text(html)
-                                otp = extract_otp_from_text(text_from_html, None)
-                        except Exception:
-                            pass
-                    items.append({
-                        "id": msg_data["id"],
-                        "from_": msg_data["from"],
-                        "to": [msg_data["to"]] if msg_data["to"] else [],
-                        "subject": msg_data["subject"],
-                        "content": content,
-                        "html": html,
-                        "date": msg_data["date"],
-                        "otp": otp,
-                    })
                 return {
                     "items": items,
                     "next_page_token": next_token,
@@ -474,6 +1118,8 @@ async def messages(req: MessagesRequest) -> PageResult:
     if provider == "outlook_imap":
         try:
             token, _ = await get_outlook_access_token(creds.email, creds.client_id or "", creds.refresh_token or "", creds.password)
+            if len(folders) > 1:
+                return await _imap_messages_multi(creds.email, token, req, folders, size)
             # Use optimized function that reuses IMAP connection
             page_token_int = None
             if req.page_token:
@@ -481,40 +1127,15 @@ async def messages(req: MessagesRequest) -> PageResult:
                     page_token_int = int(req.page_token)
                 except (ValueError, TypeError):
                     page_token_int = None
-            raw, next_uid, bodies_map, total_count = imap_xoauth_list_and_bodies(
-                creds.email, token, from_filter, size, page_token_int, req.include_body
+            # ENVELOPE rows: the server has already parsed From/To/Subject/Date
+            rows, next_uid, bodies_map, total_count = await imap_xoauth_list_envelopes_async(
+                creds.email, token, from_filter, size, page_token_int, req.include_body, req.max_body_bytes,
+                mailbox=imap_mailbox(folders[0])
             )
-            items: List[EmailMessage] = []
-
-            for uid, header_bytes in raw:
-                msg = pyemail.message_from_bytes(header_bytes)
-                from_raw = str(make_header(decode_header(msg.get("From", ""))))
-                to_list = _parse_addresses(msg.get("To"))
-                subject = str(make_header(decode_header(msg.get("Subject", ""))))
-                date = msg.get("Date", "")
-                text = ""
-                html = ""
-                otp = None
-                if req.include_body and uid in bodies_map:
-                    bmsg = pyemail.message_from_bytes(bodies_map[uid])
-                    # Extract both text and html
-                    text, html = _extract_email_text_and_html(bmsg)
-                    # OTP extraction logic: prioritize text, fallback to html->text
-                    if text:
-                        otp = extract_otp_from_text(text, None)
-                    if not otp and html:
-                        text_from_html = html_to_text(html)
-                        otp = extract_otp_from_text(text_from_html, None)
-                items.append({
-                    "id": str(uid),
-                    "from_": from_raw,
-                    "to": to_list,
-                    "subject": subject,
-                    "content": text if req.include_body else "",
-                    "html": html if req.include_body else "",
-                    "date": date,
-                    "otp": otp,
-                })
+            items = [
+                _imap_message_item(uid, env, bodies_map.get(uid), req.include_body or False, folders[0])
+                for uid, env in rows
+            ]
             return {"items": items, "next_page_token": str(next_uid) if next_uid else None, "total": total_count if page_token_int is None else None}
         except Exception as e:
             detail = _sanitize_error_message(e, not is_development())
@@ -523,18 +1144,128 @@ async def messages(req: MessagesRequest) -> PageResult:
     raise HTTPException(status_code=400, detail=ERROR_INVALID_CREDENTIALS)
 
 
+def _graph_otp_from_body(text: str, html: str, regex: Optional[str]) -> Optional[str]:
+    # Ưu tiên trích xuất OTP từ text
+    found = extract_otp_from_text(text, regex)
+    # Nếu không có, thử convert từ html sang text và trích xuất lại
+    if not found and html:
+        text_from_html = html_to_text(html)
+        found = extract_otp_from_text(text_from_html, regex)
+    return found
+
+
+def _graph_otp_from_messages(messages_data: List[Dict[str, Any]], regex: Optional[str], since: datetime) -> Optional[Dict[str, Any]]:
+    """First OTP found in Graph messages (newest first) received at or after `since`."""
+    for msg_data in messages_data:
+        date_str = msg_data.get("date", "")
+        # receivedDateTime when the message carries it, else the formatted Date
+        received = parse_mail_date(msg_data.get("received") or date_str)
+        if received is None or received < since:
+            continue
+
+        # Lấy text và html
+        text = msg_data.get("body_text") or msg_data.get("body_preview") or ""
+        html = msg_data.get("body_html") or ""
+
+        # A custom regex is part of the cache key
+        found = parsed(("graph-otp", message_key(text, html), regex), lambda: _graph_otp_from_body(text, html, regex))
+
+        if found:
+            return {
+                "otp": found,
+                "from": msg_data["from"],
+                "subject": msg_data["subject"],
+                "date": date_str,
+            }
+    return None
+
+
+async def _graph_push(token: str, creds: Any) -> None:
+    """Subscribe the account's inbox to change notifications, when GRAPH_NOTIFICATION_URL is set."""
+    notification_url = get_graph_notification_url()
+    if notification_url:
+        await ensure_graph_subscription(
+            token, creds.email, notification_url, creds.client_id or "", creds.refresh_token or ""
+        )
+
+
+async def _graph_recent_messages(
+    token: str, email: str, from_filter: Optional[str], folder: str = "inbox",
+    since: Optional[datetime] = None, keep_synced: bool = True
+) -> List[Dict[str, Any]]:
+    """
+    Newest messages of a folder received at or after `since`, with bodies,
+    from its delta-synced state: a poll only transfers what changed, and
+    bodies are fetched once per message. Without `keep_synced`, a folder not
+    synced yet is read with a listing filtered by Graph to the window
+    instead, so only messages inside it are downloaded; so is a folder whose
+    sync has pages left.
+    """
+    from .outlook_graph import graph_list_and_convert
+
+    state = get_graph_sync_state(email, graph_folder(folder))
+    if keep_synced or state is not None or since is None:
+        state = await sync_graph_folder(token, email, graph_folder(folder))
+    # A sync that has pages left may not hold the newest messages yet
+    if since is not None and (state is None or not state.complete):
+        messages_data, _, _ = await graph_list_and_convert(
+            token, from_filter=from_filter, limit=DEFAULT_OTP_TOP_EMAILS, include_bodies=True,
+            text_bodies=get_graph_text_bodies(), folder=graph_folder(folder), since=since
+        )
+        return messages_data
+    messages_data = state.page(DEFAULT_OTP_TOP_EMAILS, None, from_filter, since)[0]
+    missing = [m["id"] for m in messages_data if not _graph_has_body(m)]
+    if missing:
+        try:
+            state.fill_bodies(await _graph_messages_details(token, email, missing))
+        except Exception as e:
+            # The bodyPreview still goes through the OTP search
+            print(f"Graph bodies of {len(missing)} message(s) not fetched: {e}")
+    return messages_data
+
+
+def _imap_otp_from_body(body: Buffer, regex: Optional[str]) -> Tuple[str, str, Optional[str]]:
+    msg = message_from_buffer(body)
+    subject = msg.get("Subject", "")
+    date = msg.get("Date", "")
+    # Lấy text content
+    text = _extract_email_content(msg)
+    return subject, date, extract_otp_from_text(text, regex)
+
+
+def _imap_otp_from_bodies(
+    rows: List[Tuple[int, Optional[datetime]]], bodies_map: Dict[int, Buffer], regex: Optional[str], since: datetime
+) -> Optional[Dict[str, Any]]:
+    """
+    First OTP found in raw IMAP bodies, checked in the given (uid, arrival) order.
+    Messages without a known arrival time are placed by their Date header.
+    """
+    for uid, arrived in rows:
+        if uid not in bodies_map:
+            continue
+        body_bytes = bodies_map[uid]
+        # A custom regex is part of the cache key
+        subject, date, code = parsed(("imap-otp", message_key(body_bytes), regex), lambda: _imap_otp_from_body(body_bytes, regex))
+        when = arrived or parse_mail_date(date)
+        if code and (when is None or when >= since):
+            return {"otp": code, "emailId": str(uid), "subject": subject, "date": date}
+    return None
+
+
 @app.post("/otp")
 async def otp(req: OtpRequest) -> Dict[str, Any]:
     creds = parse_cred_string(req.credString)
     provider = select_provider(creds)
     from_filter = req.from_
-    time_window = req.time_window_minutes or DEFAULT_TIME_WINDOW_MINUTES
+    since = window_start(req.time_window_minutes or DEFAULT_TIME_WINDOW_MINUTES)
+    try:
+        folders = normalize_folders(req.folders)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     if provider == "outlook_graph":
         # Use Microsoft Graph API
         try:
-            from .outlook_graph import graph_list_and_convert
-            
             token, detected_provider = await get_outlook_access_token(creds.email, creds.client_id or "", creds.refresh_token or "", creds.password)
             
             # If detected provider is IMAP, switch to IMAP logic
@@ -542,54 +1273,15 @@ async def otp(req: OtpRequest) -> Dict[str, Any]:
                 provider = "outlook_imap"
                 # Fall through to IMAP logic below
             else:
-                # Get recent messages
-                messages_data, _, _ = await graph_list_and_convert(
-                    token,
-                    from_filter=from_filter,
-                    limit=DEFAULT_OTP_TOP_EMAILS,
-                    skip_token=None,
-                    include_bodies=True
-                )
-                
-                if not messages_data:
-                    return {"otp": None}
-                
-                # Extract OTP from messages
-                import logging
-                for idx, msg_data in enumerate(messages_data):
-                    logging.warning(f"[OTP DEBUG] Mail {idx+1}: subject={msg_data.get('subject')}")
-                    logging.warning(f"[OTP DEBUG] body_text={repr(msg_data.get('body_text'))}")
-                    logging.warning(f"[OTP DEBUG] body_html={repr(msg_data.get('body_html'))}")
-                    # Get date
-                    date_str = msg_data.get("date", "")
-                    try:
-                        # Parse email date format
-                        import email.utils
-                        dt_tuple = email.utils.parsedate_to_datetime(date_str)
-                        if not within_window(dt_tuple, time_window):
-                            continue
-                    except:
-                        continue
-
-                    # Lấy text và html
-                    text = msg_data.get("body_text") or msg_data.get("body_preview") or ""
-                    html = msg_data.get("body_html") or ""
-
-                    # Ưu tiên trích xuất OTP từ text
-                    found = extract_otp_from_text(text, req.regex)
-                    # Nếu không có, thử convert từ html sang text và trích xuất lại
-                    if not found and html:
-                        text_from_html = html_to_text(html)
-                        found = extract_otp_from_text(text_from_html, req.regex)
+                # Recent messages of every folder at once; the first folder with a code wins
+                async def scan_graph(folder: str) -> Optional[Dict[str, Any]]:
+                    messages_data = await _graph_recent_messages(
+                        token, creds.email, from_filter, folder, since=since, keep_synced=False
+                    )
+                    found = _graph_otp_from_messages(messages_data, req.regex, since)
+                    return {**found, "folder": folder} if found else None
 
-                    if found:
-                        return {
-                            "otp": found,
-                            "from": msg_data["from"],
-                            "subject": msg_data["subject"],
-                            "date": date_str,
-                        }
-                return {"otp": None}
+                return await first_found(folders, scan_graph) or {"otp": None}
         except Exception as e:
             detail = _sanitize_error_message(e, not is_development())
             raise HTTPException(status_code=400, detail=detail)
@@ -597,28 +1289,18 @@ async def otp(req: OtpRequest) -> Dict[str, Any]:
     if provider == "outlook_imap":
         try:
             token, _ = await get_outlook_access_token(creds.email, creds.client_id or "", creds.refresh_token or "", creds.password)
-            # Optimize: Use batch fetch instead of individual calls
-            raw, _ = imap_xoauth_list(creds.email, token, from_filter, DEFAULT_OTP_TOP_EMAILS, None)
-            if not raw:
-                return {"otp": None}
-            
-            # Batch fetch bodies in one connection
-            uids = [uid for uid, _ in raw]
-            bodies_map = imap_xoauth_fetch_bodies(creds.email, token, uids)
-            
-            for uid, _hdr in raw:
-                if uid not in bodies_map:
-                    continue
-                body_bytes = bodies_map[uid]
-                msg = pyemail.message_from_bytes(body_bytes)
-                subject = msg.get("Subject", "")
-                date = msg.get("Date", "")
-                # Lấy text content
-                text = _extract_email_content(msg)
-                code = extract_otp_from_text(text, req.regex)
-                if code and (not date or within_window(date, time_window)):
-                    return {"otp": code, "emailId": str(uid), "subject": subject, "date": date}
-            return {"otp": None}
+
+            async def scan_imap(folder: str) -> Optional[Dict[str, Any]]:
+                # Only the newest messages inside the window are downloaded
+                rows, bodies_map = await imap_xoauth_recent_bodies_async(
+                    creds.email, token, from_filter, since, DEFAULT_OTP_TOP_EMAILS, req.max_body_bytes,
+                    mailbox=imap_mailbox(folder)
+                )
+                found = _imap_otp_from_bodies(rows, bodies_map, req.regex, since)
+                return {**found, "folder": folder} if found else None
+
+            # One selected session per folder; the first folder with a code wins
+            return await first_found(folders, scan_imap) or {"otp": None}
         except Exception as e:
             detail = _sanitize_error_message(e, not is_development())
             raise HTTPException(status_code=400, detail=detail)
@@ -626,16 +1308,134 @@ async def otp(req: OtpRequest) -> Dict[str, Any]:
     raise HTTPException(status_code=400, detail=ERROR_INVALID_CREDENTIALS)
 
 
+async def _otp_wait_events(req: OtpWaitRequest) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Wait for an OTP to land. Yields {"event": "ping"} keepalives, then exactly one
+    {"event": "otp", ...} or {"event": "timeout", "otp": None}.
+
+    IMAP holds one IDLE session per folder and only fetches UIDs that arrive;
+    Graph has no IDLE, so it polls every folder every OTP_WAIT_POLL_SECONDS,
+    and at once when a change notification arrives for the inbox (with
+    GRAPH_NOTIFICATION_URL set).
+    """
+    creds = parse_cred_string(req.credString)
+    if select_provider(creds) == "invalid":
+        raise HTTPException(status_code=400, detail=ERROR_INVALID_CREDENTIALS)
+    try:
+        folders = normalize_folders(req.folders)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    since = window_start(req.time_window_minutes or DEFAULT_TIME_WINDOW_MINUTES)
+    timeout = req.timeout_seconds or DEFAULT_OTP_WAIT_SECONDS
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    token, detected_provider = await get_outlook_access_token(creds.email, creds.client_id or "", creds.refresh_token or "", creds.password)
+    if detected_provider == "imap":
+        initial = 0 if req.only_new else DEFAULT_OTP_TOP_EMAILS
+
+        async def folder_events(folder: str) -> AsyncIterator[Dict[str, Any]]:
+            watch = imap_xoauth_watch_bodies_async(
+                creds.email, token, req.from_, timeout, initial,
+                max_body_bytes=req.max_body_bytes, mailbox=imap_mailbox(folder), since=since
+            )
+            async with aclosing(watch) as batches:
+                async for bodies_map in batches:
+                    if not bodies_map:
+                        yield {"event": "ping"}
+                        continue
+                    rows = [(uid, None) for uid in sorted(bodies_map, reverse=True)]
+                    found = _imap_otp_from_bodies(rows, bodies_map, req.regex, since)
+                    if found:
+                        yield {"event": "otp", **found, "folder": folder}
+                        return
+
+        # Closing the merged stream on the first code cancels the other folders' IDLE sessions
+        async with aclosing(merge_streams([folder_events(folder) for folder in folders])) as events:
+            async for event in events:
+                yield event
+                if event["event"] == "otp":
+                    return
+    else:
+        await _graph_push(token, creds)
+        seen: Optional[set] = None
+        while True:
+            pages = await gather_folders(folders, lambda folder: _graph_recent_messages(token, creds.email, req.from_, folder, since=since))
+            if req.only_new and seen is None:
+                seen = {m.get("id") for messages_data in pages.values() for m in messages_data}
+            else:
+                for folder, messages_data in pages.items():
+                    fresh = [m for m in messages_data if m.get("id") not in (seen or ())]
+                    found = _graph_otp_from_messages(fresh, req.regex, since)
+                    if found:
+                        yield {"event": "otp", **found, "folder": folder}
+                        return
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            # Woken early by a change notification for the inbox, when subscribed
+            await wait_for_graph_mail(creds.email, min(OTP_WAIT_POLL_SECONDS, remaining))
+            yield {"event": "ping"}
+    yield {"event": "timeout", "otp": None}
+
+
+@app.post("/otp/wait")
+async def otp_wait(req: OtpWaitRequest) -> Dict[str, Any]:
+    """Long-poll variant of /otp: returns as soon as a code arrives, or {"otp": null} on timeout."""
+    try:
+        async for event in _otp_wait_events(req):
+            if event["event"] != "ping":
+                return {k: v for k, v in event.items() if k != "event"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        detail = _sanitize_error_message(e, not is_development())
+        raise HTTPException(status_code=400, detail=detail)
+    return {"otp": None}
+
+
+@app.post("/otp/stream")
+async def otp_stream(req: OtpWaitRequest) -> StreamingResponse:
+    """Server-Sent Events variant of /otp/wait (events: otp, timeout, error; comments as keepalive)."""
+
+    async def events() -> AsyncIterator[str]:
+        yield ": waiting\n\n"
+        try:
+            async for event in _otp_wait_events(req):
+                name = event.pop("event")
+                if name == "ping":
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {name}\ndata: {json.dumps(event)}\n\n"
+        except HTTPException as e:
+            yield f"event: error\ndata: {json.dumps({'detail': e.detail})}\n\n"
+        except Exception as e:
+            detail = _sanitize_error_message(e, not is_development())
+            yield f"event: error\ndata: {json.dumps({'detail': detail})}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.post("/message")
 async def message_body(req: MessageBodyRequest) -> Dict[str, Any]:
+    if get_prefetch_enabled():
+        prefetched = await take_prefetched(KIND_BODY, _body_prefetch_key(req))
+        if prefetched is not None:
+            return prefetched
+    return await _message_body(req)
+
+
+async def _message_body(req: MessageBodyRequest) -> Dict[str, Any]:
     creds = parse_cred_string(req.credString)
     provider = select_provider(creds)
     
     if provider == "outlook_graph":
         # Use Microsoft Graph API
         try:
-            from .outlook_graph import graph_get_message_details
-            
             token, detected_provider = await get_outlook_access_token(creds.email, creds.client_id or "", creds.refresh_token or "", creds.password)
             
             # If detected provider is IMAP, switch to IMAP logic
@@ -643,8 +1443,8 @@ async def message_body(req: MessageBodyRequest) -> Dict[str, Any]:
                 provider = "outlook_imap"
                 # Fall through to IMAP logic below
             else:
-                # Get message details
-                msg_data = await graph_get_message_details(token, req.id)
+                # Get message details (from the local mirror when it has them)
+                msg_data = await _graph_message_details(token, creds.email, req.id)
                 
                 return {
                     "id": req.id,
@@ -662,11 +1462,10 @@ async def message_body(req: MessageBodyRequest) -> Dict[str, Any]:
     if provider == "outlook_imap":
         try:
             token, _ = await get_outlook_access_token(creds.email, creds.client_id or "", creds.refresh_token or "", creds.password)
-            body_bytes = imap_xoauth_get_body(creds.email, token, int(req.id))
-            msg = pyemail.message_from_bytes(body_bytes)
-            subject = str(make_header(decode_header(msg.get("Subject", ""))))
-            date = msg.get("Date", "")
-            from_raw = str(make_header(decode_header(msg.get("From", ""))))
+            body_bytes = await imap_xoauth_get_body_async(creds.email, token, int(req.id), imap_mailbox(req.folder))
+            msg = message_from_buffer(body_bytes)
+            summary = _imap_summary_from_header(msg)
+            subject, date, from_raw = summary["subject"], summary["date"], summary["from_"]
             to_raw = msg.get("To", "") or ""
             # Extract text and html using shared function
             text, html = _extract_email_text_and_html(msg)
@@ -678,6 +1477,86 @@ async def message_body(req: MessageBodyRequest) -> Dict[str, Any]:
     raise HTTPException(status_code=400, detail=ERROR_INVALID_CREDENTIALS)
 
 
+@app.post("/graph/notifications")
+async def graph_notifications(request: Request) -> Any:
+    """
+    Webhook for Graph change notifications. Answers the validation request
+    of a new subscription by echoing its token; notifications are queued and
+    acknowledged at once, since Graph expects an answer within seconds.
+    """
+    validation_token = request.query_params.get("validationToken")
+    if validation_token is not None:
+        return PlainTextResponse(validation_token)
+    try:
+        payload = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid notification payload")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="Invalid notification payload")
+    accept_graph_notifications(payload)
+    return JSONResponse(status_code=202, content=None)
+
+
+@app.post("/graph/subscribe")
+async def graph_subscribe(req: PurgeRequest) -> Dict[str, Any]:
+    """Subscribe the account's inbox to change notifications ahead of its first request."""
+    creds = parse_cred_string(req.credString)
+    notification_url = get_graph_notification_url()
+    if select_provider(creds) == "invalid":
+        raise HTTPException(status_code=400, detail=ERROR_INVALID_CREDENTIALS)
+    if not notification_url:
+        raise HTTPException(status_code=400, detail="GRAPH_NOTIFICATION_URL is not set")
+    token, detected_provider = await get_outlook_access_token(creds.email, creds.client_id or "", creds.refresh_token or "", creds.password)
+    if detected_provider == "imap":
+        raise HTTPException(status_code=400, detail="Change notifications need a Graph token")
+    sub = await ensure_graph_subscription(
+        token, creds.email, notification_url, creds.client_id or "", creds.refresh_token or ""
+    )
+    if sub is None:
+        return {"subscribed": False}
+    return {"subscribed": True, "expires_at": datetime.fromtimestamp(sub.expires_at).astimezone().isoformat()}
+
+
+@app.post("/graph/unsubscribe")
+async def graph_unsubscribe(req: PurgeRequest) -> Dict[str, Any]:
+    """Delete the account's subscription; with GRAPH_NOTIFICATION_URL set, its next request subscribes again."""
+    creds = parse_cred_string(req.credString)
+    if select_provider(creds) == "invalid":
+        raise HTTPException(status_code=400, detail=ERROR_INVALID_CREDENTIALS)
+    token, _ = await get_outlook_access_token(creds.email, creds.client_id or "", creds.refresh_token or "", creds.password)
+    try:
+        return {"unsubscribed": await remove_graph_subscription(token, creds.email)}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=_sanitize_error_message(e, not is_development()))
+
+
+@app.post("/store/purge")
+async def store_purge(req: PurgeRequest) -> Dict[str, Any]:
+    """Drop everything the local mail mirror holds for the account."""
+    creds = parse_cred_string(req.credString)
+    if select_provider(creds) == "invalid":
+        raise HTTPException(status_code=400, detail=ERROR_INVALID_CREDENTIALS)
+    store = get_mail_store()
+    return {"purged": await asyncio.to_thread(store.purge_account, creds.email) if store is not None else 0}
+
+
+@app.post("/token/refresh-token")
+async def current_refresh_token(req: PurgeRequest) -> Dict[str, Any]:
+    """
+    The credString with the newest refresh token Microsoft issued for it, so
+    clients can persist the rotated token before the old one stops working.
+    """
+    creds = parse_cred_string(req.credString)
+    if select_provider(creds) == "invalid":
+        raise HTTPException(status_code=400, detail=ERROR_INVALID_CREDENTIALS)
+    key = _cache_key(creds.email, creds.client_id, creds.refresh_token)
+    rotated = _REFRESH_TOKENS.get(key) or (await _shared_token_state(key))[1]
+    if rotated and rotated != creds.refresh_token:
+        creds.refresh_token = rotated
+        return {"credString": format_cred_string(creds), "rotated": True}
+    return {"credString": req.credString, "rotated": False}
+
+
 if __name__ == "__main__":
     import uvicorn
 
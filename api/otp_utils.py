@@ -1,6 +1,7 @@
 import re
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from email.utils import parsedate_to_datetime
+from typing import Optional, Union
 
 from bs4 import BeautifulSoup
 
@@ -168,12 +169,31 @@ def extract_otp_from_text(text: str, regex: Optional[str]) -> Optional[str]:
     return None
 
 
-def within_window(date_iso: str, minutes: int) -> bool:
+def parse_mail_date(value: str) -> Optional[datetime]:
+    """Timezone-aware datetime from an ISO 8601 (Graph) or RFC 2822 (Date header) timestamp, None if unparseable."""
+    if not value:
+        return None
     try:
         # Graph uses ISO 8601
-        dt = datetime.fromisoformat(date_iso.replace("Z", "+00:00"))
-    except Exception:
-        return True
-    now = datetime.now(timezone.utc)
-    return now - dt <= timedelta(minutes=minutes)
+        dt = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except ValueError:
+        try:
+            dt = parsedate_to_datetime(value)
+        except (TypeError, ValueError, IndexError):
+            return None
+    # Naive timestamps are taken as UTC
+    return dt if dt.tzinfo is not None else dt.replace(tzinfo=timezone.utc)
 
+
+def window_start(minutes: int, now: Optional[datetime] = None) -> datetime:
+    """Oldest arrival time inside a window of `minutes` ending now."""
+    return (now or datetime.now(timezone.utc)) - timedelta(minutes=minutes)
+
+
+def within_window(when: Union[datetime, str], minutes: int) -> bool:
+    dt = when if isinstance(when, datetime) else parse_mail_date(when)
+    if dt is None:
+        return True
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt >= window_start(minutes)
@@ -4,15 +4,21 @@ Alternative to IMAP that works with Mail.Read scope
 """
 from __future__ import annotations
 
+import asyncio
 import base64
 import re
+import urllib.parse
 from typing import List, Optional, Tuple, Dict
 from datetime import datetime, timezone
 import email as pyemail
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
-import httpx
+GRAPH_BATCH_URL = "https://graph.microsoft.com/v1.0/$batch"
+
+_DETAIL_SELECT = "id,subject,from,toRecipients,receivedDateTime,body,hasAttachments,isRead,internetMessageId"
+# Listings that do not show bodies: bodyPreview is a short text excerpt, no HTML to download or parse
+_HEADER_SELECT = "id,subject,from,toRecipients,receivedDateTime,bodyPreview,hasAttachments,isRead,internetMessageId"
 
 
 async def exchange_refresh_token_graph(client_id: str, refresh_token: str):
@@ -35,32 +41,44 @@ async def exchange_refresh_token_graph(client_id: str, refresh_token: str):
     if client_secret:
         data["client_secret"] = client_secret
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.post(token_url, data=data)
-        print(f"Token exchange status: {resp.status_code}")
-        if resp.status_code >= 400:
-            error_body = resp.text
-            print(f"Token exchange error: {error_body}")
-            # Raise error with body included for better error detection
-            raise RuntimeError(f"Token exchange failed: {resp.status_code} - {error_body}")
-        js = resp.json()
-        access_token = js.get("access_token")
-        if not access_token:
-            raise RuntimeError("No access_token for Graph API")
-        print(f"Token exchange successful, access_token length: {len(access_token)}")
-        expires_in = js.get("expires_in") or 3600
-        new_refresh = js.get("refresh_token")
-        return access_token, int(expires_in), new_refresh
+    from .http_client import get_http_client
+
+    resp = await get_http_client().post(token_url, data=data)
+    print(f"Token exchange status: {resp.status_code}")
+    if resp.status_code >= 400:
+        error_body = resp.text
+        print(f"Token exchange error: {error_body}")
+        # Raise error with body included for better error detection
+        raise RuntimeError(f"Token exchange failed: {resp.status_code} - {error_body}")
+    js = resp.json()
+    access_token = js.get("access_token")
+    if not access_token:
+        raise RuntimeError("No access_token for Graph API")
+    print(f"Token exchange successful, access_token length: {len(access_token)}")
+    expires_in = js.get("expires_in") or 3600
+    new_refresh = js.get("refresh_token")
+    return access_token, int(expires_in), new_refresh
 
 
 async def graph_list_messages(
     access_token: str,
     from_filter: Optional[str] = None,
     limit: int = 10,
-    skip_token: Optional[str] = None
+    skip_token: Optional[str] = None,
+    folder: str = "inbox",
+    skip: Optional[int] = None,
+    include_body: bool = True,
+    text_body: bool = False,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
 ) -> Tuple[List[Dict], Optional[str]]:
     """
-    List messages from inbox using Microsoft Graph API.
+    List messages from a mail folder (well-known name or folder id) using Microsoft Graph API.
+    `skip` is an offset for callers that page several folders side by side.
+    Without `include_body` only headers and bodyPreview are selected; with
+    `text_body` Graph returns bodies as plain text instead of HTML. `since`
+    and `until` (timezone-aware, both inclusive) keep the listing to messages
+    received within them.
     
     Returns:
         - List of message objects with headers
@@ -69,54 +87,63 @@ async def graph_list_messages(
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json",
+        "Prefer": _prefer(text_body),
     }
     
     # Build URL
-    url = "https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages"
+    url = f"https://graph.microsoft.com/v1.0/me/mailFolders/{folder}/messages"
     
     # Build query parameters
     params = {
         "$top": min(limit, 50),  # Graph API max is 999, but we limit to 50
-        # Thêm body vào $select để lấy nội dung mail
-        "$select": "id,subject,from,toRecipients,receivedDateTime,body,hasAttachments,isRead,internetMessageId",
+        # Thêm body vào $select để lấy nội dung mail (chỉ khi cần)
+        "$select": _DETAIL_SELECT if include_body else _HEADER_SELECT,
     }
     
-    # Only add $orderby if no filter (Microsoft Graph limitation for MSA accounts)
-    if not from_filter:
-        params["$orderby"] = "receivedDateTime desc"
-    
+    filters = []
+    if since is not None:
+        filters.append(f"receivedDateTime ge {_graph_datetime(since)}")
+    if until is not None:
+        filters.append(f"receivedDateTime le {_graph_datetime(until)}")
     if from_filter:
         # Filter by sender email
-        # Note: For MSA accounts, filter + orderby together causes "InefficientFilter" error
-        # So we filter only, and sort client-side if needed
-        params["$filter"] = f"from/emailAddress/address eq '{from_filter}'"
+        filters.append(f"from/emailAddress/address eq '{from_filter}'")
+    if filters:
+        params["$filter"] = " and ".join(filters)
+    
+    # Note: For MSA accounts, filter + orderby together causes "InefficientFilter" error
+    # unless the $orderby property leads the $filter; otherwise sort client-side
+    if not from_filter or since is not None or until is not None:
+        params["$orderby"] = "receivedDateTime desc"
     
     if skip_token:
         params["$skiptoken"] = skip_token
+    elif skip:
+        params["$skip"] = skip
     
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.get(url, headers=headers, params=params)
-        print(f"Graph API request URL: {resp.url}")
-        print(f"Graph API status: {resp.status_code}")
-        if resp.status_code >= 400:
-            print(f"Graph API error response: {resp.text}")
-        resp.raise_for_status()
-        
-        result = resp.json()
-        messages = result.get("value", [])
-        
-        # Extract next skip token from @odata.nextLink
-        next_link = result.get("@odata.nextLink")
-        next_skip_token = None
-        if next_link:
-            # Extract skiptoken parameter
-            import urllib.parse
-            parsed = urllib.parse.urlparse(next_link)
-            query_params = urllib.parse.parse_qs(parsed.query)
-            if "$skiptoken" in query_params:
-                next_skip_token = query_params["$skiptoken"][0]
-        
-        return messages, next_skip_token
+    from .graph_scheduler import graph_request
+
+    resp = await graph_request("GET", url, access_token, headers=headers, params=params)
+    print(f"Graph API request URL: {resp.url}")
+    print(f"Graph API status: {resp.status_code}")
+    if resp.status_code >= 400:
+        print(f"Graph API error response: {resp.text}")
+    resp.raise_for_status()
+    
+    result = resp.json()
+    messages = result.get("value", [])
+    
+    # Extract next skip token from @odata.nextLink
+    next_link = result.get("@odata.nextLink")
+    next_skip_token = None
+    if next_link:
+        # Extract skiptoken parameter
+        parsed = urllib.parse.urlparse(next_link)
+        query_params = urllib.parse.parse_qs(parsed.query)
+        if "$skiptoken" in query_params:
+            next_skip_token = query_params["$skiptoken"][0]
+    
+    return messages, next_skip_token
 
 
 async def graph_get_message_body(access_token: str, message_id: str) -> str:
@@ -130,10 +157,11 @@ async def graph_get_message_body(access_token: str, message_id: str) -> str:
     # Get MIME content
     url = f"https://graph.microsoft.com/v1.0/me/messages/{message_id}/$value"
     
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.get(url, headers=headers)
-        resp.raise_for_status()
-        return resp.text
+    from .graph_scheduler import graph_request
+
+    resp = await graph_request("GET", url, access_token, headers=headers)
+    resp.raise_for_status()
+    return resp.text
 
 
 def _parse_graph_message_to_email_message(msg: Dict) -> Dict:
@@ -181,7 +209,9 @@ def _parse_graph_message_to_email_message(msg: Dict) -> Dict:
         "to": to_header,
         "subject": subject,
         "date": date_header,
-        "body_preview": body_content[:200] if body_content else "",
+        "received": received_dt,  # ISO-8601 UTC, sorts by time
+        # Header-only listings select bodyPreview (first 255 characters, as text) instead of body
+        "body_preview": msg.get("bodyPreview") or (body_content[:200] if body_content else ""),
         "body_html": body_content if body_type == "html" else "",
         "body_text": body_content if body_type == "text" else "",
         "has_attachments": msg.get("hasAttachments", False),
@@ -197,10 +227,17 @@ async def graph_list_and_convert(
     from_filter: Optional[str] = None,
     limit: int = 10,
     skip_token: Optional[str] = None,
-    include_bodies: bool = False
+    include_bodies: bool = False,
+    folder: str = "inbox",
+    skip: Optional[int] = None,
+    text_bodies: bool = False,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
 ) -> Tuple[List[Dict], Optional[str], int]:
     """
     List messages and convert to EmailMessage format.
+    Without `include_bodies` the listing is header-only (body_preview from bodyPreview);
+    `since` and `until` limit it to messages received within them, filtered by Graph.
     
     Returns:
         - List of EmailMessage dicts
@@ -211,30 +248,38 @@ async def graph_list_and_convert(
         access_token,
         from_filter=from_filter,
         limit=limit,
-        skip_token=skip_token
+        skip_token=skip_token,
+        folder=folder,
+        skip=skip,
+        include_body=include_bodies,
+        text_body=text_bodies,
+        since=since,
+        until=until
     )
     
     # Convert to our format
-    converted = []
-    # Nếu không có body, gọi API chi tiết để lấy nội dung từng mail
-    for msg in messages:
-        parsed = _parse_graph_message_to_email_message(msg)
-        # Nếu cả body_text và body_html đều rỗng, gọi API chi tiết để lấy nội dung
-        if not parsed.get("body_text") and not parsed.get("body_html"):
-            try:
-                detail = await graph_get_message_details(access_token, msg.get("id"))
-                # Gộp các trường body vào parsed nếu có
-                for k in ["body_text", "body_html", "body_preview"]:
-                    if detail.get(k):
-                        parsed[k] = detail[k]
-            except Exception as e:
-                import logging
-                logging.warning(f"[OTP DEBUG] Lỗi lấy chi tiết mail {msg.get('id')}: {e}")
-        converted.append(parsed)
-    
+    converted = [_parse_graph_message_to_email_message(msg) for msg in messages]
+    # Nếu cả body_text và body_html đều rỗng, lấy chi tiết các mail đó (gộp trong một $batch)
+    missing = [m["id"] for m in converted if m["id"] and not m.get("body_text") and not m.get("body_html")]
+    if missing and include_bodies:
+        try:
+            details = await graph_get_messages_details(access_token, missing, text_body=text_bodies)
+        except Exception as e:
+            import logging
+            logging.warning(f"[OTP DEBUG] Lỗi lấy chi tiết {len(missing)} mail: {e}")
+            details = {}
+        for parsed in converted:
+            detail = details.get(parsed["id"])
+            if not detail:
+                continue
+            # Gộp các trường body vào parsed nếu có
+            for k in ["body_text", "body_html", "body_preview"]:
+                if detail.get(k):
+                    parsed[k] = detail[k]
+
     # Sort by date descending (client-side) if we have filter
     # (Graph API doesn't support $orderby + $filter for MSA accounts)
-    if from_filter and converted:
+    if from_filter and since is None and until is None and converted:
         try:
             from email.utils import parsedate_to_datetime
             converted.sort(
@@ -244,7 +289,6 @@ async def graph_list_and_convert(
         except:
             pass  # If sorting fails, keep original order
     
-    # If include_bodies, we already have body preview
     # For full MIME content, would need separate call to /$value endpoint
     
     # Graph API doesn't easily provide total count without additional query
@@ -254,23 +298,245 @@ async def graph_list_and_convert(
     return converted, next_token, total_count
 
 
-async def graph_get_message_details(access_token: str, message_id: str) -> Dict:
+async def graph_get_message_details(access_token: str, message_id: str, text_body: bool = False) -> Dict:
     """
-    Get full message details including body.
+    Get full message details including body (as plain text with `text_body`).
     """
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json",
+        "Prefer": _prefer(text_body),
     }
     
     url = f"https://graph.microsoft.com/v1.0/me/messages/{message_id}"
     params = {
-        "$select": "id,subject,from,toRecipients,receivedDateTime,body,hasAttachments,isRead,internetMessageId"
+        "$select": _DETAIL_SELECT
     }
     
-    async with httpx.AsyncClient(timeout=30) as client:
-        resp = await client.get(url, headers=headers, params=params)
+    from .graph_scheduler import graph_request
+
+    resp = await graph_request("GET", url, access_token, headers=headers, params=params)
+    resp.raise_for_status()
+    
+    msg = resp.json()
+    return _parse_graph_message_to_email_message(msg)
+
+
+class GraphSyncReset(RuntimeError):
+    """The delta token is no longer valid; the folder has to be synced from scratch."""
+
+
+async def graph_delta_messages(
+    access_token: str,
+    folder: str = "inbox",
+    delta_link: Optional[str] = None,
+    since: Optional[str] = None,
+    page_size: int = 50,
+    include_body: bool = False,
+    text_body: bool = False,
+    max_pages: Optional[int] = None
+) -> Tuple[List[Dict], str, bool]:
+    """
+    Messages of a folder added, changed or removed since `delta_link` (the whole
+    folder, newest first, from `since` on, without one), following nextLink
+    pages, at most `max_pages` of them.
+
+    Returns the raw Graph items (removed ones only carry "id" and "@removed"),
+    the link to follow next and whether the round is complete: then the link
+    is the deltaLink for the next round, otherwise the nextLink to go on from.
+    Raises GraphSyncReset when Graph no longer accepts the delta token. Items
+    are header-only (bodyPreview) unless `include_body`; with `text_body`
+    bodies come as plain text.
+    """
+    from .graph_scheduler import graph_request
+
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Prefer": _prefer(text_body, page_size),
+    }
+    if delta_link:
+        url, params = delta_link, None
+    else:
+        url = f"https://graph.microsoft.com/v1.0/me/mailFolders/{folder}/messages/delta"
+        params = {
+            "$select": _DETAIL_SELECT if include_body else _HEADER_SELECT,
+            # The only order delta queries take; a partial first read then holds the newest messages
+            "$orderby": "receivedDateTime desc",
+        }
+        if since:
+            params["$filter"] = f"receivedDateTime ge {since}"
+
+    items: List[Dict] = []
+    pages = 0
+    while True:
+        resp = await graph_request("GET", url, access_token, headers=headers, params=params)
+        pages += 1
+        if resp.status_code == 410 or (
+            resp.status_code == 400 and any(code in resp.text for code in ("syncStateNotFound", "resyncRequired"))
+        ):
+            raise GraphSyncReset(f"Delta token expired: {resp.status_code}")
+        resp.raise_for_status()
+        result = resp.json()
+        items.extend(result.get("value", []))
+        next_link = result.get("@odata.nextLink")
+        if next_link:
+            if max_pages is not None and pages >= max_pages:
+                return items, next_link, False
+            url, params = next_link, None
+            continue
+        new_delta_link = result.get("@odata.deltaLink")
+        if not new_delta_link:
+            raise RuntimeError("Graph delta response has neither a nextLink nor a deltaLink")
+        return items, new_delta_link, True
+
+
+GRAPH_SUBSCRIPTIONS_URL = "https://graph.microsoft.com/v1.0/subscriptions"
+INBOX_MESSAGES_RESOURCE = "me/mailFolders('inbox')/messages"
+
+
+async def graph_create_subscription(
+    access_token: str,
+    notification_url: str,
+    client_state: str,
+    expires_at: datetime,
+    resource: str = INBOX_MESSAGES_RESOURCE,
+    change_type: str = "created,updated,deleted"
+) -> Dict:
+    """
+    Subscribe `notification_url` to changes of `resource`. Graph first posts a
+    validationToken there and only creates the subscription once it is echoed.
+    Returns the subscription (id, expirationDateTime, ...).
+    """
+    from .graph_scheduler import graph_request
+
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json",
+        # Notifications then name messages by the same immutable IDs the listings use
+        "Prefer": _prefer(),
+    }
+    payload = {
+        "changeType": change_type,
+        "notificationUrl": notification_url,
+        "resource": resource,
+        "expirationDateTime": _graph_datetime(expires_at),
+        "clientState": client_state,
+    }
+    resp = await graph_request("POST", GRAPH_SUBSCRIPTIONS_URL, access_token, headers=headers, json=payload)
+    if resp.status_code >= 400:
+        print(f"Graph subscription error: {resp.status_code} {resp.text}")
+    resp.raise_for_status()
+    return resp.json()
+
+
+async def graph_renew_subscription(access_token: str, subscription_id: str, expires_at: datetime) -> Dict:
+    """Move a subscription's expiry; raises httpx.HTTPStatusError (404) when Graph has dropped it."""
+    from .graph_scheduler import graph_request
+
+    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+    url = f"{GRAPH_SUBSCRIPTIONS_URL}/{urllib.parse.quote(subscription_id, safe='')}"
+    resp = await graph_request("PATCH", url, access_token, headers=headers, json={"expirationDateTime": _graph_datetime(expires_at)})
+    resp.raise_for_status()
+    return resp.json()
+
+
+async def graph_delete_subscription(access_token: str, subscription_id: str) -> None:
+    from .graph_scheduler import graph_request
+
+    url = f"{GRAPH_SUBSCRIPTIONS_URL}/{urllib.parse.quote(subscription_id, safe='')}"
+    resp = await graph_request("DELETE", url, access_token, headers={"Authorization": f"Bearer {access_token}"})
+    if resp.status_code != 404:
+        resp.raise_for_status()
+
+
+async def graph_get_messages_details(
+    access_token: str, message_ids: List[str], text_body: bool = False
+) -> Dict[str, Dict]:
+    """
+    graph_get_message_details for many messages, through JSON batching
+    (POST /$batch with up to GRAPH_BATCH_MAX_REQUESTS sub-requests each).
+
+    Throttled sub-requests (429/503/504) are retried after their Retry-After.
+    Messages that still fail are logged and left out of the result, keyed by message ID.
+    """
+    from .constants import GRAPH_BATCH_MAX_REQUESTS
+
+    ids = list(dict.fromkeys(i for i in message_ids if i))
+    chunks = [ids[i:i + GRAPH_BATCH_MAX_REQUESTS] for i in range(0, len(ids), GRAPH_BATCH_MAX_REQUESTS)]
+    found: Dict[str, Dict] = {}
+    for part in await asyncio.gather(*(_graph_batch_details(access_token, chunk, text_body) for chunk in chunks)):
+        found.update(part)
+    return found
+
+
+def _graph_datetime(value: datetime) -> str:
+    """A timezone-aware datetime as a UTC literal for $filter (2025-10-03T19:19:31Z)."""
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _prefer(text_body: bool = False, page_size: Optional[int] = None) -> str:
+    """Prefer header of a message read; several preferences are comma-separated."""
+    preferences = [f"odata.maxpagesize={page_size}"] if page_size else []
+    # Immutable IDs survive moves between folders, so they can key the local mail mirror
+    preferences.append('IdType="ImmutableId"')
+    if text_body:
+        # Graph converts the body to plain text, so no HTML parsing is needed here
+        preferences.append('outlook.body-content-type="text"')
+    return ", ".join(preferences)
+
+
+async def _graph_batch_details(access_token: str, message_ids: List[str], text_body: bool = False) -> Dict[str, Dict]:
+    """One /$batch of message detail GETs (at most 20), retrying throttled sub-requests."""
+    from .constants import GRAPH_BATCH_MAX_ATTEMPTS, GRAPH_RETRY_AFTER_DEFAULT_SECONDS
+    from .graph_scheduler import RETRYABLE_STATUS, get_graph_scheduler, graph_request, retry_after
+
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json",
+    }
+    # Sub-request id -> message ID, still to be fetched
+    pending = {str(n): message_id for n, message_id in enumerate(message_ids)}
+    found: Dict[str, Dict] = {}
+    errors: Dict[str, str] = {}
+    for attempt in range(GRAPH_BATCH_MAX_ATTEMPTS):
+        payload = {"requests": [
+            {
+                "id": n,
+                "method": "GET",
+                "url": f"/me/messages/{urllib.parse.quote(message_id, safe='')}?$select={_DETAIL_SELECT}",
+                "headers": {"Prefer": _prefer(text_body)},
+            }
+            for n, message_id in pending.items()
+        ]}
+        # A throttled batch as a whole is retried by the scheduler
+        resp = await graph_request("POST", GRAPH_BATCH_URL, access_token, headers=headers, json=payload)
         resp.raise_for_status()
-        
-        msg = resp.json()
-        return _parse_graph_message_to_email_message(msg)
+        throttled: Dict[str, str] = {}
+        delay = 0.0
+        for item in resp.json().get("responses", []):
+            n = str(item.get("id"))
+            message_id = pending.get(n)
+            if message_id is None:
+                continue
+            status = int(item.get("status") or 0)
+            if 200 <= status < 300:
+                found[message_id] = _parse_graph_message_to_email_message(item.get("body") or {})
+            elif status in RETRYABLE_STATUS:
+                throttled[n] = message_id
+                wait = retry_after(item.get("headers") or {})
+                delay = max(delay, GRAPH_RETRY_AFTER_DEFAULT_SECONDS if wait is None else wait)
+            else:
+                error = (item.get("body") or {}).get("error") or {}
+                errors[message_id] = f"{status} {error.get('code', '')}".strip()
+        pending = throttled
+        if not pending:
+            break
+        # Other requests for the mailbox hold back for as long too
+        get_graph_scheduler().note_throttled(access_token, delay)
+        if attempt + 1 < GRAPH_BATCH_MAX_ATTEMPTS:
+            await asyncio.sleep(delay)
+    for message_id in pending.values():
+        errors[message_id] = "throttled"
+    if errors:
+        print(f"Graph batch: {len(errors)} of {len(message_ids)} message(s) not fetched: {errors}")
+    return found
@@ -0,0 +1,103 @@
+"""
+In-process LRU of parsed message results (text, html, OTP) under a byte budget.
+
+Polling endpoints see the same messages over and over; parsing MIME,
+converting HTML to text and running the OTP regex is the expensive part, so
+results are kept per message. Entries are keyed by a digest of the raw
+message (or of the Graph body) rather than by UID alone: a UID names another
+message after a UIDVALIDITY change, and a capped stand-in body parses
+differently from the whole message. Whatever else changes the result (a
+custom regex) is part of the key.
+"""
+from __future__ import annotations
+
+import hashlib
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, Hashable, Tuple, TypeVar, Union
+
+from .config import get_parse_cache_max_bytes
+from .constants import PARSE_CACHE_ENTRY_OVERHEAD, PARSE_CACHE_MAX_BYTES
+
+T = TypeVar("T")
+
+
+def message_key(*parts: Union[str, bytes, bytearray, memoryview, None]) -> bytes:
+    """128-bit digest of the message content the cached result was computed from."""
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        data = (part or "").encode("utf-8", "surrogatepass") if isinstance(part, str) or part is None else part
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.digest()
+
+
+def _sizeof(value: Any) -> int:
+    """Rough payload size of a cached result; strings dominate."""
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(_sizeof(v) for v in value) + 8 * len(value)
+    if isinstance(value, dict):
+        return sum(_sizeof(k) + _sizeof(v) for k, v in value.items())
+    return 8
+
+
+@dataclass
+class ParseCacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+class ParseCache:
+    def __init__(self, max_bytes: int = PARSE_CACHE_MAX_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.counters = ParseCacheStats()
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._bytes = 0
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], T]) -> T:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.counters.hits += 1
+            return entry[0]
+        self.counters.misses += 1
+        value = compute()
+        size = _sizeof(value) + PARSE_CACHE_ENTRY_OVERHEAD
+        if size <= self.max_bytes:
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, dropped) = self._entries.popitem(last=False)
+                self._bytes -= dropped
+                self.counters.evictions += 1
+        return value
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = asdict(self.counters)
+        lookups = self.counters.hits + self.counters.misses
+        data["hit_rate"] = round(self.counters.hits / lookups, 3) if lookups else None
+        data["entries"] = len(self._entries)
+        data["bytes"] = self._bytes
+        data["max_bytes"] = self.max_bytes
+        return data
+
+
+_CACHE = ParseCache(get_parse_cache_max_bytes() or PARSE_CACHE_MAX_BYTES)
+
+
+def parsed(key: Hashable, compute: Callable[[], T]) -> T:
+    """Process-wide cache lookup; `compute` runs only on a miss."""
+    return _CACHE.get_or_compute(key, compute)
+
+
+def parse_cache_stats() -> Dict[str, Any]:
+    return _CACHE.stats()
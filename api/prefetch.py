@@ -0,0 +1,162 @@
+"""
+Predictive prefetch behind /messages and /message (PREFETCH=1).
+
+Reading a page is nearly always followed by the next page or by opening the
+newest messages. After a page is served, the page behind its next_page_token
+and the bodies of its first PREFETCH_TOP_BODIES messages are fetched in the
+background, one after the other, and kept for a short while. The endpoints
+look here first; a request for what is being prefetched at that moment waits
+for it instead of fetching it again. A prefetched result serves one request.
+
+Prefetching is bounded: one run per account, at most PREFETCH_MAX_ACCOUNTS
+runs at a time. Past that, pages are served without prefetching. A Graph
+change notification drops what was prefetched for the account
+(forget_prefetched), so a page prefetched before new mail is never served.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from .constants import (
+    PREFETCH_BODY_TTL_SECONDS, PREFETCH_MAX_ACCOUNTS, PREFETCH_MAX_ENTRIES, PREFETCH_PAGE_TTL_SECONDS
+)
+from .ttl_cache import TTLCache
+
+KIND_PAGE = "page"
+KIND_BODY = "body"
+_TTL = {KIND_PAGE: PREFETCH_PAGE_TTL_SECONDS, KIND_BODY: PREFETCH_BODY_TTL_SECONDS}
+
+# (kind, key, fetch) of one thing to prefetch
+Job = Tuple[str, str, Callable[[], Awaitable[Any]]]
+
+
+@dataclass
+class PrefetchStats:
+    page_hits: int = 0
+    page_misses: int = 0
+    body_hits: int = 0
+    body_misses: int = 0
+    fetched: int = 0
+    failed: int = 0
+    skipped: int = 0  # Runs not started: the account already had one, or the budget was used up
+    invalidated: int = 0  # Results dropped by forget_prefetched
+
+
+_CACHE: "TTLCache[str, Any]" = TTLCache(PREFETCH_MAX_ENTRIES)
+_RUNNING: Dict[str, "asyncio.Future[Any]"] = {}  # key -> the job fetching it right now
+_ACCOUNTS: Dict[str, "asyncio.Task[None]"] = {}
+# account -> keys of its cached results (some may have expired since)
+_KEYS: "TTLCache[str, Set[str]]" = TTLCache(PREFETCH_MAX_ENTRIES)
+_STATS = PrefetchStats()
+
+
+def prefetch_key(kind: str, *parts: Any) -> str:
+    """Key of a prefetched result; `parts` include the credential, so results only serve the account's own requests."""
+    raw = json.dumps([kind, *parts], sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+async def take_prefetched(kind: str, key: str) -> Optional[Any]:
+    """The prefetched result for `key`, waiting for it when it is being fetched; None on a miss."""
+    value = _CACHE.pop(key)
+    if value is None and key in _RUNNING:
+        value = await asyncio.shield(_RUNNING[key])
+        _CACHE.pop(key)
+    if kind == KIND_PAGE:
+        _STATS.page_hits += value is not None
+        _STATS.page_misses += value is None
+    else:
+        _STATS.body_hits += value is not None
+        _STATS.body_misses += value is None
+    return value
+
+
+def schedule_prefetch(account: str, jobs: List[Job]) -> bool:
+    """Start a background run over `jobs`, in order; False when nothing was started."""
+    jobs = [job for job in jobs if job[1] not in _CACHE and job[1] not in _RUNNING]
+    if not jobs:
+        return False
+    if account in _ACCOUNTS or len(_ACCOUNTS) >= PREFETCH_MAX_ACCOUNTS:
+        _STATS.skipped += 1
+        return False
+    # The first job counts as running at once: a request right behind this one waits for it
+    first_key = jobs[0][1]
+    first = _RUNNING[first_key] = asyncio.get_running_loop().create_future()
+    task = asyncio.create_task(_run(account, jobs, first))
+    _ACCOUNTS[account] = task
+
+    def done(t: "asyncio.Task[None]") -> None:
+        if _ACCOUNTS.get(account) is t:
+            _ACCOUNTS.pop(account, None)
+        # A run cancelled before it started never settles its first job
+        if not first.done():
+            first.set_result(None)
+            if _RUNNING.get(first_key) is first:
+                _RUNNING.pop(first_key, None)
+
+    task.add_done_callback(done)
+    return True
+
+
+async def _run(account: str, jobs: List[Job], first: "asyncio.Future[Any]") -> None:
+    loop = asyncio.get_running_loop()
+    for i, (kind, key, fetch) in enumerate(jobs):
+        if i == 0:
+            running = first
+        elif key in _CACHE or key in _RUNNING:
+            continue
+        else:
+            running = _RUNNING[key] = loop.create_future()
+        value = None
+        try:
+            value = await fetch()
+        except Exception:
+            # The request that wanted it fetches it itself
+            _STATS.failed += 1
+        else:
+            now = time.time()
+            _CACHE.put(key, value, now + _TTL[kind])
+            keys = {k for k in _KEYS.get(account) or () if k in _CACHE}
+            keys.add(key)
+            _KEYS.put(account, keys, now + max(_TTL.values()))
+            _STATS.fetched += 1
+        finally:
+            _RUNNING.pop(key, None)
+            if not running.done():
+                running.set_result(value)
+
+
+def forget_prefetched(account: str) -> int:
+    """Stop the account's run and drop its prefetched results; returns how many were dropped."""
+    task = _ACCOUNTS.pop(account, None)
+    if task is not None:
+        task.cancel()
+    dropped = sum(_CACHE.pop(key) is not None for key in _KEYS.pop(account) or ())
+    _STATS.invalidated += dropped
+    return dropped
+
+
+async def close_prefetch() -> None:
+    runs = list(_ACCOUNTS.values())
+    for task in runs:
+        task.cancel()
+    await asyncio.gather(*runs, return_exceptions=True)
+    _ACCOUNTS.clear()
+    _KEYS.clear()
+    _RUNNING.clear()
+
+
+def prefetch_stats() -> Dict[str, Any]:
+    data: Dict[str, Any] = asdict(_STATS)
+    for kind in (KIND_PAGE, KIND_BODY):
+        served = data[f"{kind}_hits"] + data[f"{kind}_misses"]
+        data[f"{kind}_hit_rate"] = round(data[f"{kind}_hits"] / served, 3) if served else 0.0
+    data["cached"] = len(_CACHE)
+    data["unused"] = _CACHE.expirations + _CACHE.evictions  # Prefetched, then dropped unread
+    data["running"] = len(_ACCOUNTS)
+    return data
@@ -0,0 +1,430 @@
+"""
+Shared key/value store for OAuth state and access/refresh tokens.
+
+Every uvicorn worker keeps its own dicts in api.main; this store is what
+they share, so a token exchanged by one worker is reused by the others and
+an OAuth callback can land on any worker. Values are JSON objects with a
+TTL, grouped by namespace ("oauth_state", "token", "refresh").
+
+Backends, chosen by STATE_STORE_URL:
+- memory:// (default): this process only; with STATE_SNAPSHOT_PATH it is
+  written to disk at shutdown and read back at startup (warm restart)
+- sqlite:///path/to/state.sqlite3: one file shared by the workers of a host
+- redis://[:password@]host[:port][/db]: anything speaking the Redis protocol
+  (GETDEL needs Redis 6.2 or newer)
+
+With STATE_STORE_KEY set, values are Fernet-encrypted before they reach the
+backend (or the snapshot), so tokens are never stored in clear.
+"""
+from __future__ import annotations
+
+import abc
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import unquote, urlparse
+
+from .config import get_state_snapshot_path, get_state_store_key, get_state_store_url
+from .constants import (
+    STATE_STORE_MAX_ENTRIES, STATE_STORE_REDIS_PREFIX, STATE_STORE_REDIS_TIMEOUT_SECONDS, STATE_STORE_SWEEP_EVERY
+)
+from .ttl_cache import TTLCache
+
+Value = Dict[str, Any]
+
+
+class StateStoreError(RuntimeError):
+    pass
+
+
+class _Sealer:
+    """JSON encoding of values, Fernet-encrypted when a secret is configured."""
+
+    def __init__(self, secret: Optional[str]) -> None:
+        self._fernet = None
+        if secret:
+            try:
+                from cryptography.fernet import Fernet
+            except ImportError as e:
+                raise StateStoreError("STATE_STORE_KEY requires the 'cryptography' package") from e
+            # Any secret string works: it is stretched to the 32-byte key Fernet wants
+            self._fernet = Fernet(base64.urlsafe_b64encode(hashlib.sha256(secret.encode()).digest()))
+
+    @property
+    def encrypted(self) -> bool:
+        return self._fernet is not None
+
+    def seal(self, value: Value) -> bytes:
+        data = json.dumps(value, separators=(",", ":")).encode()
+        return self._fernet.encrypt(data) if self._fernet is not None else data
+
+    def open(self, blob: bytes) -> Optional[Value]:
+        try:
+            data = self._fernet.decrypt(blob) if self._fernet is not None else blob
+            return json.loads(data)
+        except Exception:
+            # Written under another key (or in clear before one was set): treat as a miss
+            return None
+
+
+@dataclass
+class StateStoreStats:
+    hits: int = 0
+    misses: int = 0
+    writes: int = 0
+    errors: int = 0
+
+
+class StateStore(abc.ABC):
+    """Async get/set/pop of JSON values with a TTL; subclasses store the sealed bytes."""
+
+    backend = "base"
+
+    def __init__(self, secret: Optional[str] = None) -> None:
+        self._sealer = _Sealer(secret)
+        self.counters = StateStoreStats()
+
+    async def get(self, namespace: str, key: str) -> Optional[Value]:
+        blob = await self._get(namespace, key)
+        value = self._sealer.open(blob) if blob is not None else None
+        if value is None:
+            self.counters.misses += 1
+        else:
+            self.counters.hits += 1
+        return value
+
+    async def set(self, namespace: str, key: str, value: Value, ttl: float) -> None:
+        if ttl <= 0:
+            return
+        await self._set(namespace, key, self._sealer.seal(value), ttl)
+        self.counters.writes += 1
+
+    async def pop(self, namespace: str, key: str) -> Optional[Value]:
+        """Atomically read and delete; a value is handed to at most one caller (OAuth state)."""
+        blob = await self._pop(namespace, key)
+        return self._sealer.open(blob) if blob is not None else None
+
+    async def delete(self, namespace: str, key: str) -> None:
+        await self._pop(namespace, key)
+
+    async def close(self) -> None:
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = asdict(self.counters)
+        data["backend"] = self.backend
+        data["encrypted"] = self._sealer.encrypted
+        return data
+
+    @abc.abstractmethod
+    async def _get(self, namespace: str, key: str) -> Optional[bytes]:
+        """Sealed value of a live entry, or None."""
+
+    @abc.abstractmethod
+    async def _set(self, namespace: str, key: str, blob: bytes, ttl: float) -> None:
+        """Store a sealed value for `ttl` seconds."""
+
+    @abc.abstractmethod
+    async def _pop(self, namespace: str, key: str) -> Optional[bytes]:
+        """Delete an entry, returning its sealed value when it was live."""
+
+
+class MemoryStateStore(StateStore):
+    backend = "memory"
+
+    def __init__(
+        self, secret: Optional[str] = None, snapshot_path: Union[str, Path, None] = None,
+        max_entries: int = STATE_STORE_MAX_ENTRIES,
+    ) -> None:
+        super().__init__(secret)
+        self.snapshot_path = Path(snapshot_path) if snapshot_path else None
+        self._entries: "TTLCache[Tuple[str, str], bytes]" = TTLCache(max_entries)
+        if self.snapshot_path is not None:
+            self.load_snapshot(self.snapshot_path)
+
+    async def _get(self, namespace: str, key: str) -> Optional[bytes]:
+        return self._entries.get((namespace, key))
+
+    async def _set(self, namespace: str, key: str, blob: bytes, ttl: float) -> None:
+        self._entries.put((namespace, key), blob, time.time() + ttl)
+
+    async def _pop(self, namespace: str, key: str) -> Optional[bytes]:
+        return self._entries.pop((namespace, key))
+
+    def save_snapshot(self, path: Union[str, Path]) -> int:
+        """Write the live entries (still sealed) to `path`; returns how many."""
+        rows = [
+            {"ns": ns, "key": key, "value": base64.b64encode(blob).decode(), "expires_at": expires_at}
+            for (ns, key), blob, expires_at in self._entries.entries()
+        ]
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(rows, f)
+        os.chmod(tmp, 0o600)
+        os.replace(tmp, path)
+        return len(rows)
+
+    def load_snapshot(self, path: Union[str, Path]) -> int:
+        """Read back entries that have not expired since the snapshot; a missing file loads nothing."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                rows = json.load(f)
+        except FileNotFoundError:
+            return 0
+        now = time.time()
+        loaded = 0
+        for row in rows:
+            if row["expires_at"] > now:
+                self._entries.put((row["ns"], row["key"]), base64.b64decode(row["value"]), row["expires_at"])
+                loaded += 1
+        return loaded
+
+    async def close(self) -> None:
+        if self.snapshot_path is not None:
+            self.save_snapshot(self.snapshot_path)
+
+    def stats(self) -> Dict[str, Any]:
+        data = super().stats()
+        data.update(self._entries.stats())
+        return data
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+    ns TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (ns, key)
+);
+CREATE INDEX IF NOT EXISTS state_expires ON state (expires_at);
+"""
+
+
+class SQLiteStateStore(StateStore):
+    """One database file shared by the worker processes of a host."""
+
+    backend = "sqlite"
+
+    def __init__(self, path: Union[str, Path], secret: Optional[str] = None) -> None:
+        super().__init__(secret)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Autocommit; other workers write the same file, so wait for their locks
+        self._db = sqlite3.connect(str(self.path), isolation_level=None, check_same_thread=False, timeout=5.0)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SQLITE_SCHEMA)
+        # Queries can wait up to that timeout, so they run off the event loop, one at a time on one thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-sqlite")
+        self._writes = 0
+        self._entries = self._count(time.time())
+
+    async def _run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _count(self, now: float) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM state WHERE expires_at > ?", (now,)).fetchone()[0]
+
+    def _select(self, namespace: str, key: str) -> Optional[bytes]:
+        row = self._db.execute(
+            "SELECT value FROM state WHERE ns = ? AND key = ? AND expires_at > ?", (namespace, key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def _upsert(self, namespace: str, key: str, blob: bytes, ttl: float) -> None:
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO state (ns, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            (namespace, key, blob, now + ttl),
+        )
+        self._writes += 1
+        if self._writes % STATE_STORE_SWEEP_EVERY == 0:
+            self._db.execute("DELETE FROM state WHERE expires_at <= ?", (now,))
+            self._entries = self._count(now)
+
+    def _delete_returning(self, namespace: str, key: str) -> Optional[bytes]:
+        row = self._db.execute(
+            "DELETE FROM state WHERE ns = ? AND key = ? RETURNING value, expires_at", (namespace, key)
+        ).fetchone()
+        return row[0] if row and row[1] > time.time() else None
+
+    async def _get(self, namespace: str, key: str) -> Optional[bytes]:
+        return await self._run(self._select, namespace, key)
+
+    async def _set(self, namespace: str, key: str, blob: bytes, ttl: float) -> None:
+        await self._run(self._upsert, namespace, key, blob, ttl)
+
+    async def _pop(self, namespace: str, key: str) -> Optional[bytes]:
+        return await self._run(self._delete_returning, namespace, key)
+
+    async def close(self) -> None:
+        await self._run(self._db.close)
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, Any]:
+        data = super().stats()
+        # Counted at open and at each sweep: /stats does not query the file
+        data["entries"] = self._entries
+        return data
+
+
+# ----- Redis protocol (RESP2), just the commands the store needs -----
+
+def _encode_command(args: List[Union[str, bytes, int]]) -> bytes:
+    out = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode()
+        out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(out)
+
+
+async def _read_reply(reader: asyncio.StreamReader) -> Any:
+    line = await reader.readuntil(b"\r\n")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        raise StateStoreError(rest.decode(errors="replace"))
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        n = int(rest)
+        if n < 0:
+            return None
+        data = await reader.readexactly(n + 2)
+        return data[:-2]
+    if kind == b"*":
+        n = int(rest)
+        return None if n < 0 else [await _read_reply(reader) for _ in range(n)]
+    raise StateStoreError(f"Unexpected Redis reply: {line[:40]!r}")
+
+
+class RedisStateStore(StateStore):
+    """Any server speaking the Redis protocol; one connection, commands serialized."""
+
+    backend = "redis"
+
+    def __init__(
+        self, host: str = "localhost", port: int = 6379, db: int = 0, password: Optional[str] = None,
+        secret: Optional[str] = None, prefix: str = STATE_STORE_REDIS_PREFIX,
+    ) -> None:
+        super().__init__(secret)
+        self.host, self.port, self.db, self.password, self.prefix = host, port, db, password, prefix
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def from_url(cls, url: str, secret: Optional[str] = None) -> "RedisStateStore":
+        parsed = urlparse(url)
+        db = int(parsed.path.lstrip("/") or 0)
+        password = unquote(parsed.password) if parsed.password else None
+        return cls(parsed.hostname or "localhost", parsed.port or 6379, db, password, secret)
+
+    def _name(self, namespace: str, key: str) -> str:
+        return f"{self.prefix}{namespace}:{key}"
+
+    async def _connect(self) -> None:
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), STATE_STORE_REDIS_TIMEOUT_SECONDS
+        )
+        if self.password:
+            await self._roundtrip(["AUTH", self.password])
+        if self.db:
+            await self._roundtrip(["SELECT", self.db])
+
+    async def _roundtrip(self, args: List[Union[str, bytes, int]]) -> Any:
+        assert self._reader is not None and self._writer is not None
+        self._writer.write(_encode_command(args))
+        await self._writer.drain()
+        return await asyncio.wait_for(_read_reply(self._reader), STATE_STORE_REDIS_TIMEOUT_SECONDS)
+
+    def _drop(self) -> Optional[asyncio.StreamWriter]:
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer is not None:
+            writer.close()
+        return writer
+
+    async def _disconnect(self) -> None:
+        writer = self._drop()
+        if writer is not None:
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def command(self, *args: Union[str, bytes, int]) -> Any:
+        async with self._lock:
+            # One reconnect: the server may have closed an idle connection
+            for attempt in range(2):
+                try:
+                    if self._writer is None:
+                        await self._connect()
+                    return await self._roundtrip(list(args))
+                except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                    await self._disconnect()
+                    if attempt:
+                        self.counters.errors += 1
+                        raise StateStoreError(f"Redis unavailable: {e}") from e
+                except BaseException:
+                    # Cancelled (or failed) mid-command: its reply may still arrive and would
+                    # answer the next command, so this connection cannot be reused
+                    self._drop()
+                    raise
+
+    async def _get(self, namespace: str, key: str) -> Optional[bytes]:
+        return await self.command("GET", self._name(namespace, key))
+
+    async def _set(self, namespace: str, key: str, blob: bytes, ttl: float) -> None:
+        await self.command("SET", self._name(namespace, key), blob, "PX", max(1, int(ttl * 1000)))
+
+    async def _pop(self, namespace: str, key: str) -> Optional[bytes]:
+        return await self.command("GETDEL", self._name(namespace, key))
+
+    async def close(self) -> None:
+        await self._disconnect()
+
+
+def open_state_store(url: str, secret: Optional[str] = None, snapshot_path: Optional[str] = None) -> StateStore:
+    scheme = urlparse(url).scheme if url else "memory"
+    if scheme == "memory":
+        return MemoryStateStore(secret, snapshot_path)
+    if scheme == "sqlite":
+        # sqlite:///relative.db or sqlite:////absolute/path.db
+        return SQLiteStateStore(url[len("sqlite:///"):], secret)
+    if scheme in ("redis", "tcp"):
+        return RedisStateStore.from_url(url, secret)
+    raise StateStoreError(f"Unsupported STATE_STORE_URL scheme: {scheme}")
+
+
+_STORE: Optional[StateStore] = None
+
+
+def get_state_store() -> StateStore:
+    """The process-wide store, opened from STATE_STORE_URL on first use."""
+    global _STORE
+    if _STORE is None:
+        _STORE = open_state_store(get_state_store_url(), get_state_store_key(), get_state_snapshot_path())
+    return _STORE
+
+
+async def close_state_store() -> None:
+    global _STORE
+    store, _STORE = _STORE, None
+    if store is not None:
+        await store.close()
+
+
+def state_store_stats() -> Dict[str, Any]:
+    return _STORE.stats() if _STORE is not None else {"backend": None}
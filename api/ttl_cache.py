@@ -0,0 +1,121 @@
+"""
+Bounded mapping whose entries expire at a given time.
+
+Expiry is driven by a min-heap of (expires_at, seq, key): removing everything
+due costs O(log n) per removed entry instead of a scan of the whole mapping.
+Re-setting a key leaves its old heap item behind; items whose seq no longer
+matches the live entry are skipped when popped, and the heap is rebuilt once
+such leftovers outnumber the live entries. Past `max_entries` the least
+recently used entry is evicted.
+"""
+from __future__ import annotations
+
+import heapq
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Generic, Iterator, List, Optional, Tuple, TypeVar
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+_MISSING: Any = object()
+
+
+class TTLCache(Generic[K, V]):
+    def __init__(self, max_entries: int, clock: Callable[[], float] = time.time) -> None:
+        self.max_entries = max_entries
+        self._clock = clock
+        # key -> (value, expires_at, seq); order is least to most recently used
+        self._entries: "OrderedDict[K, Tuple[V, float, int]]" = OrderedDict()
+        self._heap: List[Tuple[float, int, K]] = []
+        self._seq = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def put(self, key: K, value: V, expires_at: float) -> None:
+        """Store `value` until `expires_at` (same clock as the cache's, time.time() by default)."""
+        self._seq += 1
+        self._entries[key] = (value, expires_at, self._seq)
+        self._entries.move_to_end(key)
+        heapq.heappush(self._heap, (expires_at, self._seq, key))
+        self.expire()
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._compact()
+
+    def get(self, key: K, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        if entry[1] <= self._clock():
+            self._entries.pop(key, None)
+            self.expirations += 1
+            return default
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def expires_at(self, key: K) -> Optional[float]:
+        entry = self._entries.get(key)
+        return entry[1] if entry is not None else None
+
+    def pop(self, key: K, default: Any = None) -> Any:
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[1] <= self._clock():
+            return default
+        return entry[0]
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """Drop every entry due by `now`; returns how many."""
+        now = self._clock() if now is None else now
+        heap, entries = self._heap, self._entries
+        dropped = 0
+        while heap and heap[0][0] <= now:
+            _, seq, key = heapq.heappop(heap)
+            entry = entries.get(key)
+            if entry is not None and entry[2] == seq:
+                del entries[key]
+                dropped += 1
+        self.expirations += dropped
+        return dropped
+
+    def _compact(self) -> None:
+        self._heap = [(expires_at, seq, key) for key, (_, expires_at, seq) in self._entries.items()]
+        heapq.heapify(self._heap)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._heap.clear()
+
+    def items(self) -> Iterator[Tuple[K, V]]:
+        """Live entries, least recently used first."""
+        now = self._clock()
+        return ((k, v) for k, (v, expires_at, _) in list(self._entries.items()) if expires_at > now)
+
+    def entries(self) -> Iterator[Tuple[K, V, float]]:
+        """Live entries with their expiry time."""
+        now = self._clock()
+        return ((k, v, expires_at) for k, (v, expires_at, _) in list(self._entries.items()) if expires_at > now)
+
+    def __getitem__(self, key: K) -> V:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: object) -> bool:
+        entry = self._entries.get(key)  # type: ignore[arg-type]
+        return entry is not None and entry[1] > self._clock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "expirations": self.expirations,
+            "evictions": self.evictions,
+            "heap": len(self._heap),
+        }
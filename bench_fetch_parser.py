@@ -0,0 +1,85 @@
+"""
+Benchmark: parse a 50-message UID FETCH reply.
+
+  imaplib loop  - split the reply into (prefix, literal) tuples the way imaplib
+                  hands them back (one copy per literal), then the old imaplib
+                  helpers' loop: decode each prefix to str and run a UID regex on it
+  iter_fetch    - api.imap_parse.iter_fetch over the reply buffer, literals as
+                  memoryview slices
+
+Run: python bench_fetch_parser.py
+"""
+import re
+import timeit
+
+from api.imap_parse import iter_fetch
+
+MESSAGES = 50
+BODY_SIZES = (2_000, 20_000, 200_000)
+ROUNDS = 100
+
+_UID_PATTERN = re.compile(r"UID\s+(\d+)")
+_LITERAL_PATTERN = re.compile(rb"\{(\d+)\}\r\n")
+
+
+def build_reply(body_bytes: int) -> bytearray:
+    reply = bytearray()
+    for i in range(MESSAGES):
+        uid = 1000 + i
+        body = (
+            f"From: Sender <noreply@example.com>\r\nSubject: Message {uid}\r\n\r\n".encode()
+            + (b"lorem ipsum dolor sit amet " * (body_bytes // 27))
+            + b"\r\n"
+        )
+        reply += b"* %d FETCH (UID %d RFC822.SIZE %d FLAGS (\\Seen) BODY[] {%d}\r\n" % (i + 1, uid, len(body), len(body))
+        reply += body + b")\r\n"
+    return reply
+
+
+def imaplib_tuples(reply: bytes) -> list:
+    """What imaplib.uid("fetch", ...) returns: [(prefix, literal), b")", ...]."""
+    out = []
+    pos = 0
+    while pos < len(reply):
+        m = _LITERAL_PATTERN.search(reply, pos)
+        if m is None:
+            break
+        end = m.end() + int(m.group(1))
+        out.append((reply[pos:m.end() - 2], reply[m.end():end]))
+        eol = reply.index(b"\r\n", end)
+        out.append(reply[end:eol])
+        pos = eol + 2
+    return out
+
+
+def imaplib_loop(reply: bytes) -> dict:
+    res = {}
+    for part in imaplib_tuples(reply):
+        if not isinstance(part, tuple) or not part or part[1] is None:
+            continue
+        info = (part[0] or b"").decode(errors="ignore")
+        m = _UID_PATTERN.search(info)
+        if not m:
+            continue
+        res[int(m.group(1))] = part[1]
+    return res
+
+
+def iter_fetch_loop(reply: bytearray) -> dict:
+    return {record.uid: record.items["BODY[]"] for record in iter_fetch(reply)}
+
+
+def main() -> None:
+    print(f"{MESSAGES}-message FETCH reply, best of 5 x {ROUNDS} rounds")
+    for body_bytes in BODY_SIZES:
+        reply = build_reply(body_bytes)
+        as_bytes = bytes(reply)
+        assert imaplib_loop(as_bytes).keys() == iter_fetch_loop(reply).keys()
+        print(f"{len(reply) / 1024:8.0f} KiB reply")
+        for name, fn in (("imaplib loop", lambda: imaplib_loop(as_bytes)), ("iter_fetch", lambda: iter_fetch_loop(reply))):
+            best = min(timeit.repeat(fn, number=ROUNDS, repeat=5)) / ROUNDS
+            print(f"  {name:<13} {best * 1e6:9.1f} us/reply")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Benchmark: payload size and parse time of one 25-message Graph listing page.
+
+  html body    - $select=...,body (the old listing): HTML bodies, converted
+                 with otp_utils.html_to_text before the OTP search
+  text body    - same $select with Prefer: outlook.body-content-type="text":
+                 Graph sends plain text, no HTML parsing
+  header-only  - $select=...,bodyPreview (listings without include_body)
+
+Parse time covers json.loads, the outlook_graph conversion and the OTP search.
+
+Run: python bench_graph_projection.py
+"""
+import json
+import timeit
+
+from api.otp_utils import extract_otp_from_text, html_to_text
+from api.outlook_graph import _parse_graph_message_to_email_message
+
+MESSAGES = 25
+ROUNDS = 5
+
+_ROW = (
+    '<tr><td style="padding:8px 24px;font-family:Segoe UI,Arial,sans-serif;font-size:14px;color:#333">'
+    "{text}</td></tr>"
+)
+
+
+def build_html(i: int) -> str:
+    """A newsletter-style HTML mail with inline styles, like most OTP and notification mails."""
+    rows = "".join(_ROW.format(text=f"Paragraph {n} of message {i}: account activity and settings.") for n in range(60))
+    return (
+        '<html><head><meta charset="utf-8"><style>td{border:0} a{color:#0067b8}</style></head><body>'
+        '<table width="100%" cellpadding="0" cellspacing="0" style="background:#f3f3f3">'
+        f"{_ROW.format(text=f'Your security code is <b>{481207 + 37 * i}</b>')}{rows}</table></body></html>"
+    )
+
+
+def build_text(i: int) -> str:
+    paragraphs = "\n".join(f"Paragraph {n} of message {i}: account activity and settings." for n in range(60))
+    return f"Your security code is {481207 + 37 * i}\n{paragraphs}"
+
+
+def build_page(projection: str) -> bytes:
+    value = []
+    for i in range(MESSAGES):
+        msg = {
+            "id": f"AAkALgAAAAAAHYQDEapmEc2byACqAC-EWg0A{i:04d}",
+            "subject": f"Your security code {i}",
+            "from": {"emailAddress": {"address": "account-security-noreply@accountprotection.microsoft.com", "name": "Microsoft"}},
+            "toRecipients": [{"emailAddress": {"address": "user@outlook.com", "name": "User"}}],
+            "receivedDateTime": f"2025-10-03T10:{i:02d}:00Z",
+            "hasAttachments": False,
+            "isRead": False,
+            "internetMessageId": f"<{i}@example.com>",
+        }
+        if projection == "html body":
+            msg["body"] = {"contentType": "html", "content": build_html(i)}
+        elif projection == "text body":
+            msg["body"] = {"contentType": "text", "content": build_text(i)}
+        else:
+            msg["bodyPreview"] = build_text(i)[:255]
+        value.append(msg)
+    return json.dumps({"value": value}).encode()
+
+
+def parse_page(payload: bytes) -> list:
+    otps = []
+    for raw in json.loads(payload)["value"]:
+        msg = _parse_graph_message_to_email_message(raw)
+        text = html_to_text(msg["body_html"]) if msg["body_html"] else (msg["body_text"] or msg["body_preview"])
+        otps.append(extract_otp_from_text(text, None))
+    return otps
+
+
+def main() -> None:
+    print(f"{MESSAGES} messages per page, best of {ROUNDS}")
+    for projection in ("html body", "text body", "header-only"):
+        payload = build_page(projection)
+        assert all(parse_page(payload))
+        best = min(timeit.repeat(lambda: parse_page(payload), number=1, repeat=ROUNDS))
+        print(f"  {projection:<12} {len(payload) / 1024:8.1f} KiB  {best * 1e3:8.2f} ms/page")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark: token cache upkeep per request with 100k cached accounts.
+
+  dict scan  - the old _cleanup_expired_tokens: scan a dict of
+               {"expires_at": ...} entries for expired ones, then look up
+  TTLCache   - api.ttl_cache.TTLCache: expire() pops the heap while its top is
+               due, then get()
+
+Each request also re-caches one entry with a fresh expiry, so a few entries
+expire along the way in both variants.
+
+Run: python bench_ttl_cache.py
+"""
+import random
+import time
+import timeit
+
+from api.ttl_cache import TTLCache
+
+ENTRIES = 100_000
+REQUESTS = 200
+TTL = 3600.0
+
+
+def build(now: float):
+    rng = random.Random(1)
+    expiries = [now + rng.uniform(0, TTL) for _ in range(ENTRIES)]
+    as_dict = {f"user{i}@example.com|cid|{i:012x}": {"expires_at": e} for i, e in enumerate(expiries)}
+    cache: TTLCache = TTLCache(ENTRIES * 2)
+    for key, entry in as_dict.items():
+        cache.put(key, entry, entry["expires_at"])
+    return as_dict, cache, list(as_dict)
+
+
+def dict_requests(as_dict: dict, keys: list, now: float) -> None:
+    for i in range(REQUESTS):
+        t = now + i
+        expired = [k for k, v in as_dict.items() if v.get("expires_at", 0) <= t]
+        for k in expired:
+            as_dict.pop(k, None)
+        key = keys[i]
+        as_dict.get(key)
+        as_dict[key] = {"expires_at": t + TTL}
+
+
+def cache_requests(cache: TTLCache, keys: list, now: float) -> None:
+    for i in range(REQUESTS):
+        t = now + i
+        cache.expire(t)
+        key = keys[i]
+        cache.get(key)
+        cache.put(key, {"expires_at": t + TTL}, t + TTL)
+
+
+def main() -> None:
+    now = time.time()
+    print(f"{ENTRIES:,} cached accounts, {REQUESTS} requests, best of 3")
+    for name, run in (
+        ("dict scan", lambda d, c, k: dict_requests(d, k, now)),
+        ("TTLCache", lambda d, c, k: cache_requests(c, k, now)),
+    ):
+        best = float("inf")
+        for _ in range(3):
+            as_dict, cache, keys = build(now)
+            best = min(best, timeit.timeit(lambda: run(as_dict, cache, keys), number=1))
+        print(f"  {name:<10} {best / REQUESTS * 1e6:9.1f} us/request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+import asyncio
+import json
+from urllib.parse import parse_qs
+
+import httpx
+import pytest
+
+from api import http_client, main
+from api.outlook_graph import (
+    exchange_refresh_token_graph, graph_get_message_body, graph_get_messages_details, graph_list_messages
+)
+from api.outlook_imap import exchange_refresh_token_outlook
+
+NEXT_LINK = "https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages?%24top=2&%24skiptoken=abc123"
+
+
+@pytest.fixture
+def graph_requests(monkeypatch):
+    seen = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(request)
+        if request.url.host == "login.microsoftonline.com":
+            form = parse_qs(request.content.decode())
+            if form["refresh_token"] == ["bad"]:
+                return httpx.Response(400, json={"error": "invalid_grant"})
+            return httpx.Response(200, json={"access_token": "at", "expires_in": 1800, "refresh_token": "rt-2"})
+        if request.url.path.endswith("/$value"):
+            return httpx.Response(200, text="Subject: hi\r\n\r\nbody")
+        return httpx.Response(200, json={"value": [{"id": "m1"}, {"id": "m2"}], "@odata.nextLink": NEXT_LINK})
+
+    monkeypatch.setattr(http_client, "_CLIENT", http_client.new_http_client(httpx.MockTransport(handler)))
+    return seen
+
+
+def test_calls_share_the_application_client(graph_requests):
+    client = http_client.get_http_client()
+    created = http_client.http_client_stats()["clients_created"]
+
+    async def scenario():
+        token = await exchange_refresh_token_graph("cid", "rt")
+        listing = await graph_list_messages("at", limit=2, folder="junkemail")
+        body = await graph_get_message_body("at", "m1")
+        with pytest.raises(RuntimeError, match="invalid_grant"):
+            await exchange_refresh_token_outlook("cid", "bad")
+        return token, listing, body
+
+    token, (messages, skip_token), body = asyncio.run(scenario())
+    assert token == ("at", 1800, "rt-2")
+    assert [m["id"] for m in messages] == ["m1", "m2"] and skip_token == "abc123"
+    assert body.startswith("Subject: hi")
+
+    exchange, listing, _, _ = graph_requests
+    assert parse_qs(exchange.content.decode())["scope"] == ["https://graph.microsoft.com/Mail.Read"]
+    assert listing.url.path == "/v1.0/me/mailFolders/junkemail/messages"
+    assert listing.headers["Prefer"] == 'IdType="ImmutableId"' and listing.url.params["$top"] == "2"
+    assert http_client.get_http_client() is client
+    assert http_client.http_client_stats()["clients_created"] == created
+
+
+def test_lifespan_opens_and_closes_the_client(monkeypatch):
+    monkeypatch.setattr(http_client, "_CLIENT", None)
+
+    async def scenario():
+        async with main._lifespan(main.app):
+            client = http_client._CLIENT
+            assert client is not None and not client.is_closed
+        return client
+
+    client = asyncio.run(scenario())
+    assert client.is_closed and http_client._CLIENT is None
+
+
+def test_details_are_batched_and_throttled_items_retried(monkeypatch):
+    batches = []
+    throttled_once = set()
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        assert request.url.path == "/v1.0/$batch"
+        subs = json.loads(request.content)["requests"]
+        batches.append(len(subs))
+        responses = []
+        for sub in subs:
+            message_id = sub["url"].split("/")[3].split("?")[0]
+            if message_id == "m3" and message_id not in throttled_once:
+                throttled_once.add(message_id)
+                responses.append({"id": sub["id"], "status": 429, "headers": {"Retry-After": "0"}, "body": {}})
+            elif message_id == "gone":
+                responses.append({"id": sub["id"], "status": 404, "body": {"error": {"code": "ErrorItemNotFound"}}})
+            else:
+                body = {"id": message_id, "subject": f"S {message_id}", "body": {"contentType": "text", "content": "code 123456"}}
+                responses.append({"id": sub["id"], "status": 200, "body": body})
+        return httpx.Response(200, json={"responses": responses})
+
+    monkeypatch.setattr(http_client, "_CLIENT", http_client.new_http_client(httpx.MockTransport(handler)))
+    ids = [f"m{i}" for i in range(24)] + ["gone"]
+    details = asyncio.run(graph_get_messages_details("at", ids))
+    assert batches == [20, 5, 1]
+    assert set(details) == set(ids) - {"gone"}
+    assert details["m3"]["subject"] == "S m3" and details["m3"]["body_text"] == "code 123456"
+
+
+def _graph_message(message_id, minute, sender="noreply@example.com"):
+    return {
+        "id": message_id,
+        "subject": f"Subject {message_id}",
+        "from": {"emailAddress": {"address": sender, "name": ""}},
+        "receivedDateTime": f"2025-10-03T10:{minute:02d}:00Z",
+        "body": {"contentType": "text", "content": f"Your code is 1000{minute:02d}"},
+    }
+
+
+class DeltaReplay:
+    """Mock Graph that replays scripted delta pages keyed by deltatoken."""
+
+    DELTA = "https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages/delta"
+
+    def __init__(self):
+        self.requests = []
+        self.rounds = {
+            None: [
+                {"value": [_graph_message("m1", 1), _graph_message("m3", 3)], "@odata.nextLink": self.DELTA + "?$skiptoken=p2"},
+                {"value": [_graph_message("m2", 2, "other@example.com")], "@odata.deltaLink": self.DELTA + "?$deltatoken=t1"},
+            ],
+            "t1": [{
+                "value": [_graph_message("m4", 4), {"id": "m1", "@removed": {"reason": "deleted"}}],
+                "@odata.deltaLink": self.DELTA + "?$deltatoken=t2",
+            }],
+            "t2": [{"value": [], "@odata.deltaLink": self.DELTA + "?$deltatoken=t2"}],
+        }
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        params = request.url.params
+        if request.url.path.endswith("/messages/delta"):
+            if "$deltatoken" in params:
+                token = params["$deltatoken"]
+                if token not in self.rounds:
+                    return httpx.Response(410, json={"error": {"code": "syncStateNotFound"}})
+                return httpx.Response(200, json=self.rounds[token][0])
+            page = 1 if params.get("$skiptoken") == "p2" else 0
+            return httpx.Response(200, json=self.rounds[None][page])
+        # Listing below the synced part, keyed on the last message shown (m2)
+        assert params["$filter"] == "receivedDateTime le 2025-10-03T10:02:00Z"
+        assert params["$orderby"] == "receivedDateTime desc"
+        return httpx.Response(200, json={"value": [_graph_message("m0", 0)]})
+
+
+def test_delta_sync_transfers_changes_and_pages_from_state(monkeypatch):
+    from api import graph_sync
+
+    replay = DeltaReplay()
+    monkeypatch.setattr(http_client, "_CLIENT", http_client.new_http_client(httpx.MockTransport(replay.handler)))
+    monkeypatch.setattr(graph_sync, "GRAPH_DELTA_MIN_INTERVAL_SECONDS", 0)
+    monkeypatch.setattr(graph_sync, "GRAPH_DELTA_WINDOW_DAYS", 3650)  # The replayed mail is from 2025
+    graph_sync.forget_graph_sync_state("u@x.com")
+
+    async def token(*args, **kwargs):
+        return "at", "graph"
+
+    monkeypatch.setattr(main, "get_outlook_access_token", token)
+
+    async def scenario():
+        req = main.MessagesRequest(credString="u@x.com||rt|cid", page_size=2)
+        first = await main.messages(req)
+        # Next polls: only what changed since the last deltaLink comes over the wire
+        recent = await main._graph_recent_messages("at", "u@x.com", None, "inbox")
+        filtered = await main._graph_recent_messages("at", "u@x.com", "Other@Example.com", "inbox")
+        # The view is exhausted after m2 (m1 is gone); the page goes on below the synced window
+        second = await main.messages(req.model_copy(update={"page_token": first["next_page_token"]}))
+        replay.rounds.pop("t2")  # expired: the folder is synced from scratch
+        resynced = await main._graph_recent_messages("at", "u@x.com", None, "inbox")
+        return first, recent, filtered, second, resynced
+
+    first, recent, filtered, second, resynced = asyncio.run(scenario())
+    assert [m["id"] for m in first["items"]] == ["m3", "m2"]
+    assert first["next_page_token"] == "delta:2025-10-03T10:02:00Z|m2"
+    assert [m["id"] for m in recent] == ["m4", "m3", "m2"]
+    assert [m["id"] for m in filtered] == ["m2"]
+    assert [m["id"] for m in second["items"]] == ["m0"] and second["next_page_token"] is None
+    assert [m["id"] for m in resynced] == ["m3", "m2", "m1"]
+
+    delta_calls = [r.url.params for r in replay.requests if r.url.path.endswith("/delta")]
+    assert delta_calls[0]["$filter"].startswith("receivedDateTime ge ")
+    assert [p.get("$deltatoken") for p in delta_calls] == [None, None, "t1", "t2", "t2", "t2", None, None]
+    assert graph_sync.graph_sync_stats()["resets"] >= 1
+
+
+def test_first_sync_is_bounded_and_paging_continues_by_received_time(monkeypatch):
+    from datetime import datetime, timedelta, timezone
+
+    from api import graph_sync
+
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    iso = lambda dt: dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def message(message_id, received):
+        return {**_graph_message(message_id, 0), "receivedDateTime": iso(received)}
+
+    recent = [message(f"m{i}", now - timedelta(minutes=10 - i)) for i in range(9, -1, -1)]  # m9 newest
+    old = message("old", now - timedelta(days=30))  # Moved into the folder after the first sync
+    delta = {
+        None: {"value": recent[0:2], "@odata.nextLink": DeltaReplay.DELTA + "?$skiptoken=p2"},
+        "p2": {"value": recent[2:4], "@odata.nextLink": DeltaReplay.DELTA + "?$skiptoken=p3"},
+        "p3": {"value": recent[4:5], "@odata.deltaLink": DeltaReplay.DELTA + "?$deltatoken=t1"},
+        "t1": {"value": [old], "@odata.deltaLink": DeltaReplay.DELTA + "?$deltatoken=t2"},
+        "t2": {"value": [], "@odata.deltaLink": DeltaReplay.DELTA + "?$deltatoken=t2"},
+    }
+    seen = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(request)
+        params = request.url.params
+        if request.url.path.endswith("/messages/delta"):
+            return httpx.Response(200, json=delta[params.get("$deltatoken") or params.get("$skiptoken")])
+        # The folder as Graph would list it: received at or before the cutoff, newest first
+        cutoff = params["$filter"].split()[-1]
+        folder = sorted(recent + [old], key=lambda m: m["receivedDateTime"], reverse=True)
+        rows = [m for m in folder if m["receivedDateTime"] <= cutoff]
+        top = int(params["$top"])
+        page = {"value": rows[:top]}
+        if len(rows) > top:
+            page["@odata.nextLink"] = "https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages?$skiptoken=x"
+        return httpx.Response(200, json=page)
+
+    async def token(*args, **kwargs):
+        return "at", "graph"
+
+    monkeypatch.setattr(http_client, "_CLIENT", http_client.new_http_client(httpx.MockTransport(handler)))
+    monkeypatch.setattr(main, "get_outlook_access_token", token)
+    monkeypatch.setattr(graph_sync, "GRAPH_DELTA_MIN_INTERVAL_SECONDS", 0)
+    graph_sync.forget_graph_sync_state("b@x.com")
+
+    async def scenario():
+        req = main.MessagesRequest(credString="b@x.com||rt|cid", page_size=3)
+        pages = [await main.messages(req)]
+        partial = main.get_graph_sync_state("b@x.com").complete
+        while pages[-1]["next_page_token"]:
+            pages.append(await main.messages(req.model_copy(update={"page_token": pages[-1]["next_page_token"]})))
+        return pages, partial
+
+    pages, partial = asyncio.run(scenario())
+    first_round = [r for r in seen if r.url.path.endswith("/delta")][:2]
+    assert partial is False and len(first_round) == 2  # Page 1 waited for GRAPH_DELTA_MAX_PAGES pages only
+    assert first_round[0].url.params["$orderby"] == "receivedDateTime desc"
+    assert [[m["id"] for m in page["items"]] for page in pages] == [
+        ["m9", "m8", "m7"], ["m6", "m5", "m4"], ["m3", "m2", "m1"], ["m0", "old"],
+    ]
+    assert not any("$skip" in r.url.params for r in seen)
+    graph_sync.forget_graph_sync_state("b@x.com")
+
+
+def test_header_only_listing_and_text_bodies(monkeypatch):
+    from api.outlook_graph import graph_list_and_convert
+
+    seen = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(request)
+        if "body" in request.url.params["$select"].split(","):
+            return httpx.Response(200, json={"value": [
+                {**_graph_message("m1", 1), "body": {"contentType": "text", "content": "Your code is 482913"}}
+            ]})
+        header = {k: v for k, v in _graph_message("m1", 1).items() if k != "body"}
+        return httpx.Response(200, json={"value": [{**header, "bodyPreview": "Your code is 482913"}]})
+
+    monkeypatch.setattr(http_client, "_CLIENT", http_client.new_http_client(httpx.MockTransport(handler)))
+
+    async def scenario():
+        headers_only, _, _ = await graph_list_and_convert("at", limit=5)
+        text, _, _ = await graph_list_and_convert("at", limit=5, include_bodies=True, text_bodies=True)
+        return headers_only, text
+
+    headers_only, text = asyncio.run(scenario())
+    listing, text_listing = seen  # no $batch round for the bodies a header-only listing left out
+    assert listing.url.params["$select"].split(",").count("bodyPreview") == 1
+    assert "body" not in listing.url.params["$select"].split(",")
+    assert listing.headers["Prefer"] == 'IdType="ImmutableId"'
+    assert headers_only[0]["body_preview"] == "Your code is 482913" and not headers_only[0]["body_html"]
+    assert text_listing.headers["Prefer"] == 'IdType="ImmutableId", outlook.body-content-type="text"'
+    assert text[0]["body_text"] == "Your code is 482913" and text[0]["body_html"] == ""
+    assert main._graph_message_item(headers_only[0], "inbox")["otp"] == "482913"
+
+
+def test_default_listing_is_served_header_only_from_the_delta_state(monkeypatch):
+    from api import graph_sync
+
+    seen = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(request)
+        if request.url.path.endswith("/$batch"):
+            return httpx.Response(200, json={"responses": [
+                {"id": sub["id"], "status": 200, "body": {**_graph_message(f"m{int(sub['id']) + 1}", 0),
+                                                           "body": {"contentType": "html", "content": "<p>Full body</p>"}}}
+                for sub in json.loads(request.content)["requests"]
+            ]})
+        if request.url.path.endswith("/messages/delta"):
+            header = {k: v for k, v in _graph_message("m1", 1).items() if k != "body"}
+            return httpx.Response(200, json={
+                "value": [{**header, "bodyPreview": "Your code is 482913"}],
+                "@odata.deltaLink": DeltaReplay.DELTA + "?$deltatoken=t1",
+            })
+        return httpx.Response(200, json={"value": []})
+
+    async def token(*args, **kwargs):
+        return "at", "graph"
+
+    monkeypatch.setattr(http_client, "_CLIENT", http_client.new_http_client(httpx.MockTransport(handler)))
+    monkeypatch.setattr(main, "get_outlook_access_token", token)
+    monkeypatch.setattr(graph_sync, "GRAPH_DELTA_WINDOW_DAYS", 3650)
+    graph_sync.forget_graph_sync_state("h@x.com")
+
+    async def scenario():
+        req = main.MessagesRequest(credString="h@x.com||rt|cid", page_size=5)
+        headers_only = await main.messages(req)
+        batches_before = sum(1 for r in seen if r.url.path.endswith("/$batch"))
+        with_bodies = await main.messages(req.model_copy(update={"include_body": True}))
+        return headers_only, batches_before, with_bodies
+
+    headers_only, batches_before, with_bodies = asyncio.run(scenario())
+    delta = next(r for r in seen if r.url.path.endswith("/messages/delta"))
+    assert "bodyPreview" in delta.url.params["$select"].split(",")
+    assert "body" not in delta.url.params["$select"].split(",")
+    (item,) = headers_only["items"]
+    assert item["content"] == "" and item["html"] == "" and item["otp"] == "482913"
+    assert batches_before == 0
+    assert with_bodies["items"][0]["html"] == "<p>Full body</p>"
+    graph_sync.forget_graph_sync_state("h@x.com")
+
+
+def test_cold_otp_lists_only_the_window_and_compares_typed_times(monkeypatch):
+    from datetime import datetime, timedelta, timezone
+
+    now = datetime.now(timezone.utc)
+    iso = lambda dt: dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+    seen = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(request)
+        old, new = _graph_message("old", 1), _graph_message("new", 2)
+        old["receivedDateTime"] = iso(now - timedelta(hours=2))
+        new["receivedDateTime"] = iso(now - timedelta(minutes=2))
+        # A stale message first: only the receivedDateTime comparison keeps its code out
+        return httpx.Response(200, json={"value": [old, new]})
+
+    async def token(*args, **kwargs):
+        return "at", "graph"
+
+    monkeypatch.setattr(http_client, "_CLIENT", http_client.new_http_client(httpx.MockTransport(handler)))
+    monkeypatch.setattr(main, "get_outlook_access_token", token)
+    req = main.OtpRequest(credString="otp@x.com||rt|cid", from_="noreply@example.com", time_window_minutes=10)
+    found = asyncio.run(main.otp(req))
+
+    assert found["otp"] == "100002" and found["subject"] == "Subject new"
+    (listing,) = seen
+    window, sender = listing.url.params["$filter"].split(" and ")
+    assert window.startswith("receivedDateTime ge ") and sender == "from/emailAddress/address eq 'noreply@example.com'"
+    assert datetime.fromisoformat(window.split()[-1].replace("Z", "+00:00")) >= now - timedelta(minutes=10, seconds=5)
+    assert listing.url.params["$orderby"] == "receivedDateTime desc"
+    assert main.get_graph_sync_state("otp@x.com") is None
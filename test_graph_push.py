@@ -0,0 +1,139 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from api import graph_push, graph_sync, http_client, main, state_store
+from api.ttl_cache import TTLCache
+
+HOOK = "https://hook.example/graph/notifications"
+DELTA = "https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages/delta"
+
+
+def _message(message_id, minute):
+    return {
+        "id": message_id,
+        "subject": f"Subject {message_id}",
+        "from": {"emailAddress": {"address": "noreply@example.com", "name": ""}},
+        "receivedDateTime": f"2025-10-03T10:{minute:02d}:00Z",
+        "body": {"contentType": "text", "content": f"Your code is 4829{minute:02d}"},
+    }
+
+
+class FakeGraph:
+    """Subscriptions endpoint plus a delta query that reports one new message per round."""
+
+    def __init__(self):
+        self.requests = []
+        self.created = []
+        self.round = 0
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if request.url.path == "/v1.0/subscriptions":
+            body = json.loads(request.content)
+            self.created.append(body)
+            return httpx.Response(201, json={"id": f"sub-{len(self.created)}", **body})
+        if request.url.path.startswith("/v1.0/subscriptions/"):
+            return httpx.Response(204 if request.method == "DELETE" else 200, json={})
+        if not request.url.path.endswith("/messages/delta"):
+            return httpx.Response(200, json={"value": []})  # Nothing below the synced window
+        self.round += 1
+        return httpx.Response(200, json={
+            "value": [_message(f"m{self.round}", self.round)], "@odata.deltaLink": DELTA + "?$deltatoken=t",
+        })
+
+    def delta_calls(self):
+        return sum(1 for r in self.requests if r.url.path.endswith("/delta"))
+
+
+@pytest.fixture
+def graph(monkeypatch):
+    fake = FakeGraph()
+    monkeypatch.setattr(http_client, "_CLIENT", http_client.new_http_client(httpx.MockTransport(fake.handler)))
+    monkeypatch.setattr(state_store, "_STORE", state_store.MemoryStateStore())
+    monkeypatch.setattr(graph_sync, "GRAPH_DELTA_MIN_INTERVAL_SECONDS", 0)
+    monkeypatch.setattr(graph_sync, "GRAPH_DELTA_WINDOW_DAYS", 3650)
+    monkeypatch.setattr(graph_push, "_SUBSCRIPTIONS", {})
+    monkeypatch.setattr(graph_push, "_FAILED", TTLCache(100))
+    monkeypatch.setattr(graph_push, "_QUEUE", None)
+    monkeypatch.setattr(graph_push, "_WORKER", None)
+    monkeypatch.setattr(main, "get_graph_notification_url", lambda: HOOK)
+
+    async def token(*args, **kwargs):
+        return "at", "graph"
+
+    monkeypatch.setattr(main, "get_outlook_access_token", token)
+    graph_sync.forget_graph_sync_state("u@x.com")
+    yield fake
+    graph_sync.forget_graph_sync_state("u@x.com")
+
+
+def test_webhook_echoes_the_validation_token():
+    async def scenario():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://api") as client:
+            return await client.post("/graph/notifications", params={"validationToken": "Validation: a&b"})
+
+    resp = asyncio.run(scenario())
+    assert resp.status_code == 200 and resp.text == "Validation: a&b"
+    assert resp.headers["content-type"].startswith("text/plain")
+
+
+def test_notifications_drive_resync_and_wake_waiters(graph):
+    req = main.MessagesRequest(credString="u@x.com||rt|cid", page_size=5)
+    before = graph_push.graph_push_stats()
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://api") as client:
+
+            async def notify(client_state):
+                item = {"subscriptionId": "sub-1", "clientState": client_state, "changeType": "created"}
+                resp = await client.post("/graph/notifications", json={"value": [item]})
+                assert resp.status_code == 202
+                await graph_push._QUEUE.join()
+
+            first = await main.messages(req)
+            # Subscribed and nothing notified: served from the synced state without asking Graph
+            quiet = await main.messages(req)
+            await notify("forged")
+            still_quiet = await main.messages(req)
+            calls_while_quiet = graph.delta_calls()
+
+            waiter = asyncio.create_task(main.wait_for_graph_mail("U@x.com", 5))
+            bystander = asyncio.create_task(main.wait_for_graph_mail("v@x.com", 0.2))
+            await asyncio.sleep(0)
+            await notify(graph.created[0]["clientState"])
+            woken = await asyncio.wait_for(waiter, 1)
+            after = await main.messages(req)
+            return first, quiet, still_quiet, calls_while_quiet, woken, await bystander, after
+
+    first, quiet, still_quiet, calls_while_quiet, woken, bystander, after = asyncio.run(scenario())
+    assert [m["id"] for m in first["items"]] == ["m1"]
+    assert quiet["items"] == still_quiet["items"] == first["items"]
+    assert calls_while_quiet == 1
+    assert woken is True and bystander is False
+    assert [m["id"] for m in after["items"]] == ["m2", "m1"] and graph.delta_calls() == 2
+
+    (created,) = graph.created
+    assert created["notificationUrl"] == HOOK and created["resource"] == "me/mailFolders('inbox')/messages"
+    (subscribe,) = [r for r in graph.requests if r.url.path == "/v1.0/subscriptions"]
+    assert subscribe.headers["Prefer"] == 'IdType="ImmutableId"'
+    stats = graph_push.graph_push_stats()
+    assert stats["subscribed"] - before["subscribed"] == 1
+    assert stats["rejected"] - before["rejected"] == 1 and stats["delivered"] - before["delivered"] == 1
+
+
+def test_unsubscribe_returns_the_folder_to_polling(graph, monkeypatch):
+    req = main.MessagesRequest(credString="u@x.com||rt|cid", page_size=5)
+
+    async def scenario():
+        await main.messages(req)
+        removed = await main.graph_unsubscribe(main.PurgeRequest(credString="u@x.com||rt|cid"))
+        monkeypatch.setattr(main, "get_graph_notification_url", lambda: None)
+        await main.messages(req)
+        return removed
+
+    assert asyncio.run(scenario()) == {"unsubscribed": True}
+    assert [r.method for r in graph.requests if r.url.path.startswith("/v1.0/subscriptions/")] == ["DELETE"]
+    assert graph.delta_calls() == 2
@@ -0,0 +1,120 @@
+import asyncio
+
+import httpx
+import pytest
+
+from api import graph_scheduler, http_client
+from api.graph_scheduler import GraphScheduler, TokenBucket
+from api.outlook_graph import graph_list_messages
+
+URL = "https://graph.microsoft.com/v1.0/me/messages"
+
+
+def _use_transport(monkeypatch, handler):
+    monkeypatch.setattr(http_client, "_CLIENT", http_client.new_http_client(httpx.MockTransport(handler)))
+
+
+def test_token_bucket_spaces_reservations_past_the_burst():
+    now = [0.0]
+    bucket = TokenBucket(rate=2.0, burst=2, clock=lambda: now[0])
+    assert [bucket.take() for _ in range(4)] == [0.0, 0.0, 0.5, 1.0]
+    now[0] = 5.0  # refilled, never above the burst
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.5]
+
+
+def test_throttled_request_is_retried_after_retry_after_and_narrows_concurrency(monkeypatch):
+    answers = [
+        httpx.Response(429, headers={"Retry-After": "0.05"}),
+        httpx.Response(503),
+        httpx.Response(200, json={"value": []}),
+    ]
+    monkeypatch.setattr(graph_scheduler, "GRAPH_BACKOFF_BASE_SECONDS", 0.01)
+    _use_transport(monkeypatch, lambda request: answers.pop(0))
+    scheduler = GraphScheduler()
+    limit = scheduler.gate.limit
+
+    async def scenario():
+        start = asyncio.get_running_loop().time()
+        resp = await scheduler.request("GET", URL, "at")
+        return resp, asyncio.get_running_loop().time() - start
+
+    resp, elapsed = asyncio.run(scenario())
+    assert resp.status_code == 200 and elapsed >= 0.05
+    stats = scheduler.stats()
+    assert (stats["requests"], stats["retries"], stats["throttled"], stats["gave_up"]) == (1, 2, 2, 0)
+    # Both throttles fell in one decrease interval: halved once, then grown back a little
+    assert limit / 2 < stats["concurrency_limit"] < limit / 2 + 1
+    assert stats["in_flight"] == 0 and stats["queue_ms_max"] >= 50
+
+
+def test_per_mailbox_concurrency_is_capped_while_others_proceed(monkeypatch):
+    running = {}
+    peak = {}
+
+    async def handler(request):
+        token = request.headers["Authorization"]
+        running[token] = running.get(token, 0) + 1
+        peak[token] = max(peak.get(token, 0), running[token])
+        await asyncio.sleep(0.02)
+        running[token] -= 1
+        return httpx.Response(200, json={"value": []})
+
+    _use_transport(monkeypatch, handler)
+    scheduler = GraphScheduler()
+
+    async def call(token):
+        return await scheduler.request("GET", URL, token, headers={"Authorization": f"Bearer {token}"})
+
+    async def scenario():
+        return await asyncio.gather(*(call(token) for token in ["busy"] * 12 + ["other"] * 2))
+
+    assert all(r.status_code == 200 for r in asyncio.run(scenario()))
+    assert peak == {"Bearer busy": graph_scheduler.GRAPH_MAILBOX_CONCURRENCY, "Bearer other": 2}
+    assert scheduler.stats()["waiting"] == 0
+
+
+def test_persistent_throttling_gives_up_with_an_error(monkeypatch):
+    monkeypatch.setattr(graph_scheduler, "GRAPH_REQUEST_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(graph_scheduler, "_SCHEDULER", GraphScheduler())
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(429, headers={"Retry-After": "0"})
+
+    _use_transport(monkeypatch, handler)
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(graph_list_messages("at", limit=5))
+    assert len(calls) == 2 and graph_scheduler.graph_scheduler_stats()["gave_up"] == 1
+
+
+def test_requests_that_may_have_reached_graph_are_only_resent_when_idempotent(monkeypatch):
+    monkeypatch.setattr(graph_scheduler, "GRAPH_BACKOFF_BASE_SECONDS", 0.001)
+    calls = []
+
+    def handler(request):
+        calls.append((request.method, request.url.path))
+        if request.url.path.endswith("/read-timeout") and len([c for c in calls if c == calls[-1]]) == 1:
+            raise httpx.ReadTimeout("timed out", request=request)
+        if request.url.path.endswith("/refused") and len([c for c in calls if c == calls[-1]]) == 1:
+            raise httpx.ConnectError("refused", request=request)
+        if request.url.path.endswith("/gateway"):
+            return httpx.Response(504)
+        return httpx.Response(201)
+
+    _use_transport(monkeypatch, handler)
+    scheduler = GraphScheduler()
+
+    async def scenario():
+        get = await scheduler.request("GET", URL + "/read-timeout", "at")
+        with pytest.raises(httpx.ReadTimeout):
+            await scheduler.request("POST", URL + "/read-timeout", "at")
+        post = await scheduler.request("POST", URL + "/refused", "at")
+        gateway = await scheduler.request("POST", URL + "/gateway", "at")
+        return get, post, gateway
+
+    get, post, gateway = asyncio.run(scenario())
+    assert get.status_code == 201 and post.status_code == 201  # Not sent the first time: safe to send again
+    assert gateway.status_code == 504
+    assert [method for method, _ in calls] == ["GET", "GET", "POST", "POST", "POST", "POST"]
+    assert graph_scheduler.retry_after({"retry-after": "3"}) == 3.0 and graph_scheduler.retry_after({}) is None
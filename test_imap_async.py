@@ -0,0 +1,705 @@
+import asyncio
+import email
+import email.utils
+import re
+import time
+from contextlib import aclosing
+from datetime import datetime, timezone
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from api import imap_async, imap_sync, main
+from api.folders import first_found
+from api.imap_parse import find_text_parts, iter_fetch, message_from_buffer, parse_list
+from api.imap_async import (
+    imap_xoauth_fetch_bodies_async,
+    imap_xoauth_list_envelopes_async,
+    imap_xoauth_get_body_async,
+    imap_xoauth_recent_bodies_async,
+    imap_xoauth_watch_bodies_async,
+    parse_uid_set,
+)
+
+
+def make_message(uid: int, sender: str = "noreply@example.com", body: str = "", date: str = "") -> bytes:
+    body = body or f"Your verification code is {100000 + uid * 7}"
+    date = date or f"Mon, 06 Oct 2025 10:{uid % 60:02d}:00 +0000"
+    return (
+        f"From: Sender {uid} <{sender}>\r\n"
+        f"To: user@hotmail.com\r\n"
+        f"Subject: Message {uid}\r\n"
+        f"Date: {date}\r\n"
+        f"Content-Type: text/plain; charset=utf-8\r\n"
+        f"\r\n"
+        f"{body}\r\n"
+    ).encode()
+
+
+def _bodystructure(part) -> str:
+    """BODYSTRUCTURE of an email.message part, in the shape Outlook answers with."""
+    if part.is_multipart():
+        return "(" + "".join(_bodystructure(p) for p in part.get_payload()) + f' "{part.get_content_subtype().upper()}")'
+    payload = part.get_payload().encode()
+    params = " ".join(f'"{k.upper()}" "{v}"' for k, v in part.get_params()[1:]) or None
+    fields = [
+        f'"{part.get_content_maintype().upper()}"',
+        f'"{part.get_content_subtype().upper()}"',
+        f"({params})" if params else "NIL",
+        "NIL",
+        "NIL",
+        f'"{(part.get("Content-Transfer-Encoding") or "7BIT").upper()}"',
+        str(len(payload)),
+    ]
+    if part.get_content_maintype() == "text":
+        fields.append(str(payload.count(b"\n")))
+    fields.append("NIL")  # MD5
+    disposition = part.get_content_disposition()
+    fields.append(f'("{disposition.upper()}" NIL)' if disposition else "NIL")
+    return "(" + " ".join(fields) + ")"
+
+
+def _imap_string(value) -> str:
+    if value is None:
+        return "NIL"
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _envelope(msg) -> str:
+    """ENVELOPE as a server builds it: raw header strings, addresses split into (name adl mailbox host)."""
+    def addresses(field):
+        values = msg.get_all(field)
+        if not values:
+            return "NIL"
+        parts = []
+        for name, addr in email.utils.getaddresses(values):
+            mailbox, _, host = addr.partition("@")
+            parts.append(f"({_imap_string(name or None)} NIL {_imap_string(mailbox)} {_imap_string(host)})")
+        return "(" + "".join(parts) + ")"
+
+    unfold = lambda v: re.sub(r"\r?\n(?=[ \t])", "", v) if v is not None else None
+    return "(" + " ".join([
+        _imap_string(unfold(msg.get("Date"))),
+        _imap_string(unfold(msg.get("Subject"))),
+        addresses("From"), addresses("From"), addresses("From"),
+        addresses("To"), addresses("Cc"), addresses("Bcc"),
+        "NIL",
+        _imap_string(msg.get("Message-ID")),
+    ]) + ")"
+
+
+def _section(msg, spec: str) -> bytes:
+    part = msg
+    for number in spec.split("."):
+        if part.is_multipart():
+            part = part.get_payload()[int(number) - 1]
+    return part.get_payload().encode()
+
+
+class FakeImapServer:
+    """Tiny in-process IMAP server: enough of RFC 3501 for the client under test."""
+
+    def __init__(self, messages=None, latency: float = 0.0, capabilities: str = "IMAP4rev1 AUTH=XOAUTH2"):
+        # uid -> raw message, per mailbox
+        self.mailboxes = {"INBOX": dict(messages or {})}
+        self.latency = latency
+        # Simulated network round trip: replies are delivered this late without
+        # holding up the next command, so pipelined commands overlap
+        self.rtt = 0.0
+        self.capabilities = capabilities
+        self.uidvalidity = 1
+        self.connections = 0
+        self.commands = []
+        self._sessions = []
+        self._server = None
+
+    async def start(self) -> int:
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    def uidnext(self, mailbox: str = "INBOX") -> int:
+        return max(self.mailboxes[mailbox], default=0) + 1
+
+    def _notify(self, mailbox: str, line: str) -> None:
+        """IDLE sessions hear about changes at once, others with their next command."""
+        for session in self._sessions:
+            if session["selected"] != mailbox:
+                continue
+            if session["idle"]:
+                session["writer"].write(line.encode())
+            else:
+                session["pending"].append(line)
+
+    def deliver(self, uid: int, raw: bytes, mailbox: str = "INBOX") -> None:
+        box = self.mailboxes[mailbox]
+        box[uid] = raw
+        self._notify(mailbox, f"* {len(box)} EXISTS\r\n")
+
+    def expunge(self, uid: int, mailbox: str = "INBOX") -> None:
+        box = self.mailboxes[mailbox]
+        seq = sorted(box).index(uid) + 1
+        del box[uid]
+        self._notify(mailbox, f"* {seq} EXPUNGE\r\n")
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        selected = None
+        session = {"writer": writer, "selected": None, "idle": False, "pending": []}
+        self._sessions.append(session)
+        writer.write(b"* OK [CAPABILITY " + self.capabilities.encode() + b"] Fake IMAP ready\r\n")
+        await writer.drain()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                tag, _, rest = line.decode().rstrip("\r\n").partition(" ")
+                self.commands.append(rest)
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                upper = rest.upper()
+                if upper.startswith("CAPABILITY"):
+                    out = f"* CAPABILITY {self.capabilities}\r\n{tag} OK done\r\n"
+                elif upper.startswith("AUTHENTICATE XOAUTH2"):
+                    writer.write(b"+ \r\n")
+                    await writer.drain()
+                    await reader.readline()
+                    out = f"{tag} OK AUTHENTICATE completed\r\n"
+                elif upper.startswith("SELECT"):
+                    selected = session["selected"] = rest.split(" ", 1)[1].split(" (")[0].strip('"')
+                    session["pending"] = []
+                    box = self.mailboxes.get(selected)
+                    if box is None:
+                        out = f"{tag} NO no such mailbox\r\n"
+                    else:
+                        out = (
+                            f"* {len(box)} EXISTS\r\n"
+                            f"* OK [UIDVALIDITY {self.uidvalidity}] UIDs valid\r\n"
+                            f"* OK [UIDNEXT {self.uidnext(selected)}] Predicted next UID\r\n"
+                            f"{tag} OK [READ-WRITE] SELECT completed\r\n"
+                        )
+                elif upper == "IDLE":
+                    writer.write(("".join(session["pending"]) + "+ idling\r\n").encode())
+                    session["pending"] = []
+                    await writer.drain()
+                    session["idle"] = True
+                    await reader.readline()  # DONE
+                    session["idle"] = False
+                    out = f"{tag} OK IDLE terminated\r\n"
+                elif upper.startswith("NOOP"):
+                    out = f"{tag} OK NOOP completed\r\n"
+                elif upper.startswith("LOGOUT"):
+                    writer.write(f"* BYE\r\n{tag} OK LOGOUT completed\r\n".encode())
+                    await writer.drain()
+                    return
+                elif upper.startswith("STATUS"):
+                    box = self.mailboxes[rest.split(" ")[1].strip('"')]
+                    out = f"* STATUS INBOX (MESSAGES {len(box)} UIDNEXT {max(box, default=0) + 1})\r\n{tag} OK STATUS completed\r\n"
+                elif upper.startswith("UID SEARCH"):
+                    out = self._search(tag, selected, rest[len("UID SEARCH "):])
+                elif upper.startswith("UID FETCH"):
+                    out = self._fetch(tag, selected, rest[len("UID FETCH "):])
+                else:
+                    out = f"{tag} BAD unknown command\r\n"
+                if isinstance(out, str):
+                    out = out.encode()
+                out = "".join(session["pending"]).encode() + out
+                session["pending"] = []
+                if self.rtt:
+                    asyncio.get_running_loop().call_later(self.rtt, writer.write, out)
+                else:
+                    writer.write(out)
+                    await writer.drain()
+        finally:
+            self._sessions.remove(session)
+            writer.close()
+
+    def _search(self, tag, mailbox, criteria):
+        box = self.mailboxes[mailbox]
+        uids = sorted(box)
+        returns = re.match(r"RETURN \(([^)]*)\) ", criteria, re.IGNORECASE)
+        if returns:
+            criteria = criteria[returns.end():]
+        m = re.match(r"UID (\d+|\*)(?::(\d+|\*))?\s*", criteria, re.IGNORECASE)
+        if m:
+            top = max(box, default=0)
+            lo, hi = (top if b == "*" else int(b) for b in (m.group(1), m.group(2) or m.group(1)))
+            lo, hi = min(lo, hi), max(lo, hi)
+            uids = [u for u in uids if lo <= u <= hi]
+            criteria = criteria[m.end():]
+        m = re.match(r"SINCE (\S+)\s*", criteria, re.IGNORECASE)
+        if m:
+            day = datetime.strptime(m.group(1), "%d-%b-%Y").date()
+            uids = [u for u in uids if email.utils.parsedate_to_datetime(email.message_from_bytes(box[u])["Date"]).date() >= day]
+            criteria = criteria[m.end():]
+        m = re.match(r'FROM "(.*)"', criteria, re.IGNORECASE)
+        if m:
+            needle = m.group(1).lower().encode()
+            uids = [u for u in uids if needle in box[u].split(b"\r\n\r\n", 1)[0].lower()]
+        if returns:
+            parts = []
+            if uids and "COUNT" in returns.group(1).upper():
+                parts.append(f"COUNT {len(uids)}")
+            if uids and "MAX" in returns.group(1).upper():
+                parts.append(f"MAX {max(uids)}")
+            return f'* ESEARCH (TAG "{tag}") UID {" ".join(parts)}\r\n{tag} OK SEARCH completed\r\n'
+        return f"* SEARCH {' '.join(map(str, uids))}\r\n{tag} OK SEARCH completed\r\n"
+
+    def _fetch(self, tag, mailbox, args):
+        box = self.mailboxes[mailbox]
+        uid_set, _, items = args.partition(" ")
+        wanted = []
+        for piece in uid_set.split(","):
+            lo, _, hi = piece.partition(":")
+            hi = hi or lo
+            hi_v = max(box, default=0) if hi == "*" else int(hi)
+            wanted.extend(u for u in sorted(box) if int(lo) <= u <= hi_v)
+        out = b""
+        seqs = {u: i + 1 for i, u in enumerate(sorted(box))}
+        for uid in wanted:
+            raw = box[uid]
+            chunks = [f"UID {uid}".encode()]
+            if "ENVELOPE" in items.upper():
+                chunks.append(b"ENVELOPE " + _envelope(email.message_from_bytes(raw)).encode())
+            if "HEADER.FIELDS (FROM)" in items.upper():
+                field = b"".join(re.findall(rb"(?mi)^From:.*\r\n(?:[ \t].*\r\n)*", raw.split(b"\r\n\r\n", 1)[0] + b"\r\n"))
+                chunks.append(b"BODY[HEADER.FIELDS (FROM)] {%d}\r\n" % (len(field) + 2) + field + b"\r\n")
+            if "INTERNALDATE" in items.upper():
+                date = email.utils.parsedate_to_datetime(email.message_from_bytes(raw)["Date"])
+                chunks.append(b'INTERNALDATE "%s"' % date.strftime("%d-%b-%Y %H:%M:%S %z").encode())
+            if "FLAGS" in items.upper():
+                chunks.append(b"FLAGS (\\Seen)")
+            if "RFC822.SIZE" in items.upper():
+                chunks.append(b"RFC822.SIZE %d" % len(raw))
+            if "BODYSTRUCTURE" in items.upper():
+                chunks.append(b"BODYSTRUCTURE " + _bodystructure(email.message_from_bytes(raw)).encode())
+            if "BODY.PEEK[HEADER]" in items.upper():
+                header = raw.split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n"
+                chunks.append(b"BODY[HEADER] {%d}\r\n" % len(header) + header)
+            for spec, cap in re.findall(r"BODY\.PEEK\[([\d.]+)\]<0\.(\d+)>", items, re.IGNORECASE):
+                data = _section(email.message_from_bytes(raw), spec)[: int(cap)]
+                chunks.append(f"BODY[{spec}]<0> {{{len(data)}}}\r\n".encode() + data)
+            if "BODY.PEEK[]" in items.upper():
+                chunks.append(b"BODY[] {%d}\r\n" % len(raw) + raw)
+            out += b"* %d FETCH (" % seqs[uid] + b" ".join(chunks) + b")\r\n"
+        return out + f"{tag} OK FETCH completed\r\n".encode()
+
+
+async def _with_server(server, coro_factory):
+    port = await server.start()
+    old = (imap_async.HOST, imap_async.PORT, imap_async.USE_SSL)
+    imap_async.HOST, imap_async.PORT, imap_async.USE_SSL = "127.0.0.1", port, False
+    try:
+        return await coro_factory()
+    finally:
+        await imap_async.close_imap_async_pool()
+        imap_async.HOST, imap_async.PORT, imap_async.USE_SSL = old
+        await server.stop()
+
+
+def test_listing_pages_and_parses_literals():
+    messages = {uid: make_message(uid) for uid in range(1, 8)}
+    messages[3] = make_message(3, sender="alerts@bank.com")
+    server = FakeImapServer(messages)
+
+    async def scenario():
+        raw, next_uid, bodies, total = await imap_xoauth_list_envelopes_async("u@x.com", "tok", None, 3, None, True)
+        assert [uid for uid, _ in raw] == [7, 6, 5]
+        assert next_uid == 5 and total == 7
+        assert raw[0][1].subject == "Message 7" and raw[0][1].from_header.startswith("Sender 7")
+        assert bodies[6] == messages[6]
+
+        raw, next_uid, bodies, total = await imap_xoauth_list_envelopes_async("u@x.com", "tok", None, 3, 2, False)
+        assert [uid for uid, _ in raw] == [1] and next_uid is None and bodies == {}
+
+        raw, _, _, _ = await imap_xoauth_list_envelopes_async("u@x.com", "tok", "alerts@bank.com", 5, None)
+        assert [uid for uid, _ in raw] == [3]
+        assert await imap_xoauth_get_body_async("u@x.com", "tok", 4) == messages[4]
+        assert set(await imap_xoauth_fetch_bodies_async("u@x.com", "tok", [1, 2])) == {1, 2}
+
+    asyncio.run(_with_server(server, scenario))
+    # Everything above went over a single pooled connection
+    assert server.connections == 1
+
+
+def test_mailboxes_are_served_concurrently():
+    latency = 0.05
+    accounts = [f"user{i}@hotmail.com" for i in range(6)]
+    server = FakeImapServer({uid: make_message(uid) for uid in range(1, 21)}, latency=latency)
+
+    async def fetch(account):
+        return await imap_xoauth_list_envelopes_async(account, "tok-" + account, None, 10, None, True)
+
+    async def scenario():
+        start = time.perf_counter()
+        for account in accounts:
+            await fetch(account)
+        sequential = time.perf_counter() - start
+        # Fresh connections for the concurrent run so both sides pay the same handshakes
+        await imap_async.close_imap_async_pool()
+        start = time.perf_counter()
+        results = await asyncio.gather(*(fetch(a) for a in accounts))
+        concurrent = time.perf_counter() - start
+        return sequential, concurrent, results
+
+    sequential, concurrent, results = asyncio.run(_with_server(server, scenario))
+    assert all(len(r[0]) == 10 for r in results)
+    assert concurrent < sequential / 3
+
+
+def test_watch_returns_mail_pushed_during_idle():
+    server = FakeImapServer({1: make_message(1), 2: make_message(2)}, capabilities="IMAP4rev1 AUTH=XOAUTH2 IDLE")
+
+    async def scenario():
+        async def deliver_later():
+            await asyncio.sleep(0.2)
+            server.deliver(3, make_message(3, body="Your code is 482913"))
+
+        task = asyncio.create_task(deliver_later())
+        start = time.perf_counter()
+        watch = imap_xoauth_watch_bodies_async("u@x.com", "tok", None, timeout=5, heartbeat=5)
+        async with aclosing(watch) as batches:
+            async for batch in batches:
+                if batch:
+                    break
+        await task
+        return batch, time.perf_counter() - start
+
+    batch, elapsed = asyncio.run(_with_server(server, scenario))
+    assert list(batch) == [3] and b"482913" in bytes(batch[3])
+    assert elapsed < 2
+    # Only the new UID range was searched, never the whole mailbox
+    assert not any(c.upper() == "UID SEARCH ALL" for c in server.commands)
+    assert "IDLE" in server.commands
+
+
+def test_watch_sends_heartbeats_then_times_out():
+    server = FakeImapServer({1: make_message(1)}, capabilities="IMAP4rev1 AUTH=XOAUTH2 IDLE")
+
+    async def scenario():
+        batches = []
+        async for batch in imap_xoauth_watch_bodies_async("u@x.com", "tok", None, timeout=0.35, initial_limit=1, heartbeat=0.1):
+            batches.append(batch)
+        return batches
+
+    batches = asyncio.run(_with_server(server, scenario))
+    assert list(batches[0]) == [1]
+    assert len(batches) >= 3 and all(b == {} for b in batches[1:])
+
+
+def test_listing_syncs_incrementally_after_first_page():
+    server = FakeImapServer({uid: make_message(uid) for uid in range(1, 31)})
+
+    async def scenario():
+        def searches():
+            return [c for c in server.commands if c.upper().startswith("UID SEARCH")]
+
+        raw, next_uid, _, total = await imap_xoauth_list_envelopes_async("sync@x.com", "tok", None, 10, None)
+        assert [u for u, _ in raw] == list(range(30, 20, -1)) and total == 30 and next_uid == 21
+        assert searches() == ["UID SEARCH ALL"]
+
+        server.deliver(31, make_message(31))
+        raw, next_uid, _, total = await imap_xoauth_list_envelopes_async("sync@x.com", "tok", None, 10, None)
+        assert raw[0][0] == 31 and total == 31
+        raw, next_uid, _, _ = await imap_xoauth_list_envelopes_async("sync@x.com", "tok", None, 10, next_uid)
+        assert [u for u, _ in raw] == list(range(21, 11, -1))
+        assert searches()[1:] == ["UID SEARCH UID 31:*", "UID SEARCH UID 32:*"]
+
+        # An expunge the server cannot describe (no QRESYNC) forces one full resync
+        server.expunge(25)
+        raw, _, _, total = await imap_xoauth_list_envelopes_async("sync@x.com", "tok", None, 10, None)
+        assert total == 30 and 25 not in [u for u, _ in raw]
+        assert searches()[-1] == "UID SEARCH ALL"
+
+        # A new UIDVALIDITY (seen by a fresh SELECT) throws the cached UIDs away
+        await imap_async.close_imap_async_pool()
+        server.uidvalidity = 2
+        await imap_xoauth_list_envelopes_async("sync@x.com", "tok", None, 10, None)
+        assert searches()[-1] == "UID SEARCH ALL"
+        state = imap_sync.get_sync_state("sync@x.com")
+        assert state.uidvalidity == 2 and state.uidnext == 32
+
+    asyncio.run(_with_server(server, scenario))
+    assert imap_sync.imap_sync_stats()["uidvalidity_changes"] >= 1
+
+
+def test_filtered_paging_uses_esearch_and_uid_windows():
+    messages = {uid: make_message(uid, sender="otp@svc.com" if uid % 7 == 0 else "news@list.com") for uid in range(1, 1001)}
+    server = FakeImapServer(messages, capabilities="IMAP4rev1 AUTH=XOAUTH2 ESEARCH")
+    expected = sorted((u for u in messages if u % 7 == 0), reverse=True)
+
+    async def scenario():
+        seen, token = [], None
+        raw, token, _, total = await imap_xoauth_list_envelopes_async("f@x.com", "tok", "otp@svc.com", 20, None)
+        assert total == len(expected)
+        seen += [u for u, _ in raw]
+        while token:
+            raw, token, _, _ = await imap_xoauth_list_envelopes_async("f@x.com", "tok", "otp@svc.com", 20, token)
+            seen += [u for u, _ in raw]
+        return seen
+
+    assert asyncio.run(_with_server(server, scenario)) == expected
+    searches = [c for c in server.commands if c.upper().startswith("UID SEARCH")]
+    assert searches[0] == 'UID SEARCH RETURN (COUNT MAX) FROM "otp@svc.com"'
+    # Every other search is bounded by a UID range
+    assert all(c.startswith("UID SEARCH UID ") for c in searches[1:])
+
+
+def test_large_mailbox_pages_with_status_instead_of_search_all(monkeypatch):
+    monkeypatch.setattr(imap_async, "IMAP_FULL_SYNC_MAX_MESSAGES", 50)
+    server = FakeImapServer({uid: make_message(uid) for uid in range(1, 501)})
+
+    async def scenario():
+        raw, token, _, total = await imap_xoauth_list_envelopes_async("big@x.com", "tok", None, 20, None)
+        assert total == 500 and [u for u, _ in raw] == list(range(500, 480, -1)) and token == 481
+        raw, token, _, _ = await imap_xoauth_list_envelopes_async("big@x.com", "tok", None, 20, token)
+        assert [u for u, _ in raw] == list(range(480, 460, -1))
+
+    asyncio.run(_with_server(server, scenario))
+    assert "STATUS \"INBOX\" (MESSAGES UIDNEXT)" in server.commands
+    assert "UID SEARCH ALL" not in server.commands
+
+
+def test_parse_list_handles_literals_and_sections():
+    tree = parse_list([b'* 3 FETCH (UID 9 BODY[HEADER.FIELDS (FROM)]<0> ', b"From: a\r\n", b' FLAGS (\\Seen) X "q\\"s" NIL)'])
+    assert tree == ["*", 3, "FETCH", ["UID", 9, "BODY[HEADER.FIELDS (FROM)]<0>", b"From: a\r\n", "FLAGS", ["\\Seen"], "X", b'q"s', None]]
+    structure = parse_list([b'((("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 10 1 NIL NIL)'
+                            b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "BASE64" 20 1 NIL NIL) "ALTERNATIVE")'
+                            b'("APPLICATION" "PDF" NIL NIL NIL "BASE64" 9000 NIL ("ATTACHMENT" NIL) NIL) "MIXED")'])[0]
+    plain, html = find_text_parts(structure)
+    assert (plain.section, plain.encoding, plain.charset) == ("1.1", "quoted-printable", "utf-8")
+    assert (html.section, html.content_type) == ("1.2", "text/html")
+    single, _ = find_text_parts(parse_list([b'("TEXT" "PLAIN" NIL NIL NIL "7BIT" 5 1)'])[0])
+    assert single.section == "1"
+
+
+def test_partial_body_fetch_skips_attachments():
+    big = MIMEMultipart("mixed")
+    big["From"] = "Shop <news@example.com>"
+    big["Subject"] = "Newsletter"
+    big["Date"] = "Mon, 06 Oct 2025 10:00:00 +0000"
+    alternative = MIMEMultipart("alternative")
+    alternative.attach(MIMEText("Your code is 424242 " + "lorem ipsum " * 2000, "plain", "utf-8"))
+    alternative.attach(MIMEText("<p>Your code is <b>424242</b></p>", "html", "utf-8"))
+    big.attach(alternative)
+    big.attach(MIMEApplication(b"\x00" * 300_000, Name="catalog.pdf"))
+    big_raw = big.as_bytes().replace(b"\n", b"\r\n")
+    server = FakeImapServer({1: make_message(1), 2: big_raw})
+
+    async def scenario():
+        bodies = await imap_xoauth_fetch_bodies_async("user@hotmail.com", "tok", [1, 2], max_body_bytes=4096)
+        full = await imap_xoauth_fetch_bodies_async("user@hotmail.com", "tok", [2])
+        return bodies, full
+
+    bodies, full = asyncio.run(_with_server(server, scenario))
+    assert bodies[1] == make_message(1)  # under the cap: fetched whole
+    assert full[2] == big_raw
+    assert len(bodies[2]) < 12_000 < len(big_raw)
+    msg = message_from_buffer(bodies[2])
+    assert msg["Subject"] == "Newsletter" and msg["Date"]
+    parts = {p.get_content_type(): p.get_payload(decode=True).decode() for p in msg.walk() if not p.is_multipart()}
+    assert "424242" in parts["text/plain"] and "<b>424242</b>" in parts["text/html"]
+    assert any("BODY.PEEK[1.1]<0.4096> BODY.PEEK[1.2]<0.4096>" in c for c in server.commands)
+    assert not any("BODY.PEEK[2]" in c for c in server.commands)
+
+
+def test_iter_fetch_slices_literals_without_copying():
+    raw = make_message(5)
+    reply = bytearray(
+        b"* 2 EXISTS\r\n"
+        b"* 1 FETCH (UID 5 RFC822.SIZE %d FLAGS (\\Seen \\Flagged) BODY[] {%d}\r\n" % (len(raw), len(raw))
+        + raw
+        + b' INTERNALDATE "06-Oct-2025 10:05:00 +0000")\r\n'
+        b"* 2 FETCH (FLAGS ())\r\n"
+        b'* 3 FETCH (UID 7 BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" {5}\r\nutf-8) NIL NIL "7BIT" 5 1))\r\n'
+    )
+    records = list(iter_fetch(reply))
+    assert [r.uid for r in records] == [5, None, 7]
+    first = records[0]
+    assert (first.size, first.flags) == (len(raw), ("\\Seen", "\\Flagged"))
+    body = first.items["BODY[]"]
+    assert isinstance(body, memoryview) and body.obj is reply and body == raw
+    assert bytes(first.items["INTERNALDATE"]) == b"06-Oct-2025 10:05:00 +0000"
+    assert message_from_buffer(body)["Subject"] == "Message 5"
+    plain, _ = find_text_parts(records[2].items["BODYSTRUCTURE"])
+    assert (plain.section, plain.charset) == ("1", "utf-8")
+
+
+def test_warm_page_with_bodies_is_one_round_trip():
+    server = FakeImapServer({uid: make_message(uid) for uid in range(1, 31)})
+
+    async def scenario():
+        # Cold call builds the sync state and leaves a pooled connection
+        await imap_xoauth_list_envelopes_async("rt@x.com", "tok", None, 10, None, True)
+        server.rtt = 0.1
+        server.deliver(31, make_message(31))
+        sent = len(server.commands)
+        start = time.perf_counter()
+        page = await imap_xoauth_list_envelopes_async("rt@x.com", "tok", None, 10, None, True)
+        elapsed = time.perf_counter() - start
+        server.rtt = 0.0
+        return page, elapsed, server.commands[sent:]
+
+    (raw, next_uid, bodies, total), elapsed, commands = asyncio.run(_with_server(server, scenario))
+    assert [uid for uid, _ in raw] == list(range(31, 21, -1))
+    assert next_uid == 22 and total == 31
+    assert sorted(bodies) == list(range(22, 32)) and bytes(bodies[31]) == make_message(31)
+    assert [c.split(" ")[:2] for c in commands] == [["UID", "SEARCH"], ["UID", "FETCH"]]
+    assert elapsed < 0.18  # one 0.1 s round trip, not one per command
+
+
+def test_envelope_listing_matches_header_listing():
+    from api.main import _imap_summary_from_envelope, _imap_summary_from_header
+
+    def message(uid, from_, to, subject):
+        return (
+            f"From: {from_}\r\nTo: {to}\r\nSubject: {subject}\r\n"
+            f"Date: Mon, 06 Oct 2025 10:{uid:02d}:00 +0000\r\nMessage-ID: <{uid}@example.com>\r\n"
+            f"Content-Type: text/plain\r\n\r\ncode {uid}\r\n"
+        ).encode()
+
+    messages = {
+        1: message(1, "Sender 1 <a@example.com>", "user@hotmail.com", "Plain subject"),
+        2: message(2, '"Doe, John" <john@example.com>', "a@x.com, B <b@x.com>", "Comma name"),
+        3: message(3, '"Microsoft account team" <ms@example.com>', "user@hotmail.com", "Needless quotes"),
+        4: message(4, "=?utf-8?B?VHLhuqduIFbEg24gQQ==?= <vn@example.com>", "user@hotmail.com", "=?utf-8?Q?M=C3=A3_x=C3=A1c_minh?="),
+        5: message(5, "bare@example.com", "user@hotmail.com", "No display name"),
+    }
+    server = FakeImapServer(messages)
+
+    async def scenario():
+        return await imap_xoauth_list_envelopes_async("env@x.com", "tok", None, 10, None, True)
+
+    rows, _, bodies, total = asyncio.run(_with_server(server, scenario))
+    assert [uid for uid, _ in rows] == [5, 4, 3, 2, 1] and total == 5
+    # The listing returns what parsing each message's own header returns
+    by_header = {uid: _imap_summary_from_header(email.message_from_bytes(raw)) for uid, raw in messages.items()}
+    by_envelope = {uid: _imap_summary_from_envelope(env) for uid, env in rows}
+    assert by_envelope == by_header
+    assert by_envelope[2]["from_"] == '"Doe, John" <john@example.com>'
+    assert by_envelope[3]["from_"] == '"Microsoft account team" <ms@example.com>'
+    assert by_envelope[4]["from_"] == "Trần Văn A <vn@example.com>"
+    assert by_envelope[5]["from_"] == "bare@example.com"
+    assert by_envelope[2]["to"] == ["a@x.com", "b@x.com"]
+    assert by_envelope[4]["subject"] == "Mã xác minh"
+    env = dict(rows)[1]
+    assert (env.flags, env.internaldate, env.message_id) == (("\\Seen",), "06-Oct-2025 10:01:00 +0000", "<1@example.com>")
+    assert b"code 1" in bytes(bodies[1])
+    assert not any("RFC822.HEADER" in c for c in server.commands)
+
+
+def test_folders_are_merged_by_date_and_paged_together():
+    server = FakeImapServer({uid: make_message(uid) for uid in (5, 15, 25, 35)})
+    server.mailboxes["Junk"] = {uid: make_message(uid) for uid in (10, 20, 30)}
+    folders = ["inbox", "junk"]
+
+    def request(token=None):
+        return main.MessagesRequest(credString="x", folders=folders, page_size=3, page_token=token, include_body=True)
+
+    async def scenario():
+        pages = []
+        token = None
+        while True:
+            page = await main._imap_messages_multi("u@x.com", "tok", request(token), folders, 3)
+            pages.append(page)
+            token = page["next_page_token"]
+            if token is None:
+                return pages
+
+    pages = asyncio.run(_with_server(server, scenario))
+    assert [[(i["folder"], i["id"]) for i in page["items"]] for page in pages] == [
+        [("inbox", "35"), ("junk", "30"), ("inbox", "25")],
+        [("junk", "20"), ("inbox", "15"), ("junk", "10")],
+        [("inbox", "5")],
+    ]
+    assert pages[0]["total"] == 7 and pages[1]["total"] is None
+    assert pages[0]["items"][1]["otp"] == str(100000 + 30 * 7)
+
+
+def test_first_found_cancels_the_other_folder_scans():
+    cancelled = []
+
+    async def scan(folder):
+        if folder == "broken":
+            raise RuntimeError("no such folder")
+        if folder == "slow":
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(folder)
+                raise
+        if folder == "junk":
+            await asyncio.sleep(0.01)
+            return {"otp": "123456", "folder": folder}
+        return None
+
+    async def scenario():
+        found = await first_found(["inbox", "broken", "slow", "junk"], scan)
+        missing = await first_found(["inbox"], scan)
+        try:
+            await first_found(["inbox", "broken"], scan)
+        except RuntimeError:
+            failed = True
+        else:
+            failed = False
+        return found, missing, failed
+
+    found, missing, failed = asyncio.run(scenario())
+    assert found == {"otp": "123456", "folder": "junk"}
+    assert cancelled == ["slow"]
+    assert missing is None and failed
+
+
+def test_mail_store_serves_repeat_pages_and_bodies(tmp_path, monkeypatch):
+    from api import mail_store
+
+    monkeypatch.setattr(mail_store, "_STORE", mail_store.MailStore(tmp_path))
+    monkeypatch.setattr(mail_store, "_CONFIGURED", True)
+    messages = {uid: make_message(uid) for uid in range(1, 8)}
+    server = FakeImapServer(messages)
+
+    async def scenario():
+        first = await imap_xoauth_list_envelopes_async("disk@x.com", "tok", None, 3, None, True)
+        sent = len(server.commands)
+        again = await imap_xoauth_list_envelopes_async("disk@x.com", "tok", None, 3, None, True)
+        repeat_commands = server.commands[sent:]
+        sent = len(server.commands)
+        body = await imap_xoauth_get_body_async("disk@x.com", "tok", 6)
+        return first, again, repeat_commands, body, server.commands[sent:]
+
+    first, again, repeat_commands, body, body_commands = asyncio.run(_with_server(server, scenario))
+    assert [uid for uid, _ in again[0]] == [uid for uid, _ in first[0]] == [7, 6, 5]
+    assert again[0] == first[0]
+    assert {uid: bytes(b) for uid, b in again[2].items()} == {uid: messages[uid] for uid in (7, 6, 5)}
+    # The repeat page only probed for new mail past UIDNEXT; rows and bodies came from disk
+    assert [c.split(" (")[0] for c in repeat_commands if "FETCH" in c] == ["UID FETCH 8:*"]
+    assert body == messages[6] and body_commands == []
+
+
+def test_recent_bodies_only_downloads_messages_inside_the_window():
+    dates = {
+        1: "Sat, 04 Oct 2025 10:00:00 +0000",
+        2: "Sun, 05 Oct 2025 09:00:00 +0000",
+        3: "Mon, 06 Oct 2025 09:50:00 +0000",
+        4: "Mon, 06 Oct 2025 12:04:00 +0200",  # 10:04 UTC
+        5: "Mon, 06 Oct 2025 10:05:00 +0000",
+        6: "Mon, 06 Oct 2025 10:06:00 +0000",
+    }
+    server = FakeImapServer({uid: make_message(uid, date=date) for uid, date in dates.items()})
+    since = datetime(2025, 10, 6, 10, 0, tzinfo=timezone.utc)
+
+    async def scenario():
+        return await imap_xoauth_recent_bodies_async("u@x.com", "tok", None, since, 10)
+
+    rows, bodies = asyncio.run(_with_server(server, scenario))
+    assert [uid for uid, _ in rows] == [6, 5, 4]
+    assert rows[2][1] == datetime(2025, 10, 6, 10, 4, tzinfo=timezone.utc)
+    assert set(bodies) == {4, 5, 6}
+    # The day-granular SEARCH starts a day early; INTERNALDATE drops 2 and 3 before any body is fetched
+    assert "UID SEARCH SINCE 5-Oct-2025" in server.commands
+    body_fetches = [c.split(" ")[2] for c in server.commands if c.startswith("UID FETCH") and "BODY" in c.upper()]
+    assert [set(parse_uid_set(c.encode())) for c in body_fetches] == [{4, 5, 6}]
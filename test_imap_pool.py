@@ -0,0 +1,145 @@
+import asyncio
+
+import pytest
+
+from api import imap_pool
+from api.imap_pool import AsyncImapConnectionPool
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeImap:
+    """connect / noop / logout callables that record what the pool did with each connection."""
+
+    def __init__(self):
+        self.opened = []
+        self.closed = []
+        self.noops = 0
+        self.healthy = True
+
+    async def connect(self, email_addr, access_token, mailbox):
+        conn = (email_addr, access_token, mailbox, len(self.opened))
+        self.opened.append(conn)
+        return conn
+
+    async def noop(self, conn):
+        self.noops += 1
+        return self.healthy
+
+    async def close(self, conn):
+        self.closed.append(conn)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(imap_pool.time, "monotonic", clock)
+    return clock
+
+
+def _pool(fake, **kwargs):
+    options = dict(max_idle_seconds=300, max_per_account=3, noop_after_seconds=5)
+    options.update(kwargs)
+    return AsyncImapConnectionPool(fake.connect, fake.noop, fake.close, **options)
+
+
+async def _use(pool, email_addr="u@x.com", token="tok", mailbox="INBOX"):
+    async with pool.connection(email_addr, token, mailbox) as conn:
+        return conn
+
+
+def test_reuse_checks_health_with_noop_only_after_a_pause(clock):
+    fake = FakeImap()
+    pool = _pool(fake)
+
+    async def scenario():
+        first = await _use(pool)
+        clock.now += 1
+        again = await _use(pool)  # Used a second ago: no NOOP
+        noops_when_fresh = fake.noops
+        clock.now += 10
+        checked = await _use(pool)
+        fake.healthy = False
+        clock.now += 10
+        replaced = await _use(pool)
+        return first, again, noops_when_fresh, checked, replaced
+
+    first, again, noops_when_fresh, checked, replaced = asyncio.run(scenario())
+    assert first is again is checked and noops_when_fresh == 0
+    assert replaced is not first and fake.closed == [first] and fake.noops == 2
+    stats = pool.stats()
+    assert stats["hits"] == 2 and stats["misses"] == 2 and stats["health_failures"] == 1
+    assert stats["idle"] == 1 and stats["in_use"] == 0
+
+
+def test_idle_connections_expire(clock):
+    fake = FakeImap()
+    pool = _pool(fake, max_idle_seconds=60)
+
+    async def scenario():
+        first = await _use(pool)
+        clock.now += 61
+        return first, await _use(pool)
+
+    first, second = asyncio.run(scenario())
+    assert second is not first and fake.closed == [first]
+    assert pool.stats()["idle_evictions"] == 1 and fake.noops == 0
+
+
+def test_connections_over_the_account_cap_are_not_kept(clock):
+    fake = FakeImap()
+    pool = _pool(fake, max_per_account=2)
+
+    async def scenario():
+        async with pool.connection("u@x.com", "tok") as a, pool.connection("U@x.com", "tok") as b:
+            async with pool.connection("u@x.com", "tok", "Junk") as extra:
+                pass
+            # Other accounts have their own cap
+            other = await _use(pool, "v@x.com")
+        return a, b, extra, other
+
+    a, b, extra, other = asyncio.run(scenario())
+    assert fake.closed == [extra]
+    stats = pool.stats()
+    assert stats["overflow"] == 1 and stats["idle"] == 3 and stats["accounts"] == 2
+
+
+def test_new_access_token_evicts_the_accounts_connections(clock):
+    fake = FakeImap()
+    pool = _pool(fake)
+
+    async def scenario():
+        inbox = await _use(pool, token="old")
+        junk = await _use(pool, token="old", mailbox="Junk")
+        other = await _use(pool, "v@x.com", token="old")
+        async with pool.connection("u@x.com", "old") as held:
+            fresh = await _use(pool, token="new")
+        # Checked out under the old token: closed on return instead of pooled
+        return inbox, junk, other, held, fresh, await _use(pool, token="new")
+
+    inbox, junk, other, held, fresh, reused = asyncio.run(scenario())
+    assert set(fake.closed) == {junk, held} and held is inbox
+    assert fresh is not inbox and reused is fresh and other not in fake.closed
+    assert pool.stats()["token_evictions"] == 1
+
+
+def test_failed_use_discards_the_connection(clock):
+    fake = FakeImap()
+    pool = _pool(fake)
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            async with pool.connection("u@x.com", "tok") as conn:
+                raise RuntimeError("BAD reply")
+        return conn, await _use(pool)
+
+    broken, second = asyncio.run(scenario())
+    assert fake.closed == [broken] and second is not broken
+    stats = pool.stats()
+    assert stats["discarded"] == 1 and stats["misses"] == 2 and stats["in_use"] == 0
@@ -0,0 +1,78 @@
+import asyncio
+import threading
+
+from api.mail_store import KIND_BODY, KIND_ENVELOPE, MailStore, body_kind
+
+
+def test_entries_round_trip_and_share_blobs(tmp_path):
+    store = MailStore(tmp_path)
+    inbox = store.mailbox("User@Hotmail.com", "INBOX", 7)
+    inbox.put(KIND_BODY, {1: b"same body", 2: memoryview(b"same body"), 3: b"other"})
+    assert inbox.get(KIND_BODY, [1, 2, 3, 4]) == {1: b"same body", 2: b"same body", 3: b"other"}
+    assert inbox.get(KIND_ENVELOPE, [1]) == {}
+    # Identical bodies are one blob on disk
+    assert store.stats()["bytes"] == len(b"same body") + len(b"other")
+    assert len(list((tmp_path / "blobs").rglob("*"))) == 2 + 2  # two shard dirs, two blobs
+
+    # Reopening finds the same data; the account key is case-insensitive
+    store.close()
+    store = MailStore(tmp_path)
+    assert store.mailbox("user@hotmail.com", "INBOX", 7).get(KIND_BODY, [3]) == {3: b"other"}
+    assert store.mailbox("user@hotmail.com", "Junk", 7).get(KIND_BODY, [3]) == {}
+
+
+def test_uidvalidity_change_drops_old_generation(tmp_path):
+    store = MailStore(tmp_path)
+    store.mailbox("u@x.com", "INBOX", 1).put(KIND_BODY, {1: b"old"})
+    store.mailbox("u@x.com", "INBOX", 2).put(KIND_BODY, {1: b"new"})
+    assert store.mailbox("u@x.com", "INBOX", 1).get(KIND_BODY, [1]) == {}
+    assert store.mailbox("u@x.com", "INBOX", 2).get(KIND_BODY, [1]) == {1: b"new"}
+    assert store.stats()["bytes"] == 3
+
+
+def test_eviction_keeps_recently_read_entries(tmp_path, monkeypatch):
+    store = MailStore(tmp_path, max_bytes=1000)
+    inbox = store.mailbox("u@x.com", "INBOX", 1)
+    clock = iter(range(1000))
+    monkeypatch.setattr("api.mail_store.time.time", lambda: next(clock))
+    for uid in range(1, 5):
+        inbox.put(KIND_BODY, {uid: bytes([uid]) * 200})
+    inbox.get(KIND_BODY, [1])  # 1 is now the most recently read
+    inbox.put(KIND_BODY, {5: b"5" * 200})  # 1000 bytes: over the budget's 90% mark after this
+    inbox.put(KIND_BODY, {6: b"6" * 200})
+    kept = inbox.get(KIND_BODY, range(1, 7))
+    assert set(kept) == {1, 5, 6, 4} and store.stats()["bytes"] <= 900
+
+
+def test_purge_account_and_capped_kinds(tmp_path):
+    store = MailStore(tmp_path)
+    store.mailbox("a@x.com", "INBOX", 1).put(body_kind(4096), {1: b"capped"})
+    store.mailbox("a@x.com", "Junk", 3).put(KIND_BODY, {1: b"junk"})
+    store.graph("a@x.com").put("graph", {"AAMk-id": b"{}"})
+    store.mailbox("b@x.com", "INBOX", 1).put(KIND_BODY, {1: b"keep"})
+    assert store.mailbox("a@x.com", "INBOX", 1).get(KIND_BODY, [1]) == {}
+    assert store.purge_account("A@x.com") == 3
+    assert store.stats()["entries"] == 1 and store.stats()["bytes"] == 4
+    assert store.mailbox("b@x.com", "INBOX", 1).get(KIND_BODY, [1]) == {1: b"keep"}
+
+
+def test_async_access_runs_off_the_event_loop(tmp_path, monkeypatch):
+    store = MailStore(tmp_path)
+    inbox = store.mailbox("u@x.com", "INBOX", 1)
+    threads = []
+    put = MailStore.put
+
+    def recording_put(self, *args):
+        threads.append(threading.get_ident())
+        return put(self, *args)
+
+    monkeypatch.setattr(MailStore, "put", recording_put)
+
+    async def scenario():
+        # Concurrent writers take turns on the shared connection
+        await asyncio.gather(*(inbox.put_async(KIND_BODY, {uid: b"body %d" % uid}) for uid in range(20)))
+        return await inbox.get_async(KIND_BODY, range(20))
+
+    found = asyncio.run(scenario())
+    assert found == {uid: b"body %d" % uid for uid in range(20)}
+    assert len(threads) == 20 and threading.get_ident() not in threads
@@ -0,0 +1,42 @@
+from api.main import _imap_otp_from_bodies
+from api.otp_utils import window_start
+from api.parse_cache import ParseCache, message_key, parse_cache_stats
+
+
+def test_lru_respects_byte_budget_and_counts_hits():
+    cache = ParseCache(max_bytes=3 * (256 + 100))
+    calls = []
+
+    def compute(n):
+        calls.append(n)
+        return "x" * 100
+
+    for n in (1, 2, 3):
+        cache.get_or_compute(n, lambda: compute(n))
+    cache.get_or_compute(1, lambda: compute(1))  # hit; 2 is now least recently used
+    cache.get_or_compute(4, lambda: compute(4))
+    cache.get_or_compute(2, lambda: compute(2))
+    assert calls == [1, 2, 3, 4, 2]
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 5, 3)
+    assert stats["bytes"] <= cache.max_bytes and stats["evictions"] == 2
+
+
+def test_message_key_separates_parts_and_buffers():
+    assert message_key(b"ab", b"c") != message_key(b"a", b"bc")
+    assert message_key(memoryview(b"body")) == message_key(b"body")
+    assert message_key("text", None) == message_key("text", "")
+
+
+def test_otp_scan_reuses_parse_per_regex():
+    body = (
+        b"From: a@example.com\r\nSubject: Code\r\nContent-Type: text/plain\r\n\r\n"
+        b"Your code is 482913. Ref 551177\r\n"
+    )
+    since = window_start(30)
+    before = parse_cache_stats()
+    assert _imap_otp_from_bodies([(1, None)], {1: body}, None, since)["otp"] == "482913"
+    assert _imap_otp_from_bodies([(1, None)], {1: memoryview(body)}, None, since)["otp"] == "482913"
+    assert _imap_otp_from_bodies([(1, None)], {1: body}, r"Ref (\d{6})", since)["otp"] == "551177"
+    after = parse_cache_stats()
+    assert after["hits"] - before["hits"] == 1 and after["misses"] - before["misses"] == 2
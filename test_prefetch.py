@@ -0,0 +1,130 @@
+import asyncio
+
+import httpx
+import pytest
+
+from api import graph_push, http_client, main, prefetch, state_store
+from api.ttl_cache import TTLCache
+
+CRED = "u@x.com||rt|cid"
+NEXT_LINK = "https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages?%24skiptoken=p2"
+
+
+def _message(message_id, minute):
+    return {
+        "id": message_id,
+        "subject": f"Subject {message_id}",
+        "from": {"emailAddress": {"address": "noreply@example.com", "name": ""}},
+        "receivedDateTime": f"2025-10-03T10:{minute:02d}:00Z",
+        "bodyPreview": f"Preview {message_id}",
+        "body": {"contentType": "text", "content": f"Body of {message_id}"},
+    }
+
+
+@pytest.fixture
+def graph(monkeypatch):
+    seen = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(request)
+        path = request.url.path
+        if path.startswith("/v1.0/me/messages/"):
+            message_id = path.rsplit("/", 1)[-1]
+            return httpx.Response(200, json=_message(message_id, 0))
+        if request.url.params.get("$skiptoken") == "p2":
+            return httpx.Response(200, json={"value": [_message("m1", 1)]})
+        return httpx.Response(200, json={"value": [_message("m3", 3), _message("m2", 2)], "@odata.nextLink": NEXT_LINK})
+
+    async def token(*args, **kwargs):
+        return "at", "graph"
+
+    monkeypatch.setattr(http_client, "_CLIENT", http_client.new_http_client(httpx.MockTransport(handler)))
+    monkeypatch.setattr(main, "get_outlook_access_token", token)
+    monkeypatch.setattr(main, "get_prefetch_enabled", lambda: True)
+    monkeypatch.setattr(prefetch, "_CACHE", TTLCache(100))
+    monkeypatch.setattr(prefetch, "_RUNNING", {})
+    monkeypatch.setattr(prefetch, "_ACCOUNTS", {})
+    monkeypatch.setattr(prefetch, "_KEYS", TTLCache(100))
+    monkeypatch.setattr(prefetch, "_STATS", prefetch.PrefetchStats())
+    return seen
+
+
+def _settled():
+    return asyncio.gather(*prefetch._ACCOUNTS.values())
+
+
+def test_next_page_and_top_bodies_are_served_from_prefetch(graph):
+    req = main.MessagesRequest(credString=CRED, from_="noreply@example.com", page_size=2)
+
+    async def scenario():
+        first = await main.messages(req)
+        await _settled()
+        fetched = len(graph)
+        second = await main.messages(req.model_copy(update={"page_token": first["next_page_token"]}))
+        body = await main.message_body(main.MessageBodyRequest(credString=CRED, id="m3", folder="inbox"))
+        served_without_graph = len(graph) == fetched
+        # Another credential does not see this one's prefetched results
+        other = await main.message_body(main.MessageBodyRequest(credString="u@x.com||rt-2|cid", id="m2", folder="inbox"))
+        await _settled()
+        return first, second, body, served_without_graph, other
+
+    first, second, body, served_without_graph, other = asyncio.run(scenario())
+    assert [m["id"] for m in first["items"]] == ["m3", "m2"]
+    assert [m["id"] for m in second["items"]] == ["m1"] and second["next_page_token"] is None
+    assert body["id"] == "m3" and body["text"] == "Body of m3"
+    assert served_without_graph and other["text"] == "Body of m2"
+
+    stats = prefetch.prefetch_stats()
+    assert stats["page_hits"] == 1 and stats["page_misses"] == 1
+    assert stats["body_hits"] == 1 and stats["body_misses"] == 1 and stats["body_hit_rate"] == 0.5
+    # Page 2, m3, m2, then m1 from page 2
+    assert stats["fetched"] == 4 and stats["failed"] == 0
+
+
+def test_request_right_behind_waits_for_the_running_prefetch(graph):
+    req = main.MessagesRequest(credString=CRED, from_="noreply@example.com", page_size=2)
+
+    async def scenario():
+        first = await main.messages(req)
+        second = await main.messages(req.model_copy(update={"page_token": first["next_page_token"]}))
+        await _settled()
+        return second
+
+    second = asyncio.run(scenario())
+    assert [m["id"] for m in second["items"]] == ["m1"]
+    listings = [r for r in graph if r.url.path.endswith("/inbox/messages")]
+    assert len(listings) == 2  # Page 2 was listed once, by the prefetch
+    assert prefetch.prefetch_stats()["page_hits"] == 1
+
+
+def test_prefetch_is_off_by_default(graph, monkeypatch):
+    monkeypatch.setattr(main, "get_prefetch_enabled", lambda: False)
+    req = main.MessagesRequest(credString=CRED, from_="noreply@example.com", page_size=2)
+
+    async def scenario():
+        await main.messages(req)
+        return len(prefetch._ACCOUNTS)
+
+    assert asyncio.run(scenario()) == 0
+    assert len(graph) == 1 and prefetch.prefetch_stats()["fetched"] == 0
+
+
+def test_graph_notification_drops_the_accounts_prefetched_pages(graph, monkeypatch):
+    monkeypatch.setattr(state_store, "_STORE", state_store.MemoryStateStore())
+    req = main.MessagesRequest(credString=CRED, from_="noreply@example.com", page_size=2)
+
+    async def scenario():
+        first = await main.messages(req)
+        await _settled()
+        store = state_store.get_state_store()
+        await store.set("graph_subscription", "sub-1", {"email": "U@x.com", "client_state": "cs"}, 600)
+        await graph_push._deliver({"subscriptionId": "sub-1", "clientState": "cs"})
+        fetched = len(graph)
+        second = await main.messages(req.model_copy(update={"page_token": first["next_page_token"]}))
+        await _settled()
+        return second, len(graph) - fetched
+
+    second, listed_again = asyncio.run(scenario())
+    assert [m["id"] for m in second["items"]] == ["m1"] and listed_again >= 1
+    stats = prefetch.prefetch_stats()
+    assert stats["page_hits"] == 0 and stats["page_misses"] == 2 and stats["invalidated"] == 3  # Page 2, m3 and m2
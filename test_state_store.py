@@ -0,0 +1,179 @@
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+from api import state_store
+from api.state_store import (
+    MemoryStateStore, RedisStateStore, SQLiteStateStore, StateStoreError, open_state_store
+)
+
+TOKEN = {"access_token": "eyJ-secret-token", "expires_at": 1e12, "provider": "graph"}
+
+
+def test_memory_snapshot_is_encrypted_and_warm_restarts(tmp_path):
+    path = tmp_path / "state.json"
+
+    async def scenario():
+        store = MemoryStateStore(secret="s3cret", snapshot_path=path)
+        await store.set("token", "k", TOKEN, 3600)
+        await store.set("oauth_state", "gone", {"verifier": "v"}, 0.05)
+        await asyncio.sleep(0.1)
+        await store.close()
+
+        warm = MemoryStateStore(secret="s3cret", snapshot_path=path)
+        other_key = MemoryStateStore(secret="another", snapshot_path=path)
+        return await warm.get("token", "k"), await warm.get("oauth_state", "gone"), await other_key.get("token", "k")
+
+    restored, expired, wrong_key = asyncio.run(scenario())
+    assert restored == TOKEN and expired is None and wrong_key is None
+    assert b"eyJ-secret-token" not in path.read_bytes()
+
+
+def test_sqlite_is_shared_between_workers_and_pop_is_once(tmp_path):
+    url = f"sqlite:///{tmp_path / 'state.sqlite3'}"
+
+    async def scenario():
+        worker_a = open_state_store(url, secret="k")
+        worker_b = open_state_store(url, secret="k")
+        await worker_a.set("token", "k", TOKEN, 3600)
+        await worker_a.set("oauth_state", "st", {"verifier": "v"}, 600)
+        shared = await worker_b.get("token", "k")
+        first, second = await worker_b.pop("oauth_state", "st"), await worker_a.pop("oauth_state", "st")
+        await worker_a.close()
+        await worker_b.close()
+        return shared, first, second
+
+    shared, first, second = asyncio.run(scenario())
+    assert shared == TOKEN and first == {"verifier": "v"} and second is None
+    assert b"eyJ-secret-token" not in (tmp_path / "state.sqlite3").read_bytes()
+
+
+
+def test_sqlite_waits_for_locks_off_the_event_loop(tmp_path):
+    path = tmp_path / "state.sqlite3"
+
+    async def scenario():
+        store = SQLiteStateStore(path)
+        other_worker = sqlite3.connect(str(path), isolation_level=None)
+        other_worker.execute("BEGIN IMMEDIATE")
+        asyncio.get_running_loop().call_later(0.2, other_worker.execute, "COMMIT")
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        await store.set("token", "k", TOKEN, 3600)  # Waits for the other worker's write lock
+        ticker.cancel()
+        value = await store.get("token", "k")
+        await store.close()
+        other_worker.close()
+        return ticks, value
+
+    ticks, value = asyncio.run(scenario())
+    assert ticks >= 10 and value == TOKEN
+
+
+class FakeRedis:
+    """Just enough of a Redis server: AUTH, SELECT, GET, SET ... PX, GETDEL."""
+
+    def __init__(self):
+        self.data = {}
+        self.commands = []
+        self.connections = 0
+        self.writers = []
+        self.delay = 0.0  # Before each reply
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.writers.append(writer)
+        try:
+            while True:
+                header = await reader.readline()
+                if not header:
+                    break
+                args = []
+                for _ in range(int(header[1:])):
+                    size = int((await reader.readline())[1:])
+                    args.append((await reader.readexactly(size + 2))[:-2])
+                self.commands.append(args[0].decode().upper())
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                writer.write(self.reply(args))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def reply(self, args):
+        cmd = args[0].decode().upper()
+        if cmd in ("AUTH", "SELECT"):
+            return b"+OK\r\n"
+        if cmd == "SET":
+            self.data[args[1]] = (args[2], time.time() + int(args[4]) / 1000)
+            return b"+OK\r\n"
+        if cmd in ("GET", "GETDEL"):
+            value, expires_at = self.data.get(args[1], (None, 0))
+            if cmd == "GETDEL":
+                self.data.pop(args[1], None)
+            if value is None or expires_at <= time.time():
+                return b"$-1\r\n"
+            return b"$%d\r\n%s\r\n" % (len(value), value)
+        return b"-ERR unknown command\r\n"
+
+
+def test_redis_backend_against_stand_in_server():
+    fake = FakeRedis()
+
+    async def scenario():
+        server = await asyncio.start_server(fake.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        store = RedisStateStore.from_url(f"redis://:pw@127.0.0.1:{port}/2", secret="k")
+        await store.set("token", "k", TOKEN, 3600)
+        got = await store.get("token", "k")
+        # The server drops the idle connection; the next command reconnects
+        for writer in fake.writers:
+            writer.close()
+        await asyncio.sleep(0.05)
+        await store.set("oauth_state", "st", {"verifier": "v"}, 600)
+        popped, again = await store.pop("oauth_state", "st"), await store.pop("oauth_state", "st")
+        await store.close()
+        server.close()
+        await server.wait_closed()
+        return got, popped, again
+
+    got, popped, again = asyncio.run(scenario())
+    assert got == TOKEN and popped == {"verifier": "v"} and again is None
+    assert fake.connections == 2 and fake.commands.count("AUTH") == 2 and fake.commands.count("SELECT") == 2
+    assert all(b"eyJ-secret-token" not in value for value, _ in fake.data.values())
+    assert set(fake.data) == {b"hotmail:token:k"}
+
+
+def test_redis_reply_of_a_cancelled_command_never_answers_the_next_one(monkeypatch):
+    fake = FakeRedis()
+    monkeypatch.setattr(state_store, "STATE_STORE_REDIS_TIMEOUT_SECONDS", 0.2)
+
+    async def scenario():
+        server = await asyncio.start_server(fake.handle, "127.0.0.1", 0)
+        store = RedisStateStore.from_url(f"redis://127.0.0.1:{server.sockets[0].getsockname()[1]}")
+        await store.set("token", "alice", {"access_token": "ALICE"}, 3600)
+        await store.set("token", "bob", {"access_token": "BOB"}, 3600)
+        fake.delay = 0.1
+        cancelled = asyncio.create_task(store.get("token", "alice"))
+        await asyncio.sleep(0.02)  # Sent, reply not read yet
+        cancelled.cancel()
+        bob = await store.get("token", "bob")
+        # A reply slower than the timeout fails the command instead of hanging it
+        fake.delay = 0.5
+        with pytest.raises(StateStoreError):
+            await store.get("token", "bob")
+        await store.close()
+        server.close()
+        return bob
+
+    assert asyncio.run(scenario()) == {"access_token": "BOB"}
+    assert fake.connections >= 2
@@ -0,0 +1,199 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from api import main, outlook_graph, state_store
+from api.constants import TOKEN_REFRESH_ACTIVE_SECONDS
+
+
+@pytest.fixture(autouse=True)
+def _empty_token_cache(monkeypatch):
+    async def no_imap_scope(client_id, refresh_token):
+        raise RuntimeError("invalid_scope")
+
+    # Exchanges race both providers; keep the IMAP one off the network unless a test replaces it
+    monkeypatch.setattr(main, "exchange_refresh_token_outlook", no_imap_scope)
+    monkeypatch.setattr(state_store, "_STORE", state_store.MemoryStateStore())
+    state = (main._TOKEN_CACHE, main._TOKEN_INFLIGHT, main._TOKEN_LAST_USED, main._REFRESH_TOKENS, main._PROVIDER_MEMO)
+    for d in state:
+        d.clear()
+    yield
+    for d in state:
+        d.clear()
+
+
+def test_concurrent_callers_share_one_exchange(monkeypatch):
+    calls = []
+
+    async def exchange(client_id, refresh_token):
+        calls.append(refresh_token)
+        await asyncio.sleep(0.05)
+        return f"access-{len(calls)}", 3600, None
+
+    monkeypatch.setattr(outlook_graph, "exchange_refresh_token_graph", exchange)
+
+    async def scenario():
+        burst = await asyncio.gather(*(main.get_outlook_access_token("u@x.com", "cid", "rt") for _ in range(5)))
+        other = await main.get_outlook_access_token("u@x.com", "cid", "rt-2")
+        cached = await main.get_outlook_access_token("u@x.com", "cid", "rt")
+        return burst, other, cached
+
+    burst, other, cached = asyncio.run(scenario())
+    assert burst == [("access-1", "graph")] * 5
+    assert other == ("access-2", "graph") and cached == ("access-1", "graph")
+    assert calls == ["rt", "rt-2"]
+    assert main._TOKEN_INFLIGHT == {}
+
+
+def test_failed_exchange_reaches_every_waiter_and_is_retried(monkeypatch):
+    calls = []
+
+    async def failing(client_id, refresh_token):
+        calls.append("graph")
+        await asyncio.sleep(0.01)
+        raise RuntimeError("Token exchange failed: 400 - invalid_client")
+
+    async def failing_imap(client_id, refresh_token):
+        calls.append("imap")
+        raise RuntimeError("invalid_client")
+
+    monkeypatch.setattr(outlook_graph, "exchange_refresh_token_graph", failing)
+    monkeypatch.setattr(main, "exchange_refresh_token_outlook", failing_imap)
+
+    async def scenario():
+        first = await asyncio.gather(
+            *(main.get_outlook_access_token("u@x.com", "cid", "rt") for _ in range(3)), return_exceptions=True
+        )
+        second = await asyncio.gather(main.get_outlook_access_token("u@x.com", "cid", "rt"), return_exceptions=True)
+        return first + second
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(r, HTTPException) for r in results)
+    assert calls == ["graph", "imap", "graph", "imap"]
+
+
+def test_rotated_refresh_token_is_used_and_returned(monkeypatch):
+    calls = []
+
+    async def exchange(client_id, refresh_token):
+        calls.append(refresh_token)
+        return f"access-{len(calls)}", 3600, f"rt-{len(calls) + 1}"
+
+    monkeypatch.setattr(outlook_graph, "exchange_refresh_token_graph", exchange)
+
+    key = main._cache_key("u@x.com", "cid", "rt-1")
+    asyncio.run(main.get_outlook_access_token("u@x.com", "cid", "rt-1"))
+    main._TOKEN_CACHE.clear()  # another worker: served from the shared store
+    assert asyncio.run(main.get_outlook_access_token("u@x.com", "cid", "rt-1")) == ("access-1", "graph")
+    main._TOKEN_CACHE.clear()
+    asyncio.run(state_store.get_state_store().delete("token", key))
+    # A second exchange, with the credential the client still holds
+    asyncio.run(main.get_outlook_access_token("u@x.com", "cid", "rt-1"))
+    assert calls == ["rt-1", "rt-2"]
+    main._REFRESH_TOKENS.clear()  # the rotated token is in the shared store too
+
+    result = asyncio.run(main.current_refresh_token(main.PurgeRequest(credString="u@x.com||rt-1|cid")))
+    assert result == {"credString": "u@x.com||rt-3|cid", "rotated": True}
+    unknown = asyncio.run(main.current_refresh_token(main.PurgeRequest(credString="v@x.com||rt-9|cid")))
+    assert unknown == {"credString": "v@x.com||rt-9|cid", "rotated": False}
+
+
+def test_background_refresh_renews_only_active_accounts_near_expiry(monkeypatch):
+    calls = []
+
+    async def exchange(client_id, refresh_token):
+        calls.append(refresh_token)
+        return f"access-{refresh_token}", 3600, None
+
+    monkeypatch.setattr(outlook_graph, "exchange_refresh_token_graph", exchange)
+
+    async def scenario():
+        for rt in ("active", "idle", "fresh"):
+            await main.get_outlook_access_token("u@x.com", "cid", rt)
+        now = time.time()
+        keys = {rt: main._cache_key("u@x.com", "cid", rt) for rt in ("active", "idle", "fresh")}
+        main._TOKEN_CACHE[keys["active"]]["expires_at"] = now + 120
+        main._TOKEN_CACHE[keys["idle"]]["expires_at"] = now + 120
+        idle_since = now - 2 * TOKEN_REFRESH_ACTIVE_SECONDS
+        main._TOKEN_LAST_USED.put(keys["idle"], idle_since, idle_since + TOKEN_REFRESH_ACTIVE_SECONDS)
+        state_store._STORE = state_store.MemoryStateStore()  # no fresher copy elsewhere
+        calls.clear()
+        refreshed = await main.refresh_due_tokens(now)
+        return refreshed, main._TOKEN_CACHE[keys["active"]]["expires_at"] - now
+
+    refreshed, remaining = asyncio.run(scenario())
+    assert refreshed == 1 and calls == ["active"]
+    assert remaining > 3000
+
+
+def test_provider_is_raced_once_then_remembered(monkeypatch):
+    calls = []
+
+    async def graph(client_id, refresh_token):
+        calls.append("graph")
+        await asyncio.sleep(0.05)
+        raise RuntimeError("AADSTS70000: scope not granted")
+
+    async def imap(client_id, refresh_token):
+        calls.append("imap")
+        return f"imap-{refresh_token}", 3600, None
+
+    monkeypatch.setattr(outlook_graph, "exchange_refresh_token_graph", graph)
+    monkeypatch.setattr(main, "exchange_refresh_token_outlook", imap)
+    before = dict(main._PROVIDER_STATS)
+
+    async def scenario():
+        start = time.perf_counter()
+        first = await main.get_outlook_access_token("u@x.com", "cid", "rt")
+        raced_in = time.perf_counter() - start
+        second = await main.get_outlook_access_token("U@x.com", "cid", "rt-2")
+        return first, raced_in, second
+
+    first, raced_in, second = asyncio.run(scenario())
+    assert first == ("imap-rt", "imap") and second == ("imap-rt-2", "imap")
+    assert 0.05 <= raced_in < 0.5  # Waited for Graph to fail, not for the whole grace period
+    assert calls == ["graph", "imap", "imap"]
+    delta = {k: main._PROVIDER_STATS[k] - before[k] for k in before}
+    assert delta == {"graph": 0, "imap": 2, "raced": 1, "memo_hits": 1, "memo_stale": 0, "unsettled": 0}
+
+
+def test_graph_wins_the_race_when_both_providers_accept_the_token(monkeypatch):
+    graph_delay = 0.05
+
+    async def graph(client_id, refresh_token):
+        await asyncio.sleep(graph_delay)
+        return "graph-token", 3600, None
+
+    async def imap(client_id, refresh_token):
+        return "imap-token", 3600, None
+
+    monkeypatch.setattr(outlook_graph, "exchange_refresh_token_graph", graph)
+    monkeypatch.setattr(main, "exchange_refresh_token_outlook", imap)
+    monkeypatch.setattr(main, "PROVIDER_RACE_GRAPH_GRACE_SECONDS", 0.5)
+    memo_key = main._provider_key("u@x.com", "cid")
+
+    assert asyncio.run(main._exchange_detecting_provider("u@x.com", "cid", "rt"))[::3] == ("graph-token", "graph")
+    assert main._PROVIDER_MEMO[memo_key] == "graph"
+
+    # Graph too slow to answer within the grace period: IMAP serves, nothing is remembered
+    graph_delay = 1.0
+    monkeypatch.setattr(main, "PROVIDER_RACE_GRAPH_GRACE_SECONDS", 0.05)
+    unsettled = main._PROVIDER_STATS["unsettled"]
+    assert asyncio.run(main._exchange_detecting_provider("v@x.com", "cid", "rt"))[::3] == ("imap-token", "imap")
+    assert main._provider_key("v@x.com", "cid") not in main._PROVIDER_MEMO
+    assert main._PROVIDER_STATS["unsettled"] == unsettled + 1
+
+
+def test_stale_provider_memo_falls_back_and_is_replaced(monkeypatch):
+    async def graph(client_id, refresh_token):
+        return "graph-token", 3600, None
+
+    monkeypatch.setattr(outlook_graph, "exchange_refresh_token_graph", graph)
+    main._PROVIDER_MEMO.put(main._provider_key("u@x.com", "cid"), "imap", time.time() + 60)
+    stale_before = main._PROVIDER_STATS["memo_stale"]
+
+    assert asyncio.run(main.get_outlook_access_token("u@x.com", "cid", "rt")) == ("graph-token", "graph")
+    assert main._PROVIDER_MEMO[main._provider_key("u@x.com", "cid")] == "graph"
+    assert main._PROVIDER_STATS["memo_stale"] == stale_before + 1
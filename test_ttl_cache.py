@@ -0,0 +1,40 @@
+from api.ttl_cache import TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_expiry_follows_latest_put_and_lazy_get():
+    clock = Clock()
+    cache = TTLCache(10, clock=clock)
+    cache.put("a", 1, 1010)
+    cache.put("b", 2, 1020)
+    cache.put("a", 3, 1030)  # the heap item for a@1010 is now stale
+    clock.now = 1015
+    assert cache.expire() == 0 and cache["a"] == 3
+    clock.now = 1025
+    assert "b" not in cache and cache.get("b", "gone") == "gone"
+    assert cache.expire() == 0  # b already dropped lazily by get
+    clock.now = 1030
+    assert cache.expire() == 1 and len(cache) == 0
+    assert cache.expirations == 2
+
+
+def test_cap_evicts_least_recently_used_and_heap_stays_bounded():
+    clock = Clock()
+    cache = TTLCache(3, clock=clock)
+    for key in "abc":
+        cache.put(key, key, 2000)
+    cache.get("a")
+    cache.put("d", "d", 2000)
+    assert dict(cache.items()) == {"c": "c", "a": "a", "d": "d"} and cache.evictions == 1
+    for i in range(1000):
+        cache.put("a", i, 2000 + i)
+    assert cache.stats()["heap"] <= 2 * len(cache) + 64
+    clock.now = 2500
+    assert cache.pop("a") == 999 and cache.pop("c") is None